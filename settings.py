@@ -90,3 +90,35 @@ INSTALLED_APPS = (
     'django.contrib.gis',
     'shapeEditor',
 )
+
+# The directory to keep copies of exported shapefiles in.  If this isn't set,
+# a "shapeEditor-exports" directory within the system's temporary directory
+# is used.
+#
+# SHAPEEDITOR_EXPORT_CACHE_DIR = "/var/cache/shapeEditor/exports"
+
+# If the front-end web server supports sending files on Django's behalf, set
+# this to the name of the header to use (for example, "X-Sendfile" for
+# Apache's mod_xsendfile).
+#
+# SHAPEEDITOR_SENDFILE_HEADER = "X-Sendfile"
+
+# Shapefiles with more than this number of features are deleted in the
+# background, so that the user doesn't have to wait for the delete to
+# finish.  Set this to None to always delete shapefiles straight away.
+#
+# SHAPEEDITOR_BACKGROUND_DELETE_THRESHOLD = 100000
+
+# To answer feature lookups from an in-memory spatial index rather than the
+# database, set this to the maximum amount of memory, in bytes, to use for
+# the indexes.  Shapefiles which don't fit are always looked up in the
+# database.
+#
+# SHAPEEDITOR_SPATIAL_CACHE_SIZE = 64 * 1024 * 1024
+
+# The list of shapefiles is cached using Django's cache, and the cached list
+# is discarded whenever a shapefile changes.  The default cache is local to
+# each process, so when running more than one process, use a shared cache
+# so that every process sees changes straight away.
+#
+# CACHE_BACKEND = "memcached://127.0.0.1:11211/"
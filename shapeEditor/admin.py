@@ -4,6 +4,6 @@ from django.contrib.gis import admin
 from models import Feature
 
 class MultiPolygonAdmin(admin.GeoModelAdmin):
-    fields = ['geom_multipolygon']
+    fields = ['geometry']
 
 
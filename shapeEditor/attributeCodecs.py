@@ -0,0 +1,333 @@
+# attributeCodecs.py
+#
+# This module implements the logic for converting attribute values between
+# OGR features and the values we store in the database.
+#
+# Each attribute value is stored as the JSON value matching the attribute's
+# declared type: integers and reals are stored as numbers (with reals rounded
+# to the attribute's precision), strings as strings, and lists as arrays.
+# Dates, times and date/times are stored as ISO 8601 strings, such as
+# "2010-07-04", "13:45:00" and "2010-07-04T13:45:00", which sort correctly
+# when compared as text.
+#
+# Rather than working out how to convert each attribute value as we go, we
+# "compile" a decoder or encoder function for each of the shapefile's
+# attributes up front.  Each codec looks up its OGR field by index and knows
+# exactly which conversion to apply, so converting a feature's attributes is
+# simply a matter of calling each codec in turn.
+
+from osgeo import ogr
+
+import ast
+import json
+
+#############################################################################
+
+def compileDecoders(attributes, featureDefn, encoding):
+    """ Return a list of decoders for extracting the given attributes.
+
+        The parameters are as follows:
+
+            'attributes'
+
+                A list of Attribute objects describing the attributes to
+                extract.
+
+            'featureDefn'
+
+                The OGR FeatureDefn object for the layer the features will be
+                read from.
+
+            'encoding'
+
+                The character encoding to use for string values.
+
+        We return a list with one decoder function for each attribute, in
+        the same order as the 'attributes' list.  Each decoder function takes
+        an OGR Feature object, and returns a (success, result) tuple, where
+        'success' will be True iff the attribute was successfully extracted,
+        and 'result' is either the attribute's value, converted to the type
+        of value we store in the database (or None if the attribute isn't
+        set), or a suitable error message explaining why the attribute could
+        not be extracted.
+    """
+    decoders = []
+    for attr in attributes:
+        fieldIndex = featureDefn.GetFieldIndex(str(attr.name))
+        decoders.append(_makeDecoder(attr, fieldIndex, encoding))
+    return decoders
+
+
+def compileEncoders(attributes, featureDefn, encoding):
+    """ Return a list of encoders for storing the given attributes.
+
+        The parameters are as follows:
+
+            'attributes'
+
+                A list of Attribute objects describing the attributes to
+                store.
+
+            'featureDefn'
+
+                The OGR FeatureDefn object for the layer the features will be
+                written to.
+
+            'encoding'
+
+                The character encoding to use for string values.
+
+        We return a list with one encoder function for each attribute, in
+        the same order as the 'attributes' list.  Each encoder function takes
+        an OGR Feature object and the attribute's value (as stored in the
+        database), and stores that value into the given feature.
+    """
+    encoders = []
+    for attr in attributes:
+        fieldIndex = featureDefn.GetFieldIndex(str(attr.name))
+        encoders.append(_makeEncoder(attr, fieldIndex, encoding))
+    return encoders
+
+
+def compileLegacyParsers(attributes):
+    """ Return a list of parsers for reading old-style attribute values.
+
+        Earlier versions of the ShapeEditor stored every attribute value as
+        a string.  'attributes' is a list of Attribute objects, and we return
+        a list with one parser function for each attribute, in the same order
+        as the 'attributes' list.  Each parser function takes an attribute
+        value as stored in the database, and returns the equivalent typed
+        value.  Values which are already stored using the correct type are
+        returned unchanged.
+    """
+    parsers = []
+    for attr in attributes:
+        parsers.append(_makeLegacyParser(attr))
+    return parsers
+
+
+def encodeList(values):
+    """ Convert a list of attribute values into a string for storage.
+
+        We use a JSON array to store list values, so that they can be read
+        back in again without having to evaluate the string.
+    """
+    return json.dumps(values, ensure_ascii=False)
+
+
+def decodeList(value):
+    """ Convert a string created by encodeList() back into a list of values.
+
+        For backwards compatibility, we also accept the Python repr() format
+        used by earlier versions of the ShapeEditor to store list values.
+    """
+    try:
+        return json.loads(value)
+    except ValueError:
+        return list(ast.literal_eval(value))
+
+
+def formatDateTime(type, year, month, day, hour, minute, second, tzone):
+    """ Convert the given date and/or time into an ISO 8601 string.
+
+        'type' is the OGR field type of the attribute being converted: one
+        of ogr.OFTDate, ogr.OFTTime or ogr.OFTDateTime.  The remaining
+        parameters are as returned by OGR's Feature.GetFieldAsDateTime()
+        method.  Date/time values in GMT (a 'tzone' value of 100) are given
+        a "Z" suffix.
+    """
+    if type == ogr.OFTDate:
+        return "%04d-%02d-%02d" % (year, month, day)
+    elif type == ogr.OFTTime:
+        return "%02d:%02d:%02d" % (hour, minute, second)
+    else:
+        value = "%04d-%02d-%02dT%02d:%02d:%02d" % (year, month, day,
+                                                   hour, minute, second)
+        if tzone == 100:
+            value = value + "Z"
+        return value
+
+
+def parseDateTime(type, value):
+    """ Convert an ISO 8601 string created by formatDateTime() back again.
+
+        We return a (year, month, day, hour, minute, second, tzone) tuple.
+        If the string can't be parsed, we raise a ValueError.
+    """
+    year = month = day = hour = minute = second = tzone = 0
+    if value.endswith("Z"):
+        tzone = 100
+        value = value[:-1]
+
+    if type == ogr.OFTDate:
+        year,month,day = [int(s) for s in value.split("-")]
+    elif type == ogr.OFTTime:
+        hour,minute,second = [int(s) for s in value.split(":")]
+    else:
+        date,time = value.split("T")
+        year,month,day     = [int(s) for s in date.split("-")]
+        hour,minute,second = [int(s) for s in time.split(":")]
+    return (year, month, day, hour, minute, second, tzone)
+
+#############################################################################
+#
+# Private definitions:
+
+def _makeDecoder(attr, fieldIndex, encoding):
+    """ Return a decoder function for the given attribute.
+
+        'attr' is the Attribute object to decode, 'fieldIndex' is the index
+        of the attribute's field within the OGR feature, and 'encoding' is
+        the character encoding to use for string values.
+    """
+    if attr.type == ogr.OFTInteger:
+        def convert(feature):
+            return (True, feature.GetFieldAsInteger(fieldIndex))
+    elif attr.type == ogr.OFTIntegerList:
+        def convert(feature):
+            return (True, feature.GetFieldAsIntegerList(fieldIndex))
+    elif attr.type == ogr.OFTReal:
+        precision = attr.precision
+        def convert(feature):
+            value = feature.GetFieldAsDouble(fieldIndex)
+            return (True, round(value, precision))
+    elif attr.type == ogr.OFTRealList:
+        precision = attr.precision
+        def convert(feature):
+            values = feature.GetFieldAsDoubleList(fieldIndex)
+            return (True, [round(value, precision) for value in values])
+    elif attr.type == ogr.OFTString:
+        def convert(feature):
+            value = feature.GetFieldAsString(fieldIndex)
+            try:
+                return (True, value.decode(encoding))
+            except UnicodeDecodeError:
+                return (False, _decodeErrorMessage(attr))
+    elif attr.type == ogr.OFTStringList:
+        def convert(feature):
+            values = feature.GetFieldAsStringList(fieldIndex)
+            try:
+                return (True, [value.decode(encoding) for value in values])
+            except UnicodeDecodeError:
+                return (False, _decodeErrorMessage(attr))
+    elif attr.type in [ogr.OFTDate, ogr.OFTTime, ogr.OFTDateTime]:
+        type = attr.type
+        def convert(feature):
+            parts = feature.GetFieldAsDateTime(fieldIndex)
+            return (True, formatDateTime(type, *parts))
+    else:
+        errMsg = "Unsupported attribute type: " + str(attr.type)
+        def convert(feature):
+            return (False, errMsg)
+
+    def decode(feature):
+        if not feature.IsFieldSet(fieldIndex):
+            return (True, None)
+        return convert(feature)
+
+    return decode
+
+
+def _makeEncoder(attr, fieldIndex, encoding):
+    """ Return an encoder function for the given attribute.
+
+        'attr' is the Attribute object to encode, 'fieldIndex' is the index
+        of the attribute's field within the OGR feature, and 'encoding' is
+        the character encoding to use for string values.
+    """
+    if attr.type == ogr.OFTInteger:
+        def convert(feature, value):
+            feature.SetField(fieldIndex, int(value))
+    elif attr.type == ogr.OFTIntegerList:
+        def convert(feature, value):
+            feature.SetFieldIntegerList(fieldIndex,
+                                        [int(n) for n in value])
+    elif attr.type == ogr.OFTReal:
+        def convert(feature, value):
+            feature.SetField(fieldIndex, float(value))
+    elif attr.type == ogr.OFTRealList:
+        def convert(feature, value):
+            feature.SetFieldDoubleList(fieldIndex,
+                                       [float(n) for n in value])
+    elif attr.type == ogr.OFTString:
+        def convert(feature, value):
+            feature.SetField(fieldIndex, value.encode(encoding))
+    elif attr.type == ogr.OFTStringList:
+        def convert(feature, value):
+            strings = []
+            for s in value:
+                if isinstance(s, unicode):
+                    s = s.encode(encoding)
+                strings.append(s)
+            feature.SetFieldStringList(fieldIndex, strings)
+    elif attr.type in [ogr.OFTDate, ogr.OFTTime, ogr.OFTDateTime]:
+        type = attr.type
+        def convert(feature, value):
+            parts = parseDateTime(type, value)
+            feature.SetField(fieldIndex, *parts)
+    else:
+        def convert(feature, value):
+            pass # Unsupported attribute type -> ignore.
+
+    def encode(feature, value):
+        if value == None:
+            feature.UnsetField(fieldIndex)
+        else:
+            convert(feature, value)
+
+    return encode
+
+
+def _makeLegacyParser(attr):
+    """ Return a parser function for the given attribute's old-style values.
+    """
+    if attr.type == ogr.OFTInteger:
+        convert = int
+    elif attr.type == ogr.OFTIntegerList:
+        def convert(value):
+            return [int(s) for s in decodeList(value)]
+    elif attr.type == ogr.OFTReal:
+        def convert(value):
+            return round(float(value), attr.precision)
+    elif attr.type == ogr.OFTRealList:
+        def convert(value):
+            return [round(float(s), attr.precision)
+                    for s in decodeList(value)]
+    elif attr.type == ogr.OFTStringList:
+        convert = decodeList
+    elif attr.type == ogr.OFTDate:
+        def convert(value):
+            year,month,day,tzone = [int(s) for s in value.split(",")]
+            return formatDateTime(attr.type, year, month, day,
+                                  0, 0, 0, tzone)
+    elif attr.type == ogr.OFTTime:
+        def convert(value):
+            hour,minute,second,tzone = [int(s) for s in value.split(",")]
+            return formatDateTime(attr.type, 0, 0, 0,
+                                  hour, minute, second, tzone)
+    elif attr.type == ogr.OFTDateTime:
+        def convert(value):
+            parts = [int(s) for s in value.split(",")]
+            return formatDateTime(attr.type, *parts)
+    else:
+        convert = None
+
+    def parse(value):
+        if convert == None or not isinstance(value, basestring):
+            return value # Already the correct type.
+        if (attr.type in [ogr.OFTDate, ogr.OFTTime, ogr.OFTDateTime]
+            and "," not in value):
+            return value # Already in ISO 8601 format.
+        return convert(value)
+
+    return parse
+
+
+def _decodeErrorMessage(attr):
+    """ Return the error message to use if 'attr' can't be decoded.
+    """
+    return ("Unable to decode value in " +
+            repr(str(attr.name)) + " attribute.&nbsp; " +
+            "Are you sure you're using the right " +
+            "character encoding?")
+
@@ -0,0 +1,272 @@
+# dbfReader.py
+#
+# This module implements a fast reader for the attribute values held in a
+# shapefile's ".dbf" file.
+#
+# Extracting attribute values via OGR means calling one of the GetFieldAs*()
+# methods for every attribute of every feature.  Because a DBF file is simply
+# a header followed by a sequence of fixed-width records, we can do much
+# better than this by memory-mapping the file and slicing each attribute's
+# column directly out of a batch of records, converting the whole column at
+# once.
+#
+# Only the common DBF field types are handled here.  For anything else, the
+# caller should fall back to extracting the attribute via OGR.
+
+from osgeo import ogr
+
+import codecs
+import mmap
+import struct
+
+#############################################################################
+
+class DBFError(Exception):
+    """ Exception raised when a DBF file or value can't be read.
+    """
+    pass
+
+#############################################################################
+
+class DBFReader(object):
+    """ A memory-mapped reader for a DBF file.
+
+        The reader exposes the following public attributes:
+
+            'numRecords'
+
+                The number of records in the DBF file.
+
+            'fields'
+
+                A list of (name, type, width, decimals, offset) tuples, one
+                for each field in the DBF file.  'offset' is the byte offset
+                of the field within a record.
+    """
+    def __init__(self, filename):
+        """ Open the given DBF file.
+
+            We raise a DBFError if the file can't be opened or its header is
+            invalid.
+        """
+        try:
+            self._file = open(filename, "rb")
+            self._buf  = mmap.mmap(self._file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        except (IOError, EnvironmentError, ValueError), e:
+            raise DBFError("Unable to open DBF file: " + str(e))
+
+        if len(self._buf) < 32:
+            self.close()
+            raise DBFError("DBF header is truncated.")
+
+        numRecords,headerLength,recordLength = \
+                struct.unpack("<IHH", self._buf[4:12])
+
+        self.numRecords    = numRecords
+        self._headerLength = headerLength
+        self._recordLength = recordLength
+
+        self.fields = []
+        offset = 1 # Skip the record's deletion flag.
+        pos    = 32
+        while pos + 32 <= headerLength and self._buf[pos] != "\r":
+            descriptor = self._buf[pos:pos+32]
+            name       = descriptor[:11].split("\0")[0]
+            type       = descriptor[11]
+            width      = ord(descriptor[16])
+            decimals   = ord(descriptor[17])
+            self.fields.append((name, type, width, decimals, offset))
+            offset = offset + width
+            pos    = pos + 32
+
+        if (offset > recordLength or
+            headerLength + numRecords * recordLength > len(self._buf)):
+            self.close()
+            raise DBFError("DBF file is truncated or corrupt.")
+
+
+    def close(self):
+        """ Close the DBF file.
+        """
+        if getattr(self, "_buf", None) != None:
+            self._buf.close()
+            self._buf = None
+        if getattr(self, "_file", None) != None:
+            self._file.close()
+            self._file = None
+
+
+    def iterRecordNums(self):
+        """ Iterate over the record numbers of the records in the DBF file.
+
+            Records which have been marked as deleted are skipped.
+        """
+        buf          = self._buf
+        headerLength = self._headerLength
+        recordLength = self._recordLength
+
+        for recordNum in xrange(self.numRecords):
+            if buf[headerLength + recordNum * recordLength] != "*":
+                yield recordNum
+
+
+    def compileColumn(self, attr, encoding):
+        """ Return a function which reads the given attribute's values.
+
+            'attr' is the Attribute object describing the attribute to read,
+            and 'encoding' is the character encoding to use for string
+            values.
+
+            If we can read the attribute directly from the DBF file, we return
+            a function which takes a list of record numbers and returns a
+            list of the attribute's values for those records, converted in
+            exactly the same way as attributeCodecs does (or None if the
+            value isn't set).  If any of the values can't be converted,
+            the function raises a DBFError.
+
+            If the attribute can't be read directly from the DBF file (for
+            example, because it uses an unusual field type), we return None.
+            In this case, the caller should extract the attribute via OGR.
+        """
+        for name,type,width,decimals,offset in self.fields:
+            if name == str(attr.name):
+                break
+        else:
+            return None
+
+        if attr.type == ogr.OFTInteger and type in "NF":
+            convert = _convertInteger
+        elif attr.type == ogr.OFTReal and type in "NF":
+            convert = _makeRealConverter(attr.precision)
+        elif attr.type == ogr.OFTDate and type == "D":
+            convert = _convertDate
+        elif attr.type == ogr.OFTString and type == "C":
+            return self._makeStringColumn(offset, width, encoding)
+        else:
+            return None
+
+        def column(recordNums):
+            try:
+                return convert(self._slice(recordNums, offset, width))
+            except (ValueError, OverflowError), e:
+                raise DBFError(str(e))
+
+        return column
+
+    # =====================
+    # == PRIVATE METHODS ==
+    # =====================
+
+    def _slice(self, recordNums, offset, width):
+        """ Return the raw values for one column of the given records.
+
+            We return a list of strings, one for each of the given record
+            numbers, holding the raw bytes of the field starting at the given
+            offset and width.
+        """
+        buf          = self._buf
+        headerLength = self._headerLength
+        recordLength = self._recordLength
+
+        values = []
+        for recordNum in recordNums:
+            start = headerLength + recordNum * recordLength + offset
+            values.append(buf[start:start+width])
+        return values
+
+
+    def _makeStringColumn(self, offset, width, encoding):
+        """ Return a function to read a column of string values.
+
+            For single-byte character encodings, we decode the entire column
+            in one go and then split it into individual values.  For other
+            encodings we have to decode each value separately.
+        """
+        singleByte = codecs.lookup(encoding).name in _SINGLE_BYTE_ENCODINGS
+
+        def column(recordNums):
+            rawValues = self._slice(recordNums, offset, width)
+            try:
+                if singleByte:
+                    text = "".join(rawValues).decode(encoding)
+                    values = []
+                    for i in range(len(rawValues)):
+                        values.append(text[i*width:(i+1)*width])
+                else:
+                    values = [value.decode(encoding) for value in rawValues]
+            except UnicodeDecodeError, e:
+                raise DBFError(str(e))
+
+            results = []
+            for value in values:
+                value = value.split(u"\0", 1)[0].strip(u" ")
+                if value == u"":
+                    results.append(None)
+                else:
+                    results.append(value)
+            return results
+
+        return column
+
+#############################################################################
+#
+# Private definitions:
+
+# The names (as returned by codecs.lookup()) of the character encodings which
+# use exactly one byte per character.
+
+_SINGLE_BYTE_ENCODINGS = ["ascii", "iso8859-1", "latin-1", "cp1252"]
+
+
+def _isNullNumber(value):
+    """ Return True if the given raw numeric value represents a null value.
+    """
+    return value == "" or value.startswith("*")
+
+
+def _convertInteger(rawValues):
+    """ Convert a list of raw integer values.
+    """
+    results = []
+    for value in rawValues:
+        value = value.split("\0", 1)[0].strip()
+        if _isNullNumber(value):
+            results.append(None)
+        else:
+            results.append(int(value))
+    return results
+
+
+def _makeRealConverter(precision):
+    """ Return a function which converts a list of raw real values.
+    """
+    def convert(rawValues):
+        results = []
+        for value in rawValues:
+            value = value.split("\0", 1)[0].strip()
+            if _isNullNumber(value):
+                results.append(None)
+            else:
+                results.append(round(float(value), precision))
+        return results
+    return convert
+
+
+def _convertDate(rawValues):
+    """ Convert a list of raw date values.
+    """
+    results = []
+    for value in rawValues:
+        value = value.split("\0", 1)[0].strip()
+        if value in ["", "0"] or value.startswith("00000000"):
+            results.append(None)
+        elif len(value) != 8:
+            raise ValueError("Invalid date value: " + repr(value))
+        else:
+            year  = int(value[0:4])
+            month = int(value[4:6])
+            day   = int(value[6:8])
+            results.append("%04d-%02d-%02d" % (year, month, day))
+    return results
+
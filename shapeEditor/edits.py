@@ -0,0 +1,235 @@
+# edits.py
+#
+# This module defines the batches of edits which can be applied to a
+# shapefile's features in a single request.
+#
+# A batch of edits is a list of changes, each one inserting, updating or
+# deleting a single feature.  As with filters.py, this module simply checks
+# the changes and converts them into the values we store; the featureStore
+# module applies the whole batch to the database in a single transaction,
+# using a handful of set-based statements.
+
+from django.contrib.gis.gdal import OGRException
+from django.contrib.gis.geos import GEOSGeometry, GEOSException
+from osgeo import ogr
+
+import json
+
+import attributeCodecs
+import featureStore
+import utils
+
+#############################################################################
+
+class EditError(Exception):
+    """ Exception raised when a batch of edits can't be applied.
+
+        The exception's message describes the problem.
+    """
+    pass
+
+#############################################################################
+
+class FeatureEdits(object):
+    """ A batch of edits to a shapefile's features.
+
+        The batch exposes the following public attributes:
+
+            'attributes'
+
+                A list of the shapefile's Attribute objects.
+
+            'inserts'
+
+                A list of (geometry, values) tuples, one for each feature to
+                insert, where 'geometry' is the new feature's GEOSGeometry
+                object and 'values' is a list of the feature's attribute
+                values, in the same order as 'attributes'.
+
+            'updates'
+
+                A list of (featureId, geometry, values) tuples, one for each
+                feature to update.  'geometry' is the feature's new
+                GEOSGeometry object, or None if the geometry isn't being
+                changed, and 'values' is a dictionary mapping the names of
+                the attributes to change to their new values, with None for
+                attributes which are to be cleared.
+
+            'deletes'
+
+                A list of the record IDs of the features to delete.
+    """
+    def __init__(self, attributes):
+        """ Initialise an empty batch of edits.
+        """
+        self.attributes = attributes
+        self.inserts    = []
+        self.updates    = []
+        self.deletes    = []
+
+#############################################################################
+
+def parseEdits(shapefile, changes):
+    """ Parse a batch of edits to the given shapefile.
+
+        'shapefile' is the Shapefile object the edits apply to, and
+        'changes' is the batch of edits, decoded from JSON.  The batch must
+        be a list of objects, each with the following members:
+
+            'action'
+
+                The type of change: one of "insert", "update" or "delete".
+
+            'id'
+
+                The record ID of the feature to update or delete.
+
+            'geometry'
+
+                The feature's new geometry, as a GeoJSON geometry object or
+                as WKT, in lat/long coordinates.  This is required for
+                inserts, and optional for updates.
+
+            'attributes'
+
+                An optional object mapping attribute names to the feature's
+                new attribute values.  Values are given as numbers, strings
+                or lists as appropriate for the attribute's type, with dates
+                and times given in ISO 8601 format.  When updating a feature,
+                only the given attributes are changed; use null to clear an
+                attribute's value.
+
+        We return a FeatureEdits object.  If the edits are invalid, we raise
+        an EditError.
+    """
+    if not isinstance(changes, list):
+        raise EditError("Changes must be a list.")
+
+    attributes = list(shapefile.attribute_set.all())
+    attrsByName = {}
+    for attr in attributes:
+        attrsByName[attr.name] = attr
+
+    edits = FeatureEdits(attributes)
+    changed = set()
+
+    for change in changes:
+        if not isinstance(change, dict):
+            raise EditError("Invalid change: " + json.dumps(change))
+
+        action = change.get("action")
+        if action not in ["insert", "update", "delete"]:
+            raise EditError("Invalid action: " + json.dumps(action))
+
+        if action != "insert":
+            featureId = change.get("id")
+            if (isinstance(featureId, bool) or
+                not isinstance(featureId, (int, long))):
+                raise EditError("Invalid feature ID: " +
+                                json.dumps(featureId))
+            if featureId in changed:
+                raise EditError("Feature changed more than once: %d" %
+                                featureId)
+            changed.add(featureId)
+
+        geometry = None
+        if change.get("geometry") != None and action != "delete":
+            geometry = _parseGeometry(shapefile, change['geometry'])
+
+        values = {}
+        if change.get("attributes") != None and action != "delete":
+            if not isinstance(change['attributes'], dict):
+                raise EditError("Invalid attributes: " +
+                                json.dumps(change['attributes']))
+            for name,value in change['attributes'].items():
+                if name not in attrsByName:
+                    raise EditError("Unknown attribute: " + name)
+                values[name] = _parseValue(attrsByName[name], value)
+
+        if action == "insert":
+            if geometry == None:
+                raise EditError("Inserted features must have a geometry.")
+            edits.inserts.append((geometry, [values.get(attr.name)
+                                             for attr in attributes]))
+        elif action == "update":
+            edits.updates.append((featureId, geometry, values))
+        else:
+            edits.deletes.append(featureId)
+
+    return edits
+
+#############################################################################
+#
+# Private definitions:
+
+def _parseGeometry(shapefile, value):
+    """ Parse a feature's new geometry.
+
+        'value' is the geometry as given in the batch of edits.  We return
+        the geometry as a GEOSGeometry object, wrapped in the same way as
+        imported geometries.
+    """
+    try:
+        if isinstance(value, basestring):
+            geometry = GEOSGeometry(value, srid=4326)
+        else:
+            geometry = GEOSGeometry(json.dumps(value), srid=4326)
+    except (GEOSException, OGRException, TypeError, ValueError):
+        raise EditError("Invalid geometry: " + json.dumps(value))
+
+    geometry = utils.wrapGEOSGeometry(geometry)
+    geometry.srid = 4326
+
+    geometryType = utils.calcGeometryFieldType(shapefile.geom_type)
+    if (geometryType not in ["Unknown", "None"] and
+        geometry.geom_type != geometryType):
+        raise EditError("Not a " + geometryType + ": " + json.dumps(value))
+    return geometry
+
+
+def _parseValue(attr, value):
+    """ Check and convert a new attribute value.
+
+        We return the value as it should be stored for the given Attribute,
+        or None if the attribute's value is to be cleared.
+    """
+    if value == None:
+        return None
+
+    if attr.type in [ogr.OFTIntegerList, ogr.OFTRealList,
+                     ogr.OFTStringList]:
+        if not isinstance(value, list):
+            raise EditError("Invalid value for " + attr.name + ": " +
+                            json.dumps(value))
+        elementType = {ogr.OFTIntegerList : ogr.OFTInteger,
+                       ogr.OFTRealList    : ogr.OFTReal,
+                       ogr.OFTStringList  : ogr.OFTString}[attr.type]
+        return [_parseScalar(attr, elementType, element)
+                for element in value]
+    else:
+        return _parseScalar(attr, attr.type, value)
+
+
+def _parseScalar(attr, type, value):
+    """ Check and convert a single attribute value of the given OGR type.
+    """
+    if type not in featureStore.SCALAR_TYPES:
+        raise EditError("Unable to edit attribute: " + attr.name)
+
+    try:
+        if isinstance(value, bool):
+            raise ValueError(value)
+        elif type == ogr.OFTInteger and isinstance(value, (int, long)):
+            return value
+        elif type == ogr.OFTReal and isinstance(value, (int, long, float)):
+            return round(float(value), attr.precision)
+        elif type == ogr.OFTString and isinstance(value, basestring):
+            return unicode(value)
+        elif (type in [ogr.OFTDate, ogr.OFTTime, ogr.OFTDateTime] and
+              isinstance(value, basestring)):
+            parts = attributeCodecs.parseDateTime(type, value)
+            return attributeCodecs.formatDateTime(type, *parts)
+        raise ValueError(value)
+    except ValueError:
+        raise EditError("Invalid value for " + attr.name + ": " +
+                        json.dumps(value))
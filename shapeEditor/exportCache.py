@@ -0,0 +1,329 @@
+# exportCache.py
+#
+# This module implements a disk cache of exported shapefiles.
+#
+# Exporting a large shapefile is expensive, and the exported file only
+# changes when the shapefile's features are edited.  We therefore keep a copy
+# of each exported file on disk, named after the shapefile's ID and its
+# current version number.  Because the version number is bumped whenever the
+# shapefile is edited, a cached file can be sent as-is for as long as it
+# exists, complete with a Content-Length, an ETag and support for HTTP range
+# requests.  This lets interrupted downloads be resumed, and lets clients
+# read just the parts of a FlatGeobuf file they need.  Each response also
+# carries the time the shapefile was last modified.
+
+from django.conf import settings
+from django.core.servers.basehttp import FileWrapper
+from django.http import HttpResponse
+from django.utils.http import http_date
+
+from geoedit.shapeEditor.models import Shapefile
+
+import os
+import os.path
+import re
+import tempfile
+import time
+
+import shapefileIO
+
+#############################################################################
+
+def getExportResponse(request, shapefile, compress=True):
+    """ Return an HttpResponse which sends the given shapefile to the user.
+
+        'request' is the HttpRequest asking for the export, 'shapefile' is the
+        Shapefile object to export, and 'compress' is True if the exported
+        ZIP archive should be compressed.
+
+        If we have a cached copy of the shapefile's current version, we send
+        that.  Otherwise, we stream a freshly generated export to the user,
+        saving a copy into the cache as we go.
+    """
+    if compress:
+        mode = "deflate"
+    else:
+        mode = "store"
+
+    def generate():
+        return shapefileIO.generateExport(shapefile, compress)
+
+    return _getResponse(request, shapefile, mode, ".zip", "application/zip",
+                        generate)
+
+
+def getFlatGeobufResponse(request, shapefile, index=True):
+    """ Return an HttpResponse which sends the shapefile in FlatGeobuf format.
+
+        'request' is the HttpRequest asking for the export, 'shapefile' is the
+        Shapefile object to export, and 'index' is True if the FlatGeobuf file
+        should include a spatial index.
+
+        As with getExportResponse(), we send a cached copy of the file if we
+        have one.
+    """
+    if index:
+        mode = "indexed"
+    else:
+        mode = "unindexed"
+
+    def generate():
+        return shapefileIO.generateFlatGeobuf(shapefile, index)
+
+    return _getResponse(request, shapefile, mode, ".fgb",
+                        "application/octet-stream", generate)
+
+
+def purge(shapefileId, beforeVersion=None):
+    """ Remove the cached exports for the given shapefile.
+
+        If 'beforeVersion' is specified, we only remove the cached exports
+        of versions of the shapefile older than that version.  Otherwise,
+        all the shapefile's cached exports are removed.
+    """
+    prefix = "%d-" % shapefileId
+    dirName = _getCacheDir()
+    for fName in os.listdir(dirName):
+        if not fName.startswith(prefix):
+            continue
+        if beforeVersion != None:
+            try:
+                version = int(fName[len(prefix):].split("-")[0])
+            except ValueError:
+                continue
+            if version >= beforeVersion:
+                continue
+        try:
+            os.remove(os.path.join(dirName, fName))
+        except OSError:
+            pass # Already removed.
+
+#############################################################################
+#
+# Private definitions:
+
+# The number of bytes to read at once when sending part of a cached file.
+
+_CHUNK_SIZE = 65536
+
+
+def _getCacheDir():
+    """ Return the directory to store our cached exports in.
+
+        This can be set using the SHAPEEDITOR_EXPORT_CACHE_DIR setting.  We
+        create the directory if it doesn't already exist.
+    """
+    dirName = getattr(settings, "SHAPEEDITOR_EXPORT_CACHE_DIR", None)
+    if dirName == None:
+        dirName = os.path.join(tempfile.gettempdir(), "shapeEditor-exports")
+    if not os.path.isdir(dirName):
+        try:
+            os.makedirs(dirName)
+        except OSError:
+            pass # Created by another process.
+    return dirName
+
+
+def _getResponse(request, shapefile, mode, suffix, contentType, generate):
+    """ Return an HttpResponse which sends an exported copy of a shapefile.
+
+        The parameters are as follows:
+
+            'request'
+
+                The HttpRequest asking for the export.
+
+            'shapefile'
+
+                The Shapefile object to export.
+
+            'mode'
+
+                A string identifying the variant of the export being sent,
+                for example "deflate".
+
+            'suffix'
+
+                The filename suffix to use for the exported file.
+
+            'contentType'
+
+                The MIME type to use for the exported file.
+
+            'generate'
+
+                A function which returns a generator yielding the chunks of
+                a freshly exported file.
+    """
+    shapefileName = os.path.splitext(shapefile.filename)[0]
+    path = _calcCachePath(shapefile, mode, suffix)
+    etag = '"%d-%d-%s"' % (shapefile.id, shapefile.version, mode)
+
+    # The cached file may be purged at any moment, so rather than checking
+    # whether it exists, we simply try to open it.
+
+    try:
+        f = open(path, "rb")
+    except (IOError, OSError):
+        f = None
+
+    if f != None:
+        response = _serveFile(request, f, path, etag, contentType)
+    else:
+        response = HttpResponse(_saveToCache(generate(), shapefile, path),
+                                content_type=contentType)
+        response['ETag'] = etag
+
+    response['Content-Disposition'] = "attachment; filename=" \
+                                    + shapefileName + suffix
+    response['Last-Modified'] = http_date(
+                                time.mktime(shapefile.modified.timetuple()))
+    return response
+
+
+def _calcCachePath(shapefile, mode, suffix):
+    """ Return the path to use for caching the given shapefile's export.
+    """
+    fName = "%d-%d-%s%s" % (shapefile.id, shapefile.version, mode, suffix)
+    return os.path.join(_getCacheDir(), fName)
+
+
+def _saveToCache(chunks, shapefile, path):
+    """ Save a copy of the given export into our cache.
+
+        We yield each chunk of the exported ZIP archive unchanged, while
+        writing it to a temporary file.  If the export completes, we replace
+        any older exports of this shapefile with the new one.  If the export
+        fails or the download is abandoned, the partial file is discarded,
+        as it is if the shapefile has been edited or deleted while it was
+        being exported, so that a slow export can't replace a newer one.
+    """
+    fd,tempPath = tempfile.mkstemp(prefix=".partial-",
+                                   dir=os.path.dirname(path))
+    f = os.fdopen(fd, "wb")
+    completed = False
+    try:
+        for chunk in chunks:
+            f.write(chunk)
+            yield chunk
+        completed = True
+    finally:
+        f.close()
+        if completed:
+            versions = Shapefile.objects.filter(id=shapefile.id).values_list(
+                                                        "version", flat=True)
+            completed = (list(versions) == [shapefile.version])
+        if completed:
+            purge(shapefile.id, beforeVersion=shapefile.version)
+            os.rename(tempPath, path)
+        else:
+            os.remove(tempPath)
+
+
+def _serveFile(request, f, path, etag, contentType):
+    """ Return an HttpResponse which sends the given cached file.
+
+        'f' is the cached file, already opened, and 'path' is its path.
+
+        We support conditional requests using the file's ETag, as well as
+        requests for a single range of bytes within the file.
+
+        If the SHAPEEDITOR_SENDFILE_HEADER setting is defined (for example,
+        as "X-Sendfile"), we leave it to the front-end web server to send
+        the file, along with any ranges it contains.
+    """
+    if request.META.get("HTTP_IF_NONE_MATCH") == etag:
+        f.close()
+        response = HttpResponse(status=304)
+        response['ETag'] = etag
+        return response
+
+    size = os.fstat(f.fileno()).st_size
+
+    sendfileHeader = getattr(settings, "SHAPEEDITOR_SENDFILE_HEADER", None)
+    if sendfileHeader != None:
+        f.close()
+        response = HttpResponse(content_type=contentType)
+        response[sendfileHeader] = path
+        response['ETag'] = etag
+        return response
+
+    # See if the user is asking for part of the file.  We only honour the
+    # range if the file hasn't changed since the user started downloading
+    # it.
+
+    byteRange = None
+    if "HTTP_RANGE" in request.META:
+        ifRange = request.META.get("HTTP_IF_RANGE")
+        if ifRange == None or ifRange == etag:
+            byteRange = _parseRange(request.META['HTTP_RANGE'], size)
+            if byteRange is False:
+                f.close()
+                response = HttpResponse(status=416)
+                response['Content-Range'] = "bytes */%d" % size
+                return response
+
+    if byteRange == None:
+        response = HttpResponse(FileWrapper(f), content_type=contentType)
+        response['Content-Length'] = size
+    else:
+        start,end = byteRange
+        response = HttpResponse(_readRange(f, start, end),
+                                content_type=contentType, status=206)
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = "bytes %d-%d/%d" % (start, end, size)
+
+    response['Accept-Ranges'] = "bytes"
+    response['ETag'] = etag
+    return response
+
+
+def _parseRange(header, size):
+    """ Parse the given HTTP "Range" header.
+
+        'header' is the value of the "Range" header, and 'size' is the size
+        of the file being sent.  We return a (start, end) tuple for the
+        (inclusive) range of bytes to send, None if the header should be
+        ignored and the entire file sent, or False if the requested range
+        can't be satisfied.
+
+        Note that we only support requests for a single range of bytes.
+    """
+    match = re.match(r"^bytes=(\d*)-(\d*)$", header.strip())
+    if match == None:
+        return None # Malformed or multiple ranges -> ignore.
+
+    first,last = match.groups()
+    if first == "" and last == "":
+        return None
+    elif first == "":
+        # Suffix range: the last N bytes of the file.
+        start = max(size - int(last), 0)
+        end   = size - 1
+    else:
+        start = int(first)
+        if last == "":
+            end = size - 1
+        else:
+            end = min(int(last), size - 1)
+
+    if start > end or start >= size:
+        return False
+    return (start, end)
+
+
+def _readRange(f, start, end):
+    """ Yield the given (inclusive) range of bytes from the given file.
+    """
+    try:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining = remaining - len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
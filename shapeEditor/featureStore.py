@@ -0,0 +1,1287 @@
+# featureStore.py
+#
+# This module implements set-based access to the features stored in our
+# database.
+#
+# Going through the Django ORM means one query for every Feature we save or
+# load.  For operations which touch all the features in a shapefile, we talk
+# to the database directly instead, using a handful of statements per batch
+# of features.
+#
+# The Feature table can also be partitioned by shapefile (see the
+# "partitionfeatures" management command), so that each shapefile's features
+# are stored in a table of their own.  Queries for a single shapefile's
+# features then only touch that shapefile's table and indexes, and deleting
+# a shapefile simply drops its table.  This module takes care of creating
+# and dropping the partitions as shapefiles come and go.
+
+from django.db import connection, transaction
+from osgeo import ogr
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from geoedit.shapeEditor.models import Shapefile, Attribute, Feature
+from geoedit.shapeEditor.models import FeatureChange
+from geoedit.shapeEditor.models import changesShapefileList
+from geoedit.shapeEditor.models import shapefileListChanged
+
+import array
+import itertools
+import json
+
+import utils
+
+#############################################################################
+
+# The number of features to fetch from the database at once when iterating
+# over a shapefile's features.
+
+FETCH_BATCH_SIZE = 1000
+
+# The attribute types which hold a single value, and can therefore be used
+# to filter, sort and index a shapefile's features.
+
+SCALAR_TYPES = [ogr.OFTInteger, ogr.OFTReal, ogr.OFTString,
+                ogr.OFTDate, ogr.OFTTime, ogr.OFTDateTime]
+
+#############################################################################
+
+def insertFeatures(shapefile, attributes, features):
+    """ Insert a batch of new features into the given shapefile.
+
+        The parameters are as follows:
+
+            'shapefile'
+
+                The Shapefile object to add the features to.
+
+            'attributes'
+
+                A list of the shapefile's Attribute objects.
+
+            'features'
+
+                A list of (geometry, values) tuples, one for each feature to
+                insert.  'geometry' is the feature's GEOSGeometry object, and
+                'values' is a list of the feature's attribute values (as
+                returned by attributeCodecs, or None), in the same order as
+                'attributes'.
+
+        We insert the features, along with their geometry types, bounding
+        boxes and attribute values, using a single statement, and return a
+        list of the new features' record IDs.
+    """
+    if len(features) == 0:
+        return []
+
+    qn = connection.ops.quote_name
+
+    cursor = connection.cursor()
+
+    sql = ("INSERT INTO " + qn(Feature._meta.db_table) +
+           " (" + qn(_column(Feature, "shapefile")) + ", " +
+           qn(_column(Feature, "geometry")) + ", " +
+           qn(_column(Feature, "geometry_type")) + ", " +
+           qn(_column(Feature, "bbox")) + ", " +
+           qn(_column(Feature, "attributes")) + ") VALUES " +
+           ", ".join(["(%s, ST_GeomFromWKB(%s, 4326), %s, " +
+                      "ST_MakeEnvelope(%s, %s, %s, %s, 4326), %s)"] *
+                     len(features)) +
+           " RETURNING " + qn(Feature._meta.pk.column))
+    params = []
+    for geometry,values in features:
+        params.append(shapefile.id)
+        params.append(geometry.wkb)
+        params.append(geometry.geom_type)
+        params.extend(geometry.extent)
+        params.append(encodeAttributes(attributes, values))
+    cursor.execute(sql, params)
+    featureIds = [row[0] for row in cursor.fetchall()]
+
+    transaction.commit_unless_managed()
+    return featureIds
+
+#############################################################################
+
+@changesShapefileList
+@transaction.commit_on_success
+def applyEdits(shapefile, edits):
+    """ Apply a batch of edits to the given shapefile's features.
+
+        'edits' is an edits.FeatureEdits object describing the features to
+        insert, update and delete.  The whole batch is applied in a single
+        transaction, using one statement for each type of change, followed
+        by a single update to the shapefile's statistics and a single
+        statement adding the changes to the shapefile's change journal.  The
+        batch counts as a single edit, so the shapefile's version number is
+        only bumped once.
+
+        If any of the features to update or delete don't exist, we raise a
+        Feature.DoesNotExist exception, and none of the edits are applied.
+        Otherwise, we return an (insertedIds, extent) tuple, where
+        'insertedIds' is a list of the record IDs of the inserted features,
+        and 'extent' is the (minX, minY, maxX, maxY) extent covering the old
+        and new geometries of every changed feature, or None if no
+        geometries were changed.
+    """
+    if len(edits.inserts) + len(edits.updates) + len(edits.deletes) == 0:
+        return ([], None)
+
+    qn = connection.ops.quote_name
+
+    table       = qn(Feature._meta.db_table)
+    featureId   = qn(Feature._meta.pk.column)
+    shapefileId = qn(_column(Feature, "shapefile"))
+    geometry    = qn(_column(Feature, "geometry"))
+    bbox        = qn(_column(Feature, "bbox"))
+
+    bboxColumns = ("ST_XMin(" + bbox + "), ST_YMin(" + bbox + "), " +
+                   "ST_XMax(" + bbox + "), ST_YMax(" + bbox + ")")
+
+    numFeatures = 0
+    numVertices = 0
+    oldExtents  = [] # Extents of the replaced and deleted geometries.
+    newExtents  = [] # Extents of the inserted and updated geometries.
+    changes     = [] # List of (featureId, change) tuples.
+
+    cursor = connection.cursor()
+
+    # Delete the features.
+
+    if len(edits.deletes) > 0:
+        cursor.execute("DELETE FROM " + table + " WHERE " + shapefileId +
+                       " = %s AND " + featureId + " = ANY(%s::integer[]) " +
+                       "RETURNING " + featureId + ", ST_NPoints(" +
+                       geometry + "), " + bboxColumns,
+                       [shapefile.id, edits.deletes])
+        rows = cursor.fetchall()
+        _checkFeaturesExist(edits.deletes, rows)
+        for row in rows:
+            numFeatures = numFeatures - 1
+            numVertices = numVertices - row[1]
+            oldExtents.append(row[2:6])
+            changes.append((row[0], FeatureChange.DELETE))
+
+    # Update the features.  We join the Feature table against itself so
+    # that we can return the old geometries' vertex counts and extents
+    # along with the new ones.
+
+    if len(edits.updates) > 0:
+        params = [[], [], [], [], [], [], [], []]
+        for recordId,newGeometry,values in edits.updates:
+            params[0].append(recordId)
+            if newGeometry != None:
+                params[1].append(newGeometry.wkb)
+                params[2].append(newGeometry.geom_type)
+                for i,value in enumerate(newGeometry.extent):
+                    params[3+i].append(value)
+            else:
+                params[1].append(None)
+                params[2].append(None)
+                for i in range(4):
+                    params[3+i].append(None)
+            params[7].append(json.dumps(values))
+
+        def newValue(fieldName, expression):
+            column = qn(_column(Feature, fieldName))
+            return (column + " = CASE WHEN v.wkb IS NULL THEN old." +
+                    column + " ELSE " + expression + " END")
+
+        cursor.execute("UPDATE " + table + " f SET " +
+                       newValue("geometry",
+                                "ST_GeomFromWKB(v.wkb, 4326)") + ", " +
+                       newValue("geometry_type", "v.geometry_type") + ", " +
+                       newValue("bbox",
+                                "ST_MakeEnvelope(v.min_x, v.min_y, " +
+                                "v.max_x, v.max_y, 4326)") + ", " +
+                       qn(_column(Feature, "attributes")) + " = " +
+                       "jsonb_strip_nulls(old." +
+                       qn(_column(Feature, "attributes")) +
+                       " || v.patch::jsonb) FROM " + table + " old, " +
+                       "unnest(%s::integer[], %s::bytea[], %s::text[], " +
+                       "%s::float8[], %s::float8[], %s::float8[], " +
+                       "%s::float8[], %s::text[]) AS v(id, wkb, " +
+                       "geometry_type, min_x, min_y, max_x, max_y, patch) " +
+                       "WHERE f." + featureId + " = v.id AND old." +
+                       featureId + " = v.id AND f." + shapefileId +
+                       " = %s AND old." + shapefileId + " = %s " +
+                       "RETURNING f." + featureId + ", v.wkb IS NOT NULL, " +
+                       "ST_NPoints(old." + geometry + "), ST_NPoints(f." +
+                       geometry + "), ST_XMin(old." + bbox + "), " +
+                       "ST_YMin(old." + bbox + "), ST_XMax(old." + bbox +
+                       "), ST_YMax(old." + bbox + ")",
+                       params + [shapefile.id, shapefile.id])
+        rows = cursor.fetchall()
+        _checkFeaturesExist(params[0], rows)
+        for row in rows:
+            if row[1]: # Geometry changed.
+                numVertices = numVertices - row[2] + row[3]
+                oldExtents.append(row[4:8])
+            changes.append((row[0], FeatureChange.UPDATE))
+        for recordId,newGeometry,values in edits.updates:
+            if newGeometry != None:
+                newExtents.append(newGeometry.extent)
+
+    # Insert the new features.
+
+    insertedIds = insertFeatures(shapefile, edits.attributes, edits.inserts)
+    for recordId,(newGeometry,values) in zip(insertedIds, edits.inserts):
+        numFeatures = numFeatures + 1
+        numVertices = numVertices + newGeometry.num_coords
+        newExtents.append(newGeometry.extent)
+        changes.append((recordId, FeatureChange.INSERT))
+
+    # Finally, update the shapefile's statistics, and record the changes in
+    # the shapefile's change journal.
+
+    shapefile.markEdited(numFeatures, numVertices,
+                         _calcUnionExtent(newExtents))
+
+    if len(changes) > 0:
+        featureIds,changeTypes = zip(*changes)
+        cursor.execute("INSERT INTO " + qn(FeatureChange._meta.db_table) +
+                       " (" + qn(_column(FeatureChange, "shapefile")) +
+                       ", " + qn(_column(FeatureChange, "feature_id")) +
+                       ", " + qn(_column(FeatureChange, "version")) +
+                       ", " + qn(_column(FeatureChange, "change")) + ") " +
+                       "SELECT %s, v.id, %s, v.change FROM " +
+                       "unnest(%s::integer[], %s::text[]) AS v(id, change)",
+                       [shapefile.id, shapefile.version, list(featureIds),
+                        list(changeTypes)])
+
+    return (insertedIds, _calcUnionExtent(oldExtents + newExtents))
+
+#############################################################################
+
+@changesShapefileList
+@transaction.commit_on_success
+def saveFeature(shapefile, feature, oldGeometry=None):
+    """ Save a feature which has been added or edited by the user.
+
+        'oldGeometry' is the feature's geometry before it was edited, or
+        None if the feature is new.  The feature is saved, the shapefile is
+        marked as edited and the change is added to the shapefile's change
+        journal in a single transaction, so that the shapefile's new version
+        number can't be seen before its journal entry exists.
+
+        Only the geometry of an existing feature is saved.  The update is
+        restricted to the feature's shapefile as well as its record ID, so
+        that the database only has to look in the shapefile's partition.
+        If the feature no longer exists, we raise Feature.DoesNotExist.
+    """
+    if feature.id == None:
+        change = FeatureChange.INSERT
+        feature.save()
+    else:
+        change = FeatureChange.UPDATE
+        feature.updateGeometryInfo()
+        numUpdated = Feature.objects.filter(id=feature.id,
+                                            shapefile=shapefile).update(
+                                    geometry=feature.geometry,
+                                    geometry_type=feature.geometry_type,
+                                    bbox=feature.bbox)
+        if numUpdated == 0:
+            raise Feature.DoesNotExist("No such feature: %d" % feature.id)
+
+    shapefile.recordChange(feature.id, change, oldGeometry,
+                           feature.geometry)
+
+
+@changesShapefileList
+@transaction.commit_on_success
+def deleteFeature(shapefile, feature):
+    """ Delete one of the given shapefile's features.
+
+        As with saveFeature(), the feature is deleted and the change is
+        recorded in a single transaction, and the feature is looked up by
+        its shapefile as well as its record ID.  If the feature no longer
+        exists, we raise Feature.DoesNotExist.
+    """
+    qn = connection.ops.quote_name
+
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM " + qn(Feature._meta.db_table) +
+                   " WHERE " + qn(Feature._meta.pk.column) + " = %s" +
+                   " AND " + qn(_column(Feature, "shapefile")) + " = %s",
+                   [feature.id, shapefile.id])
+    if cursor.rowcount == 0:
+        raise Feature.DoesNotExist("No such feature: %d" % feature.id)
+
+    shapefile.recordChange(feature.id, FeatureChange.DELETE,
+                           feature.geometry)
+
+#############################################################################
+
+def encodeAttributes(attributes, values):
+    """ Encode a feature's attribute values for storing in the database.
+
+        'attributes' is a list of Attribute objects, and 'values' is a list
+        of the feature's values for those attributes, or None.
+        We return the JSON object to store in the Feature's 'attributes'
+        column.  Attributes which aren't set are left out.
+    """
+    encoded = {}
+    for attr,value in zip(attributes, values):
+        if value != None:
+            encoded[attr.name] = value
+    return json.dumps(encoded)
+
+#############################################################################
+
+def iterFeatures(shapefile, featureFilter=None):
+    """ Iterate over the features in the given shapefile.
+
+        We use a single query, running on a server-side cursor, to retrieve
+        the shapefile's features along with their attribute values.  The
+        features are fetched FETCH_BATCH_SIZE at a time, so that only one
+        batch is held in memory no matter how large the shapefile is.
+
+        If 'featureFilter' is not None, it should be a FeatureFilter object
+        selecting the features to include.  The filter is applied by the
+        database, so only the selected features are retrieved.
+
+        For each feature, in order of record ID, we yield a (featureId, wkb,
+        values) tuple, where 'featureId' is the feature's record ID, 'wkb' is
+        the feature's geometry in WKB format, and 'values' is a dictionary
+        mapping attribute names to the feature's attribute values.  Note that
+        attributes which aren't set are left out of this dictionary.
+    """
+    qn = connection.ops.quote_name
+
+    whereClause,params = _calcFilterClause(shapefile, featureFilter)
+
+    sql = ("SELECT " + _calcFeatureColumns() +
+           " FROM " + qn(Feature._meta.db_table) + " f WHERE " +
+           whereClause + " ORDER BY f." + qn(Feature._meta.pk.column))
+
+    for featureId,wkb,values in _iterRows(sql, params):
+        yield (featureId, wkb, _decodeAttributes(values))
+
+
+def iterAttributes(shapefile):
+    """ Iterate over the attribute values of the given shapefile's features.
+
+        This is the same as iterFeatures(), except that the features'
+        geometries aren't retrieved: for each feature, in order of record
+        ID, we yield a (featureId, values) tuple.  This only touches the
+        Feature table's record ID, shapefile and attribute columns, so it
+        can be used before the table's geometry columns have been upgraded
+        (see the "migrategeometry" management command).
+    """
+    qn = connection.ops.quote_name
+
+    sql = ("SELECT f." + qn(Feature._meta.pk.column) + ", f." +
+           qn(_column(Feature, "attributes")) + " FROM " +
+           qn(Feature._meta.db_table) + " f WHERE f." +
+           qn(_column(Feature, "shapefile")) + " = %s ORDER BY f." +
+           qn(Feature._meta.pk.column))
+
+    for featureId,values in _iterRows(sql, [shapefile.id]):
+        yield (featureId, _decodeAttributes(values))
+
+#############################################################################
+
+def queryFeatures(shapefile, featureFilter=None, sortAttr=None,
+                  descending=False, limit=100, after=None):
+    """ Return one page of the features in the given shapefile.
+
+        The parameters are as follows:
+
+            'shapefile'
+
+                The Shapefile object to query.
+
+            'featureFilter'
+
+                A FeatureFilter object selecting the features to return, or
+                None to return all of the shapefile's features.
+
+            'sortAttr'
+
+                The Attribute object to sort the features by, or None to
+                sort the features by record ID.  The attribute's type must
+                be one of SCALAR_TYPES.  Features which don't have a value
+                for the attribute come last when sorting in ascending order,
+                and first when sorting in descending order.
+
+            'descending'
+
+                True if the features should be sorted in descending order.
+
+            'limit'
+
+                The maximum number of features to return.
+
+            'after'
+
+                A key returned by an earlier call to queryFeatures(), or
+                None to return the first page of features.
+
+        Everything is done by the database: we select the features using
+        keyset pagination, so that a page deep into the results costs no
+        more to retrieve than the first page, and if the sort attribute has
+        been indexed (see createAttributeIndex()), the features are read in
+        order straight from the index.
+
+        We return a (features, nextKey) tuple, where 'features' is a list of
+        (featureId, wkb, values) tuples as for iterFeatures(), and 'nextKey'
+        is the key to pass as 'after' to retrieve the next page of features,
+        or None if there are no more features.  The key is a (sortValue,
+        featureId) tuple, and can be converted to and from JSON.
+    """
+    qn = connection.ops.quote_name
+
+    idColumn = "f." + qn(Feature._meta.pk.column)
+
+    whereClause,params = _calcFilterClause(shapefile, featureFilter)
+
+    if sortAttr == None:
+        sortValue,sortParams = ("NULL", [])
+    else:
+        sortValue,sortParams = _calcAttributeExpression(sortAttr)
+
+    if after != None:
+        lastValue,lastId = after
+        if sortAttr == None:
+            if descending:
+                whereClause = whereClause + " AND " + idColumn + " < %s"
+            else:
+                whereClause = whereClause + " AND " + idColumn + " > %s"
+            params.append(lastId)
+        elif lastValue == None:
+            if descending:
+                whereClause = (whereClause + " AND ((" + sortValue +
+                               " IS NULL AND " + idColumn + " < %s) OR " +
+                               sortValue + " IS NOT NULL)")
+                params.extend(sortParams + [lastId] + sortParams)
+            else:
+                whereClause = (whereClause + " AND " + sortValue +
+                               " IS NULL AND " + idColumn + " > %s")
+                params.extend(sortParams + [lastId])
+        else:
+            if descending:
+                whereClause = (whereClause + " AND (" + sortValue + ", " +
+                               idColumn + ") < (%s, %s)")
+                params.extend(sortParams + [lastValue, lastId])
+            else:
+                whereClause = (whereClause + " AND ((" + sortValue + ", " +
+                               idColumn + ") > (%s, %s) OR " + sortValue +
+                               " IS NULL)")
+                params.extend(sortParams + [lastValue, lastId] + sortParams)
+
+    if descending:
+        direction = " DESC"
+    else:
+        direction = ""
+
+    if sortAttr == None:
+        orderBy = idColumn + direction
+    else:
+        orderBy = sortValue + direction + ", " + idColumn + direction
+
+    sql = ("SELECT " + _calcFeatureColumns() + ", " + sortValue +
+           " FROM " + qn(Feature._meta.db_table) + " f WHERE " +
+           whereClause + " ORDER BY " + orderBy + " LIMIT %s")
+    params = sortParams + params + sortParams + [limit + 1]
+
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    rows = cursor.fetchall()
+
+    features = []
+    for featureId,wkb,values,lastValue in rows[:limit]:
+        features.append((featureId, wkb, _decodeAttributes(values)))
+
+    if len(rows) > limit:
+        featureId,wkb,values,lastValue = rows[limit-1]
+        nextKey = (lastValue, featureId)
+    else:
+        nextKey = None
+
+    return (features, nextKey)
+
+#############################################################################
+
+def findNearestFeature(shapefile, longitude, latitude, radius):
+    """ Find the feature closest to the given point.
+
+        'shapefile' is the Shapefile object to search, 'longitude' and
+        'latitude' are the coordinates of the point, and 'radius' is the
+        maximum distance, in degrees, a feature can be from the point and
+        still be found.
+
+        We use a single query, which finds the features within the radius
+        and orders them by their distance from the point, so that the
+        database can use the spatial index on the shapefile's features to
+        both filter and order the features.  We return the record ID of the
+        closest feature, or None if no feature is within the radius.
+    """
+    qn = connection.ops.quote_name
+
+    geometry = qn(_column(Feature, "geometry"))
+    point    = "ST_SetSRID(ST_MakePoint(%s, %s), 4326)"
+
+    cursor = connection.cursor()
+    cursor.execute("SELECT " + qn(Feature._meta.pk.column) + " FROM " +
+                   qn(Feature._meta.db_table) + " WHERE " +
+                   qn(_column(Feature, "shapefile")) + " = %s AND " +
+                   "ST_DWithin(" + geometry + ", " + point + ", %s) " +
+                   "ORDER BY " + geometry + " <-> " + point + " LIMIT 1",
+                   [shapefile.id, longitude, latitude, radius,
+                    longitude, latitude])
+    row = cursor.fetchone()
+    if row == None:
+        return None
+    return row[0]
+
+
+def findNearestFeatures(shapefile, points):
+    """ Find the feature closest to each of a number of points.
+
+        'shapefile' is the Shapefile object to search, and 'points' is a
+        list of (longitude, latitude, radius) tuples, where 'radius' is the
+        maximum distance, in degrees, a feature can be from that point and
+        still be found.
+
+        All the points are resolved using a single query, which joins the
+        points against the shapefile's features, using the same
+        index-assisted nearest-feature search as findNearestFeature() for
+        each point.  We return a list with one entry for each point, holding
+        the record ID of the closest feature, or None if no feature is
+        within that point's radius.
+    """
+    if len(points) == 0:
+        return []
+
+    qn = connection.ops.quote_name
+
+    featureId = qn(Feature._meta.pk.column)
+    geometry  = "f." + qn(_column(Feature, "geometry"))
+    point     = "ST_SetSRID(ST_MakePoint(p.x, p.y), 4326)"
+
+    longitudes,latitudes,radii = zip(*points)
+
+    cursor = connection.cursor()
+    cursor.execute("SELECT h." + featureId + " FROM " +
+                   "unnest(%s::float8[], %s::float8[], %s::float8[]) " +
+                   "WITH ORDINALITY AS p(x, y, radius, n) " +
+                   "LEFT JOIN LATERAL (SELECT f." + featureId + " FROM " +
+                   qn(Feature._meta.db_table) + " f WHERE f." +
+                   qn(_column(Feature, "shapefile")) + " = %s AND " +
+                   "ST_DWithin(" + geometry + ", " + point + ", p.radius) " +
+                   "ORDER BY " + geometry + " <-> " + point + " LIMIT 1) h " +
+                   "ON true ORDER BY p.n",
+                   [list(longitudes), list(latitudes), list(radii),
+                    shapefile.id])
+    return [row[0] for row in cursor.fetchall()]
+
+
+def updateAttributes(shapefile, updates):
+    """ Replace the attribute values of a number of features.
+
+        'shapefile' is the Shapefile object the features belong to, and
+        'updates' is a list of (featureId, values) tuples, where 'featureId'
+        is the record ID of a feature to update, and 'values' is a
+        dictionary mapping attribute names to the feature's new attribute
+        values.  The features are all updated using a single statement.
+    """
+    if len(updates) == 0:
+        return
+
+    qn = connection.ops.quote_name
+
+    params = []
+    for featureId,values in updates:
+        params.append(featureId)
+        params.append(json.dumps(values))
+
+    cursor = connection.cursor()
+    cursor.execute("UPDATE " + qn(Feature._meta.db_table) + " f SET " +
+                   qn(_column(Feature, "attributes")) +
+                   " = CAST(v.attributes AS jsonb) FROM (VALUES " +
+                   ", ".join(["(%s, %s)"] * len(updates)) +
+                   ") AS v (id, attributes) WHERE f." +
+                   qn(Feature._meta.pk.column) + " = v.id AND f." +
+                   qn(_column(Feature, "shapefile")) + " = %s",
+                   params + [shapefile.id])
+    transaction.commit_unless_managed()
+
+#############################################################################
+
+def createAttributeIndex(attr):
+    """ Create a database index for the given attribute.
+
+        'attr' is the Attribute object to index.  Its type must be one of
+        SCALAR_TYPES.  We create a B-tree index on the attribute's typed
+        value (and the feature's record ID), covering just the features in
+        the attribute's shapefile.  This lets the database use the index to
+        filter and sort the shapefile's features by that attribute.
+
+        If the Feature table is partitioned, the index is created on the
+        shapefile's partition.  Otherwise, we create a partial index on the
+        Feature table.  Building an index in the usual way stops the table
+        from being written to until the index is finished, which would hold
+        up edits to every other shapefile, so the partial index is built
+        concurrently.  This can't be done within a transaction, so unless
+        the Feature table is partitioned, this shouldn't be called while a
+        transaction is being managed.
+    """
+    qn = connection.ops.quote_name
+
+    expression,params = _calcAttributeExpression(attr, alias=None)
+
+    if isPartitioned():
+        cursor = connection.cursor()
+        cursor.execute("CREATE INDEX " + _calcIndexName(attr) + " ON " +
+                       qn(_calcPartitionName(attr.shapefile_id)) + " (" +
+                       expression + ", " + qn(Feature._meta.pk.column) +
+                       ")", params)
+    else:
+        definition = _calcIndexName(attr) + " ON " + \
+                     qn(Feature._meta.db_table) + " (" + expression + \
+                     ", " + qn(Feature._meta.pk.column) + ") WHERE " + \
+                     qn(_column(Feature, "shapefile")) + " = %s"
+        params = params + [attr.shapefile_id]
+        if transaction.is_managed():
+            cursor = connection.cursor()
+            cursor.execute("CREATE INDEX " + definition, params)
+        else:
+            try:
+                _executeWithoutTransaction("CREATE INDEX CONCURRENTLY " +
+                                           definition, params)
+            except:
+                # A failed concurrent build leaves an invalid index behind.
+                _executeWithoutTransaction("DROP INDEX IF EXISTS " +
+                                           _calcIndexName(attr), [])
+                raise
+
+    attr.indexed = True
+    attr.save()
+    transaction.commit_unless_managed()
+
+
+def dropAttributeIndex(attr):
+    """ Remove the database index created for the given attribute.
+    """
+    cursor = connection.cursor()
+    cursor.execute("DROP INDEX IF EXISTS " + _calcIndexName(attr))
+    attr.indexed = False
+    attr.save()
+    transaction.commit_unless_managed()
+
+
+#############################################################################
+
+def isPartitioned():
+    """ Return True if the Feature table is partitioned by shapefile.
+    """
+    global _partitioned
+
+    if _partitioned == None:
+        cursor = connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM pg_partitioned_table " +
+                       "WHERE partrelid = to_regclass(%s)",
+                       [connection.ops.quote_name(Feature._meta.db_table)])
+        _partitioned = (cursor.fetchone()[0] > 0)
+    return _partitioned
+
+
+def createPartition(shapefile):
+    """ Create the partition which will hold the given shapefile's features.
+
+        This must be called whenever a new shapefile is created, before any
+        features are added to it.  If the Feature table isn't partitioned,
+        we do nothing.
+    """
+    if not isPartitioned():
+        return
+
+    qn = connection.ops.quote_name
+
+    cursor = connection.cursor()
+    cursor.execute("CREATE TABLE IF NOT EXISTS " +
+                   qn(_calcPartitionName(shapefile.id)) + " PARTITION OF " +
+                   qn(Feature._meta.db_table) + " FOR VALUES IN (%s)",
+                   [shapefile.id])
+    transaction.commit_unless_managed()
+
+
+@transaction.commit_on_success
+def partitionFeatures():
+    """ Convert the Feature table into a table partitioned by shapefile.
+
+        We rename the existing Feature table, create a new partitioned
+        Feature table in its place, and then copy each shapefile's features
+        into a partition of its own.  Finally, we drop the old table and
+        recreate the indexes.  Note that the database's primary key for the
+        partitioned table has to include the shapefile ID; the record IDs
+        are still allocated from the same sequence, and so remain unique.
+
+        The whole conversion is done in a single transaction, so if any
+        part of it fails, the Feature table is left as it was.  If the
+        Feature table is already partitioned, we do nothing.  We return True
+        iff the table was converted.
+    """
+    global _partitioned
+
+    if isPartitioned():
+        return False
+
+    try:
+        _partitionFeatures()
+    except:
+        _partitioned = None # The conversion has been rolled back.
+        raise
+    return True
+
+
+@changesShapefileList
+@transaction.commit_on_success
+def deleteShapefile(shapefile):
+    """ Delete the given shapefile, along with its features.
+
+        Rather than letting Django load each of the shapefile's features
+        into memory so it can delete them one at a time, we delete the
+        shapefile and everything belonging to it using a handful of
+        set-based statements, within a single transaction.
+
+        If the Feature table is partitioned, the shapefile's features are
+        removed by dropping its partition, along with the partition's
+        indexes.  Otherwise, we delete the features and drop the shapefile's
+        attribute indexes, as the database won't remove them by itself.
+    """
+    qn = connection.ops.quote_name
+
+    cursor = connection.cursor()
+
+    if isPartitioned():
+        cursor.execute("DROP TABLE IF EXISTS " +
+                       qn(_calcPartitionName(shapefile.id)))
+    else:
+        for attr in shapefile.attribute_set.filter(indexed=True):
+            cursor.execute("DROP INDEX IF EXISTS " + _calcIndexName(attr))
+        cursor.execute("DELETE FROM " + qn(Feature._meta.db_table) +
+                       " WHERE " + qn(_column(Feature, "shapefile")) +
+                       " = %s", [shapefile.id])
+
+    for model in [FeatureChange, Attribute]:
+        cursor.execute("DELETE FROM " + qn(model._meta.db_table) +
+                       " WHERE " + qn(_column(model, "shapefile")) +
+                       " = %s", [shapefile.id])
+
+    cursor.execute("DELETE FROM " + qn(Shapefile._meta.db_table) +
+                   " WHERE " + qn(Shapefile._meta.pk.column) + " = %s",
+                   [shapefile.id])
+
+#############################################################################
+
+def updateStatistics(shapefile):
+    """ Calculate the summary statistics for the given shapefile.
+
+        We calculate the shapefile's extent, feature count and vertex count
+        from its features, using a single query, and save them into the
+        Shapefile object.  This is done when a shapefile is imported; after
+        that, the statistics are updated as the features are edited.  Only
+        the statistics are written back, so that any other changes made to
+        the shapefile in the meantime aren't overwritten.
+    """
+    qn = connection.ops.quote_name
+
+    geometry = qn(_column(Feature, "geometry"))
+    bbox     = qn(_column(Feature, "bbox"))
+
+    cursor = connection.cursor()
+    cursor.execute("SELECT COUNT(*), SUM(ST_NPoints(" + geometry + ")), " +
+                   "MIN(ST_XMin(" + bbox + ")), MIN(ST_YMin(" + bbox + ")), " +
+                   "MAX(ST_XMax(" + bbox + ")), MAX(ST_YMax(" + bbox + ")) " +
+                   "FROM " + qn(Feature._meta.db_table) + " WHERE " +
+                   qn(_column(Feature, "shapefile")) + " = %s",
+                   [shapefile.id])
+    (shapefile.num_features, numVertices, shapefile.min_x, shapefile.min_y,
+     shapefile.max_x, shapefile.max_y) = cursor.fetchone()
+    shapefile.num_vertices = numVertices or 0
+    Shapefile.objects.filter(id=shapefile.id).update(
+                                    min_x=shapefile.min_x,
+                                    min_y=shapefile.min_y,
+                                    max_x=shapefile.max_x,
+                                    max_y=shapefile.max_y,
+                                    num_features=shapefile.num_features,
+                                    num_vertices=shapefile.num_vertices)
+    shapefileListChanged()
+
+@changesShapefileList
+@transaction.commit_on_success
+def clusterFeatures(shapefile):
+    """ Rewrite the given shapefile's features in Hilbert order.
+
+        Newly imported features are stored in order of the Hilbert value of
+        the centre of their bounding box, so that features which are close
+        together in space are stored close together on disk.  This function
+        does the same for a shapefile which has already been imported: we
+        calculate the Hilbert value for each of the shapefile's features,
+        copy the features into a temporary table in that order, and then
+        replace the shapefile's features with the sorted copy.  The features
+        keep their record IDs.
+
+        This is done in a single transaction.  We return the number of
+        features which were rewritten.
+    """
+    qn = connection.ops.quote_name
+
+    if shapefile.getExtent() == None:
+        updateStatistics(shapefile)
+    extent = shapefile.getExtent()
+    if extent == None:
+        return 0 # No features.
+
+    table       = qn(Feature._meta.db_table)
+    featureId   = qn(Feature._meta.pk.column)
+    shapefileId = qn(_column(Feature, "shapefile"))
+    bbox        = qn(_column(Feature, "bbox"))
+
+    if isPartitioned():
+        target = qn(_calcPartitionName(shapefile.id))
+    else:
+        target = table
+
+    # Calculate the order to store the features in.
+
+    rows = _iterRows("SELECT " + featureId + ", ST_XMin(" + bbox + "), " +
+                     "ST_YMin(" + bbox + "), ST_XMax(" + bbox + "), " +
+                     "ST_YMax(" + bbox + ") FROM " + table + " WHERE " +
+                     shapefileId + " = %s", [shapefile.id])
+
+    featureIds    = array.array("l")
+    hilbertValues = array.array("L")
+    for recordId,minX,minY,maxX,maxY in rows:
+        featureIds.append(recordId)
+        hilbertValues.append(utils.calcHilbertValue((minX + maxX) / 2,
+                                                    (minY + maxY) / 2,
+                                                    extent))
+
+    order = sorted(xrange(len(featureIds)), key=hilbertValues.__getitem__)
+    sortedIds = [featureIds[i] for i in order]
+
+    # Copy the features into a temporary table, along with their position in
+    # the sorted order, and then write them back again in that order.
+
+    columns = ", ".join([qn(field.column) for field in Feature._meta.fields])
+
+    cursor = connection.cursor()
+    cursor.execute("CREATE TEMPORARY TABLE shapeeditor_cluster " +
+                   "ON COMMIT DROP AS SELECT o.position, f.* FROM " +
+                   table + " f JOIN unnest(%s::integer[]) WITH " +
+                   "ORDINALITY AS o(id, position) ON f." + featureId +
+                   " = o.id " +
+                   "WHERE f." + shapefileId + " = %s",
+                   [sortedIds, shapefile.id])
+
+    if isPartitioned():
+        cursor.execute("TRUNCATE " + target)
+    else:
+        cursor.execute("DELETE FROM " + target + " WHERE " + shapefileId +
+                       " = %s", [shapefile.id])
+
+    cursor.execute("INSERT INTO " + target + " (" + columns + ") " +
+                   "SELECT " + columns + " FROM shapeeditor_cluster " +
+                   "ORDER BY position")
+
+    return len(sortedIds)
+
+#############################################################################
+
+def iterChanges(shapefile, sinceVersion):
+    """ Iterate over the features which have changed since a given version.
+
+        'shapefile' is the Shapefile object to check, and 'sinceVersion' is
+        the version number of the shapefile the caller already has.  We use
+        the shapefile's change journal to find the features which have been
+        inserted, updated or deleted since that version, and retrieve the
+        current state of those features using a single query.
+
+        For each changed feature, in order of record ID, we yield a
+        (featureId, change, wkb, values) tuple, where 'change' is one of
+        FeatureChange.INSERT, FeatureChange.UPDATE or FeatureChange.DELETE.
+        'wkb' and 'values' are as for iterFeatures(); for deleted features,
+        'wkb' and 'values' will both be None.
+
+        Features which were both inserted and deleted since the given
+        version are skipped.
+    """
+    qn = connection.ops.quote_name
+
+    changeTable   = qn(FeatureChange._meta.db_table)
+    changeFeature = qn(_column(FeatureChange, "feature_id"))
+    changeType    = qn(_column(FeatureChange, "change"))
+
+    sql = ("SELECT c." + changeFeature + ", c.inserted, " +
+           _calcFeatureColumns() + " FROM " +
+           "(SELECT " + changeFeature + ", " +
+           "bool_or(" + changeType + " = %s) AS inserted FROM " +
+           changeTable + " WHERE " +
+           qn(_column(FeatureChange, "shapefile")) + " = %s AND " +
+           qn(_column(FeatureChange, "version")) + " > %s " +
+           "GROUP BY " + changeFeature + ") c " +
+           "LEFT JOIN " + qn(Feature._meta.db_table) + " f ON f." +
+           qn(Feature._meta.pk.column) + " = c." + changeFeature +
+           " AND f." + qn(_column(Feature, "shapefile")) + " = %s" +
+           " ORDER BY c." + changeFeature)
+    params = [FeatureChange.INSERT, shapefile.id, sinceVersion, shapefile.id]
+
+    for row in _iterRows(sql, params):
+        featureId,inserted,ignore,wkb,values = row
+        if wkb == None:
+            if inserted:
+                continue # Feature was added and removed again.
+            yield (featureId, FeatureChange.DELETE, None, None)
+        else:
+            if inserted:
+                change = FeatureChange.INSERT
+            else:
+                change = FeatureChange.UPDATE
+            yield (featureId, change, wkb, _decodeAttributes(values))
+
+#############################################################################
+
+def recordImport(shapefile):
+    """ Record the import of the given shapefile in its change journal.
+
+        We add an "insert" entry for each of the shapefile's features, using
+        the shapefile's current version number, with a single statement.
+    """
+    qn = connection.ops.quote_name
+
+    cursor = connection.cursor()
+    cursor.execute("INSERT INTO " + qn(FeatureChange._meta.db_table) +
+                   " (" + qn(_column(FeatureChange, "shapefile")) + ", " +
+                   qn(_column(FeatureChange, "feature_id")) + ", " +
+                   qn(_column(FeatureChange, "version")) + ", " +
+                   qn(_column(FeatureChange, "change")) + ") " +
+                   "SELECT %s, " + qn(Feature._meta.pk.column) +
+                   ", %s, %s FROM " + qn(Feature._meta.db_table) +
+                   " WHERE " + qn(_column(Feature, "shapefile")) + " = %s",
+                   [shapefile.id, shapefile.version, FeatureChange.INSERT,
+                    shapefile.id])
+    transaction.commit_unless_managed()
+
+#############################################################################
+
+@changesShapefileList
+def cloneShapefile(shapefile):
+    """ Make a copy of the given shapefile within the database.
+
+        We create a new Shapefile object with the same attributes and
+        features as the given shapefile, copying the features using a single
+        set-based statement rather than loading them into memory.  The copy
+        is made in a single transaction; any attribute indexes are then
+        created once that transaction has been committed, so that they can
+        be built concurrently (see createAttributeIndex()).  Upon
+        completion, we return the new Shapefile object.
+    """
+    clone,indexed = _copyShapefile(shapefile)
+    for attr in indexed:
+        createAttributeIndex(attr)
+    return clone
+
+#############################################################################
+#
+# Private definitions:
+
+@transaction.commit_on_success
+def _copyShapefile(shapefile):
+    """ Copy a shapefile's attributes and features, for cloneShapefile().
+
+        We return a (clone, indexed) tuple, where 'clone' is the new
+        Shapefile object and 'indexed' is a list of the clone's attributes
+        which should be indexed.
+    """
+    qn = connection.ops.quote_name
+
+    clone = Shapefile(filename=shapefile.filename,
+                      srs_wkt=shapefile.srs_wkt,
+                      geom_type=shapefile.geom_type,
+                      encoding=shapefile.encoding,
+                      fingerprint=shapefile.fingerprint,
+                      min_x=shapefile.min_x,
+                      min_y=shapefile.min_y,
+                      max_x=shapefile.max_x,
+                      max_y=shapefile.max_y,
+                      num_features=shapefile.num_features,
+                      num_vertices=shapefile.num_vertices)
+    clone.save()
+    createPartition(clone)
+
+    indexed = []
+    for attr in shapefile.attribute_set.all().order_by("id"):
+        if attr.indexed:
+            indexed.append(attr)
+        attr.id = None
+        attr.shapefile = clone
+        attr.indexed = False
+        attr.save()
+
+    # Copy the features.  Because each feature's attribute values are
+    # stored along with the feature itself, this copies the attribute values
+    # too.  The features are copied in the order they are stored on disk, so
+    # that the copy keeps the original's spatial clustering.
+
+    columns = []
+    for field in Feature._meta.fields:
+        if field.name not in [Feature._meta.pk.name, "shapefile"]:
+            columns.append(qn(field.column))
+
+    cursor = connection.cursor()
+    cursor.execute("INSERT INTO " + qn(Feature._meta.db_table) + " (" +
+                   qn(_column(Feature, "shapefile")) +
+                   "".join([", " + column for column in columns]) + ") " +
+                   "SELECT %s" + "".join([", " + column
+                                          for column in columns]) +
+                   " FROM " + qn(Feature._meta.db_table) + " WHERE " +
+                   qn(_column(Feature, "shapefile")) + " = %s" +
+                   " ORDER BY ctid", [clone.id, shapefile.id])
+
+    recordImport(clone)
+
+    return (clone, indexed)
+
+# A source of unique IDs for naming our server-side cursors.
+
+_cursorIds = itertools.count()
+
+# Whether or not the Feature table is partitioned.  This is set the first
+# time isPartitioned() is called.
+
+_partitioned = None
+
+
+def _column(model, fieldName):
+    """ Return the name of the database column used by the given field.
+    """
+    return model._meta.get_field(fieldName).column
+
+
+def _executeWithoutTransaction(sql, params):
+    """ Execute an SQL statement which can't be run within a transaction.
+
+        Any changes made so far are committed first.  The statement is then
+        run with the database connection in autocommit mode.
+    """
+    transaction.commit_unless_managed()
+    cursor = connection.cursor()
+    db = connection.connection
+    isolationLevel = db.isolation_level
+    db.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    try:
+        cursor.execute(sql, params)
+    finally:
+        db.set_isolation_level(isolationLevel)
+
+
+def _calcFeatureColumns():
+    """ Return the SQL expressions used to retrieve a shapefile's features.
+
+        The Feature table is assumed to be aliased as "f".  The returned
+        expressions select the feature's record ID, its geometry in WKB
+        format, and its attribute values.
+    """
+    qn = connection.ops.quote_name
+
+    return ("f." + qn(Feature._meta.pk.column) + ", " +
+            "ST_AsBinary(f." + qn(_column(Feature, "geometry")) + "), " +
+            "f." + qn(_column(Feature, "attributes")))
+
+
+def _checkFeaturesExist(featureIds, rows):
+    """ Make sure that every one of the given features was found.
+
+        'featureIds' is a list of the record IDs of the features to be
+        updated or deleted, and 'rows' is the list of rows returned by the
+        UPDATE or DELETE statement, with the record ID in the first column.
+        If any of the features weren't found, we raise a Feature.DoesNotExist
+        exception.
+    """
+    missing = set(featureIds) - set([row[0] for row in rows])
+    if len(missing) > 0:
+        raise Feature.DoesNotExist("No such feature: %d" % min(missing))
+
+
+def _calcUnionExtent(extents):
+    """ Return the extent covering all of the given extents.
+
+        'extents' is a list of (minX, minY, maxX, maxY) tuples.  We return
+        a tuple covering all of them, or None if the list is empty.
+    """
+    if len(extents) == 0:
+        return None
+    return (min([extent[0] for extent in extents]),
+            min([extent[1] for extent in extents]),
+            max([extent[2] for extent in extents]),
+            max([extent[3] for extent in extents]))
+
+
+def _iterRows(sql, params):
+    """ Iterate over the rows returned by the given query.
+
+        The query is run on a server-side cursor, and the rows are fetched
+        FETCH_BATCH_SIZE at a time.
+    """
+    connection.cursor() # Make sure we're connected to the database.
+    cursor = connection.connection.cursor(name="shapeeditor_features_%d" %
+                                          _cursorIds.next())
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+            if len(rows) == 0:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cursor.close()
+
+
+def _partitionFeatures():
+    """ Convert the Feature table, for partitionFeatures().
+
+        This must be called within a managed transaction.
+    """
+    global _partitioned
+
+    qn = connection.ops.quote_name
+
+    table       = Feature._meta.db_table
+    oldTable    = table + "_unpartitioned"
+    featureId   = qn(Feature._meta.pk.column)
+    shapefileId = qn(_column(Feature, "shapefile"))
+
+    cursor = connection.cursor()
+    cursor.execute("ALTER TABLE " + qn(table) + " RENAME TO " +
+                   qn(oldTable))
+    cursor.execute("CREATE TABLE " + qn(table) + " (LIKE " + qn(oldTable) +
+                   " INCLUDING DEFAULTS) PARTITION BY LIST (" +
+                   shapefileId + ")")
+    cursor.execute("ALTER TABLE " + qn(table) + " ADD PRIMARY KEY (" +
+                   featureId + ", " + shapefileId + "), ADD FOREIGN KEY (" +
+                   shapefileId + ") REFERENCES " +
+                   qn(Shapefile._meta.db_table) + " (" +
+                   qn(Shapefile._meta.pk.column) + ") " +
+                   "DEFERRABLE INITIALLY DEFERRED")
+
+    _partitioned = True
+
+    for shapefile in Shapefile.objects.all().order_by("id"):
+        createPartition(shapefile)
+        cursor.execute("INSERT INTO " + qn(table) + " SELECT * FROM " +
+                       qn(oldTable) + " WHERE " + shapefileId + " = %s",
+                       [shapefile.id])
+
+    # Hand the record ID sequence over to the new table, so that it isn't
+    # dropped along with the old one.
+
+    cursor.execute("SELECT pg_get_serial_sequence(%s, %s)",
+                   [qn(oldTable), Feature._meta.pk.column])
+    sequence = cursor.fetchone()[0]
+    cursor.execute("ALTER SEQUENCE " + sequence + " OWNED BY " +
+                   qn(table) + "." + featureId)
+    cursor.execute("DROP TABLE " + qn(oldTable))
+
+    # Recreate the spatial indexes.  Indexes created on the partitioned
+    # table are automatically created on each of its partitions.
+
+    for fieldName in ["geometry", "bbox"]:
+        column = _column(Feature, fieldName)
+        cursor.execute("CREATE INDEX " + qn(table + "_" + column + "_id") +
+                       " ON " + qn(table) + " USING GIST (" + qn(column) +
+                       ")")
+
+    for attr in Attribute.objects.filter(indexed=True):
+        createAttributeIndex(attr)
+
+
+def _calcFilterClause(shapefile, featureFilter):
+    """ Return the SQL WHERE clause selecting a shapefile's features.
+
+        'shapefile' is the Shapefile object whose features are being
+        selected, and 'featureFilter' is a FeatureFilter object, or None if
+        all the shapefile's features should be selected.  The Feature table
+        is assumed to be aliased as "f".
+
+        We return a (sql, params) tuple with the text of the WHERE clause and
+        the parameters it uses.
+    """
+    qn = connection.ops.quote_name
+
+    clauses = ["f." + qn(_column(Feature, "shapefile")) + " = %s"]
+    params  = [shapefile.id]
+
+    if featureFilter == None:
+        return (clauses[0], params)
+
+    if featureFilter.area != None:
+        # ST_Intersects() includes a bounding box comparison, which lets
+        # the database use the geometry column's spatial index.
+        clauses.append("ST_Intersects(f." + qn(_column(Feature, "geometry")) +
+                       ", ST_GeomFromWKB(%s, 4326))")
+        params.append(featureFilter.area.wkb)
+
+    for attr,operator,operand in featureFilter.predicates:
+        value,valueParams = _calcAttributeExpression(attr)
+        clauses.append(value + " " + operator + " %s")
+        params.extend(valueParams + [operand])
+
+    return (" AND ".join(clauses), params)
+
+
+def _calcAttributeExpression(attr, alias="f"):
+    """ Return the SQL expression used to retrieve an attribute's value.
+
+        'attr' is the Attribute object whose value is being retrieved, and
+        'alias' is the alias used for the Feature table, or None if the
+        column shouldn't be qualified.  The expression converts the value
+        to the SQL type matching the attribute's type, so that values are
+        compared and sorted correctly.  Dates and times are stored as ISO
+        8601 strings, and so are compared as text.
+
+        The same expression is used when creating an attribute's index, so
+        that the database can use the index whenever the attribute is used
+        in a query.
+
+        We return a (sql, params) tuple with the text of the expression and
+        the parameters it uses.
+    """
+    qn = connection.ops.quote_name
+
+    column = qn(_column(Feature, "attributes"))
+    if alias != None:
+        column = alias + "." + column
+
+    value = "(" + column + " ->> %s)"
+    if attr.type == ogr.OFTInteger:
+        value = "CAST(" + value + " AS bigint)"
+    elif attr.type == ogr.OFTReal:
+        value = "CAST(" + value + " AS double precision)"
+    return (value, [attr.name])
+
+
+def _calcIndexName(attr):
+    """ Return the (quoted) name of the given attribute's database index.
+    """
+    return connection.ops.quote_name("shapeeditor_attr_%d" % attr.id)
+
+
+def _calcPartitionName(shapefileId):
+    """ Return the name of the partition holding a shapefile's features.
+    """
+    return "%s_%d" % (Feature._meta.db_table, shapefileId)
+
+
+def _decodeAttributes(value):
+    """ Convert attribute values fetched using a raw database cursor.
+
+        Depending on the version of psycopg2 being used, the feature's
+        attribute values will be either a dictionary or a JSON string.  We
+        return a dictionary in both cases.
+    """
+    if isinstance(value, basestring):
+        return json.loads(value)
+    return value
+
@@ -0,0 +1,179 @@
+# filters.py
+#
+# This module defines the filters which can be used to select a subset of a
+# shapefile's features, for example when exporting part of a shapefile.
+#
+# A filter can restrict the selected features to those which intersect a
+# bounding box or polygon, and to those whose attribute values match a number
+# of simple predicates.  The filter itself simply records what was asked
+# for; the featureStore module turns it into SQL so that the filtering is
+# done by the database, using the spatial index on the geometry columns.
+
+from django.contrib.gis.geos import GEOSGeometry, GEOSException, Polygon
+from osgeo import ogr
+
+import re
+
+import attributeCodecs
+import featureStore
+
+#############################################################################
+
+class FilterError(Exception):
+    """ Exception raised when a filter can't be parsed.
+
+        The exception's message describes the problem.
+    """
+    pass
+
+#############################################################################
+
+class FeatureFilter(object):
+    """ A filter selecting a subset of a shapefile's features.
+
+        The filter exposes the following public attributes:
+
+            'area'
+
+                A GEOSGeometry object, in WGS84 coordinates, covering the
+                area the selected features must intersect, or None if the
+                features aren't filtered by location.
+
+            'predicates'
+
+                A list of (attribute, operator, value) tuples, one for each
+                attribute predicate the selected features must match.
+                'attribute' is the Attribute object to test, 'operator' is
+                the SQL comparison operator to use, and 'value' is the value
+                to compare against, converted to an int, float or Unicode
+                string as appropriate for the attribute's type.  Date and
+                time values are converted to ISO 8601 strings.
+    """
+    def __init__(self, area=None, predicates=None):
+        """ Initialise our FeatureFilter.
+        """
+        self.area = area
+        if predicates == None:
+            self.predicates = []
+        else:
+            self.predicates = predicates
+
+#############################################################################
+
+def parseFilter(shapefile, params):
+    """ Parse a filter from the given request parameters.
+
+        'shapefile' is the Shapefile object the filter applies to, and
+        'params' is a QueryDict holding the request's parameters.  The
+        following parameters are recognised:
+
+            'bbox'
+
+                A bounding box, as "minLong,minLat,maxLong,maxLat".
+
+            'polygon'
+
+                A polygon or multipolygon, as WKT in lat/long coordinates.
+
+            'where'
+
+                An attribute predicate, such as "NAME=Paris",
+                "POP_2005>=1000000" or "FOUNDED<1900-01-01".  Dates and times
+                are given in ISO 8601 format.  The supported comparison
+                operators are =, !=, <, <=, > and >=.  This parameter can be
+                repeated, in which case the selected features must match
+                every predicate.
+
+        We return a FeatureFilter object, or None if the parameters don't
+        include a filter.  If the filter is invalid, we raise a FilterError.
+    """
+    area = None
+
+    if params.get("bbox"):
+        try:
+            minX,minY,maxX,maxY = [float(s) for s
+                                   in params['bbox'].split(",")]
+        except ValueError:
+            raise FilterError("Invalid bounding box: " + params['bbox'])
+        if minX > maxX or minY > maxY:
+            raise FilterError("Invalid bounding box: " + params['bbox'])
+        area = Polygon.from_bbox((minX, minY, maxX, maxY))
+        area.srid = 4326
+
+    if params.get("polygon"):
+        try:
+            polygon = GEOSGeometry(params['polygon'], srid=4326)
+        except (GEOSException, ValueError):
+            raise FilterError("Invalid polygon: " + params['polygon'])
+        if polygon.geom_type not in ["Polygon", "MultiPolygon"]:
+            raise FilterError("Not a polygon: " + params['polygon'])
+        if area == None:
+            area = polygon
+        else:
+            area = area.intersection(polygon)
+
+    predicates = []
+    if params.getlist("where"):
+        attributes = {}
+        for attr in shapefile.attribute_set.all():
+            attributes[attr.name] = attr
+
+        for predicate in params.getlist("where"):
+            predicates.append(_parsePredicate(predicate, attributes))
+
+    if area == None and len(predicates) == 0:
+        return None
+    return FeatureFilter(area, predicates)
+
+#############################################################################
+#
+# Private definitions:
+
+# The comparison operators supported by attribute predicates, and the SQL
+# operator to use for each one.
+
+_OPERATORS = {"="  : "=",
+              "!=" : "<>",
+              "<"  : "<",
+              "<=" : "<=",
+              ">"  : ">",
+              ">=" : ">="}
+
+# A regular expression matching an attribute predicate.
+
+_PREDICATE = re.compile(r"^\s*([^<>=!]+?)\s*(<=|>=|!=|=|<|>)\s*(.*?)\s*$")
+
+
+def _parsePredicate(predicate, attributes):
+    """ Parse a single attribute predicate.
+
+        'predicate' is the predicate to parse, and 'attributes' is a
+        dictionary mapping attribute names to Attribute objects.  We return
+        an (attribute, operator, value) tuple, as stored in a FeatureFilter.
+    """
+    match = _PREDICATE.match(predicate)
+    if match == None:
+        raise FilterError("Invalid predicate: " + predicate)
+
+    name,operator,value = match.groups()
+    if name not in attributes:
+        raise FilterError("Unknown attribute: " + name)
+    attr = attributes[name]
+
+    if attr.type not in featureStore.SCALAR_TYPES:
+        raise FilterError("Unable to filter on attribute: " + name)
+
+    try:
+        if attr.type == ogr.OFTInteger:
+            value = int(value)
+        elif attr.type == ogr.OFTReal:
+            value = float(value)
+        elif attr.type == ogr.OFTString:
+            value = unicode(value)
+        else:
+            parts = attributeCodecs.parseDateTime(attr.type, value)
+            value = attributeCodecs.formatDateTime(attr.type, *parts)
+    except ValueError:
+        raise FilterError("Invalid value for " + name + ": " + value)
+
+    return (attr, _OPERATORS[operator], value)
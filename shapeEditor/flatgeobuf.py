@@ -0,0 +1,579 @@
+# flatgeobuf.py
+#
+# This module implements a writer for the FlatGeobuf file format.
+#
+# A FlatGeobuf file consists of a "magic number", a header describing the
+# layer and its columns, an optional spatial index, and then the features
+# themselves.  The header and each feature are encoded as FlatBuffers, which
+# can be read without having to parse or copy the data.
+#
+# The spatial index is a packed Hilbert R-tree: the features are sorted by
+# the Hilbert value of the centre of their bounding boxes, and a static
+# R-tree is built over the sorted features.  This lets a client fetch just
+# the features within a given area using HTTP range requests, rather than
+# downloading the entire file.  Because the index has to be written before
+# the features, we spool the encoded features to a temporary file while
+# working out their bounding boxes, and only start sending the file once
+# all the features have been encoded.  If an index isn't required, the
+# features are sent as soon as they've been encoded.
+#
+# We only write the parts of the FlatBuffers format needed for FlatGeobuf,
+# so we don't need the flatbuffers library to be installed.
+
+from osgeo import ogr
+
+import array
+import json
+import struct
+import tempfile
+
+import utils
+
+#############################################################################
+
+class FlatGeobufWriter(object):
+    """ A writer which generates a FlatGeobuf file as a sequence of chunks.
+    """
+    def __init__(self, name, geometryType, attributes, nodeSize=16,
+                 chunkSize=65536):
+        """ Initialise our FlatGeobufWriter.
+
+            The parameters are as follows:
+
+                'name'
+
+                    The name of the layer being written.
+
+                'geometryType'
+
+                    The type of geometry held in the layer, for example
+                    "MultiPolygon".  All geometries are assumed to be in
+                    WGS84 (EPSG:4326) coordinates.
+
+                'attributes'
+
+                    A list of Attribute objects describing the columns to
+                    write.
+
+                'nodeSize'
+
+                    The number of child nodes for each node in the spatial
+                    index.
+
+                'chunkSize'
+
+                    The approximate number of bytes to yield at once.
+        """
+        self._name         = name
+        self._geometryType = _GEOMETRY_TYPES.get(geometryType, 0)
+        self._attributes   = attributes
+        self._nodeSize     = nodeSize
+        self._chunkSize    = chunkSize
+
+        self._columnTypes = []
+        for attr in attributes:
+            self._columnTypes.append(_COLUMN_TYPES.get(attr.type,
+                                                       _COLUMN_STRING))
+
+
+    def generate(self, features, index=True):
+        """ Generate the FlatGeobuf file.
+
+            'features' is an iterable yielding a (wkb, values) tuple for
+            each feature, where 'wkb' is the feature's geometry in WKB format
+            and 'values' is a list of the feature's attribute values (as
+            stored in the database), in the same order as our list of
+            attributes.
+
+            If 'index' is True, the file will include a spatial index.  We
+            yield the chunks of data making up the file.
+        """
+        if not index:
+            yield self._encodeHeader(0, None, 0)
+            chunk = []
+            size  = 0
+            for wkb,values in features:
+                data,bounds = self._encodeFeature(wkb, values)
+                chunk.append(data)
+                size = size + len(data)
+                if size >= self._chunkSize:
+                    yield "".join(chunk)
+                    chunk = []
+                    size  = 0
+            if size > 0:
+                yield "".join(chunk)
+            return
+
+        # Encode the features, storing them in a temporary file.  For each
+        # feature, we remember its bounding box, and its offset and size
+        # within the temporary file.
+
+        spool = tempfile.TemporaryFile()
+        try:
+            items  = array.array("d")
+            offset = 0
+            for wkb,values in features:
+                data,bounds = self._encodeFeature(wkb, values)
+                spool.write(data)
+                items.extend(bounds)
+                items.append(offset)
+                items.append(len(data))
+                offset = offset + len(data)
+
+            numFeatures = len(items) // _ITEM_SIZE
+            if numFeatures == 0:
+                yield self._encodeHeader(0, None, 0)
+                return
+
+            extent = _calcExtent(items)
+
+            # Sort the features by the Hilbert value of their centre point.
+
+            def hilbertValue(i):
+                i = i * _ITEM_SIZE
+                x = (items[i] + items[i+2]) / 2
+                y = (items[i+1] + items[i+3]) / 2
+                return utils.calcHilbertValue(x, y, extent)
+
+            order = sorted(xrange(numFeatures), key=hilbertValue)
+
+            yield self._encodeHeader(numFeatures, extent, self._nodeSize)
+
+            for chunk in self._generateIndex(items, order):
+                yield chunk
+
+            # Finally, send the features in sorted order.
+
+            chunk = []
+            size  = 0
+            for i in order:
+                offset,length = items[i*_ITEM_SIZE+4:i*_ITEM_SIZE+6]
+                spool.seek(int(offset))
+                chunk.append(spool.read(int(length)))
+                size = size + int(length)
+                if size >= self._chunkSize:
+                    yield "".join(chunk)
+                    chunk = []
+                    size  = 0
+            if size > 0:
+                yield "".join(chunk)
+        finally:
+            spool.close()
+
+    # =====================
+    # == PRIVATE METHODS ==
+    # =====================
+
+    def _encodeHeader(self, numFeatures, extent, nodeSize):
+        """ Return the magic number and header for our FlatGeobuf file.
+
+            'numFeatures' is the number of features in the file (or zero if
+            this isn't known), 'extent' is the (minX, minY, maxX, maxY)
+            bounding box for the file's features (or None if this isn't
+            known), and 'nodeSize' is the number of child nodes per node in
+            the spatial index, or zero if there is no index.
+        """
+        columns = []
+        for attr,columnType in zip(self._attributes, self._columnTypes):
+            fields = [(0, None, ("string", _encodeText(attr.name))),
+                      (1, "B",  columnType)]
+            if columnType == _COLUMN_STRING and attr.width > 0:
+                fields.append((4, "i", attr.width))
+            if columnType == _COLUMN_DOUBLE:
+                fields.append((6, "i", attr.precision))
+            columns.append(("table", fields))
+
+        crs = ("table", [(0, None, ("string", "EPSG")),
+                         (1, "i",  4326)])
+
+        fields = [(0,  None, ("string", _encodeText(self._name))),
+                  (2,  "B",  self._geometryType),
+                  (8,  "Q",  numFeatures),
+                  (9,  "H",  nodeSize),
+                  (10, None, crs)]
+        if extent != None:
+            fields.append((1, None, ("vector", "d", extent)))
+        if len(columns) > 0:
+            fields.append((7, None, ("tables", columns)))
+
+        header = _buildFlatBuffer(("table", fields))
+        return _MAGIC + struct.pack("<I", len(header)) + header
+
+
+    def _encodeFeature(self, wkb, values):
+        """ Encode a single feature.
+
+            We return a (data, bounds) tuple, where 'data' is the encoded
+            feature, and 'bounds' is the feature's (minX, minY, maxX, maxY)
+            bounding box.
+        """
+        geometry = utils.parseWKB(wkb)
+
+        properties = []
+        for i,(columnType,value) in enumerate(zip(self._columnTypes,
+                                                  values)):
+            if value == None:
+                continue
+            properties.append(struct.pack("<H", i))
+            if columnType == _COLUMN_INT:
+                properties.append(struct.pack("<i", value))
+            elif columnType == _COLUMN_DOUBLE:
+                properties.append(struct.pack("<d", value))
+            else:
+                if columnType == _COLUMN_JSON:
+                    value = json.dumps(value)
+                value = _encodeText(value)
+                properties.append(struct.pack("<I", len(value)) + value)
+
+        fields = [(0, None, _geometryTable(geometry))]
+        if len(properties) > 0:
+            fields.append((1, None, ("bytes", "".join(properties))))
+
+        feature = _buildFlatBuffer(("table", fields))
+        data = struct.pack("<I", len(feature)) + feature
+        return (data, _calcBounds(geometry))
+
+
+    def _generateIndex(self, items, order):
+        """ Generate the packed Hilbert R-tree for our features.
+
+            'items' is the array of feature bounding boxes, offsets and
+            sizes, and 'order' is the list of feature indexes, sorted by
+            Hilbert value.
+
+            The tree is stored one level at a time, starting with the root
+            node and ending with the leaf nodes.  Each leaf node holds the
+            bounding box of a feature and the feature's byte offset within
+            the file's features, while each of the other nodes holds the
+            bounding box of its children, and the index of its first child
+            node.
+        """
+        nodeSize    = self._nodeSize
+        levelBounds = _calcLevelBounds(len(order), nodeSize)
+
+        # Calculate the bounding boxes for the non-leaf nodes, one level at a
+        # time.
+
+        def leafBounds():
+            for i in order:
+                yield items[i*_ITEM_SIZE:i*_ITEM_SIZE+4]
+
+        levels = [] # List of lists of bounding boxes, from the bottom up.
+        bounds = leafBounds()
+        for level in range(1, len(levelBounds)):
+            parentBounds = []
+            group = []
+            for childBounds in bounds:
+                group.append(childBounds)
+                if len(group) == nodeSize:
+                    parentBounds.append(_unionBounds(group))
+                    group = []
+            if len(group) > 0:
+                parentBounds.append(_unionBounds(group))
+            levels.append(parentBounds)
+            bounds = parentBounds
+
+        # Send the non-leaf nodes, from the root node down.
+
+        for level in range(len(levels), 0, -1):
+            firstChild = levelBounds[level-1][0]
+            nodes = []
+            for i,(minX,minY,maxX,maxY) in enumerate(levels[level-1]):
+                nodes.append(struct.pack("<ddddQ", minX, minY, maxX, maxY,
+                                         firstChild + i * nodeSize))
+            yield "".join(nodes)
+
+        # Finally, send the leaf nodes.
+
+        nodes  = []
+        offset = 0
+        for i in order:
+            minX,minY,maxX,maxY,ignore,size = \
+                    items[i*_ITEM_SIZE:(i+1)*_ITEM_SIZE]
+            nodes.append(struct.pack("<ddddQ", minX, minY, maxX, maxY,
+                                     offset))
+            offset = offset + int(size)
+            if len(nodes) * _NODE_SIZE >= self._chunkSize:
+                yield "".join(nodes)
+                nodes = []
+        if len(nodes) > 0:
+            yield "".join(nodes)
+
+#############################################################################
+#
+# Private definitions:
+
+# The "magic number" at the start of every FlatGeobuf file.
+
+_MAGIC = "fgb\x03fgb\x00"
+
+# The number of values stored in our items array for each feature: the
+# feature's bounding box, followed by its offset and size within the spool
+# file.  Note that the offset and size are stored as floating-point numbers,
+# which can represent integers exactly up to 2^53.
+
+_ITEM_SIZE = 6
+
+# The size of a node in the spatial index, in bytes.
+
+_NODE_SIZE = 40
+
+# The FlatGeobuf geometry types.
+
+_GEOMETRY_TYPES = {"Point"              : 1,
+                   "LineString"         : 2,
+                   "Polygon"            : 3,
+                   "MultiPoint"         : 4,
+                   "MultiLineString"    : 5,
+                   "MultiPolygon"       : 6,
+                   "GeometryCollection" : 7}
+
+# The FlatGeobuf column types we use, and the column type to use for each
+# OGR field type.
+
+_COLUMN_INT      = 5
+_COLUMN_DOUBLE   = 10
+_COLUMN_STRING   = 11
+_COLUMN_JSON     = 12
+_COLUMN_DATETIME = 13
+
+_COLUMN_TYPES = {ogr.OFTInteger     : _COLUMN_INT,
+                 ogr.OFTIntegerList : _COLUMN_JSON,
+                 ogr.OFTReal        : _COLUMN_DOUBLE,
+                 ogr.OFTRealList    : _COLUMN_JSON,
+                 ogr.OFTString      : _COLUMN_STRING,
+                 ogr.OFTStringList  : _COLUMN_JSON,
+                 ogr.OFTDate        : _COLUMN_DATETIME,
+                 ogr.OFTTime        : _COLUMN_DATETIME,
+                 ogr.OFTDateTime    : _COLUMN_DATETIME}
+
+
+def _encodeText(value):
+    """ Return the given string value encoded as UTF-8.
+    """
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+
+def _geometryTable(geometry):
+    """ Return the FlatBuffers table for the given parsed geometry.
+
+        'geometry' is a (type, data) tuple, as returned by utils.parseWKB().
+    """
+    geometryType,data = geometry
+
+    if geometryType in ["Point", "LineString"]:
+        rings = [data]
+    elif geometryType == "Polygon":
+        rings = data
+    elif geometryType in ["MultiPoint", "MultiLineString"]:
+        rings = [member[1] for member in data]
+    else:
+        parts = [_geometryTable(member) for member in data]
+        return ("table", [(6, "B",  _GEOMETRY_TYPES[geometryType]),
+                          (7, None, ("tables", parts))])
+
+    coords = []
+    ends   = []
+    for ring in rings:
+        coords.extend(ring)
+        ends.append(len(coords) // 2)
+
+    fields = [(1, None, ("vector", "d", coords)),
+              (6, "B",  _GEOMETRY_TYPES[geometryType])]
+    if len(ends) > 1 and geometryType != "MultiPoint":
+        fields.append((0, None, ("vector", "I", ends)))
+    return ("table", fields)
+
+
+def _calcBounds(geometry):
+    """ Return the (minX, minY, maxX, maxY) bounding box for a geometry.
+
+        'geometry' is a (type, data) tuple, as returned by utils.parseWKB().
+    """
+    geometryType,data = geometry
+    if geometryType in ["Point", "LineString"]:
+        return (min(data[0::2]), min(data[1::2]),
+                max(data[0::2]), max(data[1::2]))
+    elif geometryType == "Polygon":
+        return _calcBounds(("LineString", data[0]))
+    else:
+        return _unionBounds([_calcBounds(member) for member in data])
+
+
+def _unionBounds(boundsList):
+    """ Return the bounding box which encloses the given bounding boxes.
+    """
+    minX = min([bounds[0] for bounds in boundsList])
+    minY = min([bounds[1] for bounds in boundsList])
+    maxX = max([bounds[2] for bounds in boundsList])
+    maxY = max([bounds[3] for bounds in boundsList])
+    return (minX, minY, maxX, maxY)
+
+
+def _calcExtent(items):
+    """ Return the bounding box which encloses all the items in our array.
+    """
+    minX = min(items[0::_ITEM_SIZE])
+    minY = min(items[1::_ITEM_SIZE])
+    maxX = max(items[2::_ITEM_SIZE])
+    maxY = max(items[3::_ITEM_SIZE])
+    return (minX, minY, maxX, maxY)
+
+
+def _calcLevelBounds(numItems, nodeSize):
+    """ Return the position of each level within the spatial index.
+
+        We return a list of (start, end) tuples, one for each level of the
+        tree starting with the leaf nodes, giving the range of node indexes
+        used by that level.  Note that the nodes are stored starting with
+        the root node, so the leaf nodes come last.
+    """
+    levelNumNodes = [numItems]
+    numNodes = numItems
+    n = numItems
+    while True:
+        n = (n + nodeSize - 1) // nodeSize
+        numNodes = numNodes + n
+        levelNumNodes.append(n)
+        if n == 1:
+            break
+
+    levelBounds = []
+    end = numNodes
+    for n in levelNumNodes:
+        levelBounds.append((end - n, end))
+        end = end - n
+    return levelBounds
+
+#############################################################################
+
+# The following functions build a FlatBuffer out of a tree of nodes, where
+# each node is one of the following:
+#
+#     ("table", fields)      A table.  'fields' is a list of (slot, format,
+#                            value) tuples.  If 'format' is a struct format
+#                            character, 'value' is a scalar value to store
+#                            inline.  If 'format' is None, 'value' is a node
+#                            to store after the table.
+#
+#     ("string", data)       A string of bytes.
+#
+#     ("bytes", data)        A vector of unsigned bytes.
+#
+#     ("vector", fmt, list)  A vector of scalar values, where 'fmt' is the
+#                            struct format character for each value.
+#
+#     ("tables", list)       A vector of tables.
+#
+# Unlike the flatbuffers library, which builds the buffer from the end
+# backwards, we write each node before its children so that all offsets
+# point forwards.
+
+def _buildFlatBuffer(root):
+    """ Return a FlatBuffer holding the given root table.
+    """
+    buf = bytearray(4)
+    rootPos = _writeNode(buf, root)
+    struct.pack_into("<I", buf, 0, rootPos)
+    return str(buf)
+
+
+def _pad(buf, alignment, extra=0):
+    """ Add padding until (len(buf) + extra) is a multiple of 'alignment'.
+    """
+    while (len(buf) + extra) % alignment != 0:
+        buf.append(0)
+
+
+def _writeNode(buf, node):
+    """ Write the given node, returning its position within the buffer.
+    """
+    kind = node[0]
+    if kind in ["string", "bytes"]:
+        data = node[1]
+        _pad(buf, 4)
+        pos = len(buf)
+        buf.extend(struct.pack("<I", len(data)))
+        buf.extend(data)
+        if kind == "string":
+            buf.append(0)
+        return pos
+    elif kind == "vector":
+        fmt,values = node[1:]
+        size = struct.calcsize("<" + fmt)
+        _pad(buf, 4)
+        _pad(buf, max(size, 4), 4)
+        pos = len(buf)
+        buf.extend(struct.pack("<I%d%s" % (len(values), fmt), len(values),
+                               *values))
+        return pos
+    elif kind == "tables":
+        tables = node[1]
+        _pad(buf, 4)
+        pos = len(buf)
+        buf.extend(struct.pack("<I", len(tables)))
+        buf.extend("\0" * (4 * len(tables)))
+        for i,table in enumerate(tables):
+            offsetPos = pos + 4 + 4 * i
+            tablePos = _writeNode(buf, table)
+            struct.pack_into("<I", buf, offsetPos, tablePos - offsetPos)
+        return pos
+    else:
+        return _writeTable(buf, node[1])
+
+
+def _writeTable(buf, fields):
+    """ Write a table with the given fields, returning its position.
+
+        The table's vtable is written immediately before the table itself,
+        and the table's child nodes are written after it.
+    """
+    numSlots = 0
+    for slot,fmt,value in fields:
+        numSlots = max(numSlots, slot + 1)
+    vtableSize = 4 + 2 * numSlots
+
+    _pad(buf, 2)
+    vtablePos = len(buf)
+    tablePos  = vtablePos + vtableSize
+    tablePos  = tablePos + (-tablePos % 4)
+
+    # Lay out the table's fields, largest first to keep the padding down.
+
+    def fieldSize(field):
+        if field[1] == None:
+            return 4
+        return struct.calcsize("<" + field[1])
+
+    positions = {} # Maps slot to position of field within the buffer.
+    pos = tablePos + 4
+    for field in sorted(fields, key=fieldSize, reverse=True):
+        size = fieldSize(field)
+        pos = pos + (-pos % size)
+        positions[field[0]] = pos
+        pos = pos + size
+    tableEnd = pos
+
+    vtable = [vtableSize, tableEnd - tablePos]
+    for slot in range(numSlots):
+        if slot in positions:
+            vtable.append(positions[slot] - tablePos)
+        else:
+            vtable.append(0)
+    buf.extend(struct.pack("<%dH" % len(vtable), *vtable))
+    buf.extend("\0" * (tableEnd - len(buf)))
+    struct.pack_into("<i", buf, tablePos, tablePos - vtablePos)
+
+    for slot,fmt,value in fields:
+        if fmt != None:
+            struct.pack_into("<" + fmt, buf, positions[slot], value)
+
+    for slot,fmt,value in fields:
+        if fmt == None:
+            childPos = _writeNode(buf, value)
+            struct.pack_into("<I", buf, positions[slot],
+                             childPos - positions[slot])
+
+    return tablePos
@@ -12,6 +12,13 @@ CHARACTER_ENCODINGS = [("ascii",  "ASCII"),
                        ("latin1", "Latin-1"),
                        ("utf8",   "UTF-8")]
 
+# List of things the user can do if they upload a shapefile which has already
+# been imported:
+
+DUPLICATE_ACTIONS = [("clone",  "Copy the previously imported shapefile"),
+                     ("link",   "Use the previously imported shapefile"),
+                     ("import", "Import the shapefile again")]
+
 #############################################################################
 
 class ImportShapefileForm(forms.Form):
@@ -20,4 +27,7 @@ class ImportShapefileForm(forms.Form):
     import_file        = forms.FileField(label="Select a Zipped Shapefile")
     character_encoding = forms.ChoiceField(choices=CHARACTER_ENCODINGS,
                                            initial="utf8")
+    duplicate_action   = forms.ChoiceField(choices=DUPLICATE_ACTIONS,
+                                           initial="clone",
+                                           label="If already imported")
 
@@ -0,0 +1,51 @@
+# clusterfeatures.py
+#
+# This management command rewrites the features of existing shapefiles in
+# Hilbert order.
+#
+# Features are stored in order of the Hilbert value of their centre point
+# when a shapefile is imported, so that features which are close together in
+# space are also close together on disk, and a map tile or bounding box
+# query only has to read a few pages of the Feature table.  Shapefiles
+# imported by earlier versions of the ShapeEditor were stored in their
+# original record order instead, and heavily edited shapefiles gradually lose
+# their ordering as features are updated.  To re-cluster every shapefile,
+# run:
+#
+#     python manage.py clusterfeatures
+#
+# or give the IDs of the shapefiles to re-cluster.  If the Feature table
+# isn't partitioned, you should VACUUM it afterwards to reclaim the space
+# used by the old copies of the features.
+
+from django.core.management.base import BaseCommand, CommandError
+
+from geoedit.shapeEditor.models import Shapefile
+from geoedit.shapeEditor import featureStore
+from geoedit.shapeEditor.management import upgrade
+
+#############################################################################
+
+class Command(BaseCommand):
+    args = "[<shapefile_id> ...]"
+    help = "Rewrite shapefiles' features in Hilbert order."
+
+    def handle(self, *args, **options):
+        upgrade.upgradeTables()
+
+        if len(args) == 0:
+            shapefiles = Shapefile.objects.filter(deleting=False)
+            shapefiles = shapefiles.order_by("id")
+        else:
+            shapefiles = []
+            for arg in args:
+                try:
+                    shapefiles.append(Shapefile.objects.get(id=int(arg),
+                                                            deleting=False))
+                except (ValueError, Shapefile.DoesNotExist):
+                    raise CommandError("No such shapefile: " + arg)
+
+        for shapefile in shapefiles:
+            numFeatures = featureStore.clusterFeatures(shapefile)
+            print "Clustered %d features in %s" % (numFeatures,
+                                                  shapefile.filename)
@@ -0,0 +1,33 @@
+# finishdeletes.py
+#
+# This management command finishes deleting any shapefiles which were being
+# deleted in the background.
+#
+# Large shapefiles are hidden from the user and then deleted by a background
+# thread.  If the web server is restarted before the thread finishes, the
+# shapefile is left hidden but not deleted; this command deletes any such
+# shapefiles.  When upgrading an existing database, this command also adds
+# the 'deleting' column to the Shapefile table.  Run:
+#
+#     python manage.py finishdeletes
+
+from django.core.management.base import NoArgsCommand
+
+from geoedit.shapeEditor.models import Shapefile
+from geoedit.shapeEditor import exportCache
+from geoedit.shapeEditor import featureStore
+from geoedit.shapeEditor.management import upgrade
+
+#############################################################################
+
+class Command(NoArgsCommand):
+    help = "Finish deleting shapefiles which were being deleted in the " \
+         + "background."
+
+    def handle_noargs(self, **options):
+        upgrade.upgradeTables()
+
+        for shapefile in Shapefile.objects.filter(deleting=True):
+            print "Deleting " + shapefile.filename
+            featureStore.deleteShapefile(shapefile)
+            exportCache.purge(shapefile.id)
@@ -0,0 +1,59 @@
+# indexattribute.py
+#
+# This management command creates or removes the database index for one of
+# a shapefile's attributes.
+#
+# Indexing an attribute lets the database filter and sort the shapefile's
+# features by that attribute without reading every feature, at the cost of
+# some extra work whenever a feature is saved.  To index an attribute, run:
+#
+#     python manage.py indexattribute <shapefile_id> <attribute>
+#
+# To remove the index again, add the --drop option.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from geoedit.shapeEditor.models import Shapefile, Attribute
+from geoedit.shapeEditor import featureStore
+from geoedit.shapeEditor.management import upgrade
+
+#############################################################################
+
+class Command(BaseCommand):
+    args = "<shapefile_id> <attribute> [<attribute> ...]"
+    help = "Create or remove the database index for a shapefile's " \
+         + "attributes."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--drop", action="store_true", dest="drop",
+                    default=False, help="Remove the attribute's index."),
+    )
+
+    def handle(self, *args, **options):
+        upgrade.upgradeTables()
+
+        if len(args) < 2:
+            raise CommandError("Usage: indexattribute " + self.args)
+
+        try:
+            shapefile = Shapefile.objects.get(id=int(args[0]))
+        except (ValueError, Shapefile.DoesNotExist):
+            raise CommandError("No such shapefile: " + args[0])
+
+        for name in args[1:]:
+            try:
+                attr = shapefile.attribute_set.get(name=name)
+            except Attribute.DoesNotExist:
+                raise CommandError("No such attribute: " + name)
+
+            if options['drop']:
+                if attr.indexed:
+                    featureStore.dropAttributeIndex(attr)
+                    print "Removed index for " + name
+            elif attr.type not in featureStore.SCALAR_TYPES:
+                raise CommandError("Unable to index attribute: " + name)
+            elif not attr.indexed:
+                featureStore.createAttributeIndex(attr)
+                print "Created index for " + name
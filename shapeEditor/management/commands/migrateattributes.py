@@ -0,0 +1,147 @@
+# migrateattributes.py
+#
+# This management command upgrades the attribute values stored by earlier
+# versions of the ShapeEditor.
+#
+# Earlier versions stored each attribute value as a separate row in an
+# AttributeValue table.  Each feature's attribute values are now stored in
+# the Feature's 'attributes' column, so this command adds that column (if it
+# doesn't already exist), copies the attribute values across one shapefile
+# at a time, and then drops the old table.
+#
+# Earlier versions also stored every attribute value as a string.  Attribute
+# values are now stored using the attribute's declared type, so this command
+# also converts any values which are still stored as strings.  To upgrade an
+# existing database, run:
+#
+#     python manage.py migrateattributes
+#
+# This only reads the Feature table's record ID and attribute columns, so it
+# works whether or not the feature geometries have been upgraded.  When
+# upgrading a database from an earlier version of the ShapeEditor, run the
+# upgrade commands in this order:
+#
+#     python manage.py migrateattributes
+#     python manage.py migrategeometry
+#     python manage.py updatestatistics
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+
+from geoedit.shapeEditor.models import Shapefile, Attribute, Feature
+from geoedit.shapeEditor import attributeCodecs
+from geoedit.shapeEditor import featureStore
+from geoedit.shapeEditor.management import upgrade
+
+#############################################################################
+
+class Command(NoArgsCommand):
+    help = "Upgrade the attribute values stored by earlier versions of " \
+         + "the ShapeEditor."
+
+    def handle_noargs(self, **options):
+        upgrade.upgradeTables()
+
+        qn = connection.ops.quote_name
+
+        featureTable = Feature._meta.db_table
+        valueTable   = Feature._meta.app_label + "_attributevalue"
+        attributes   = qn(Feature._meta.get_field("attributes").column)
+
+        cursor = connection.cursor()
+
+        # Add the new columns to the Feature and Attribute tables, if
+        # necessary.
+
+        _addColumn(cursor, Feature, "attributes",
+                   "jsonb NOT NULL DEFAULT '{}'")
+        _addColumn(cursor, Attribute, "indexed",
+                   "boolean NOT NULL DEFAULT false")
+
+        if valueTable in connection.introspection.table_names():
+            # Copy the attribute values across, one shapefile at a time.
+
+            for shapefile in Shapefile.objects.all().order_by("id"):
+                print "Migrating attribute values for " + shapefile.filename
+                cursor.execute("UPDATE " + qn(featureTable) + " f SET " +
+                               attributes + " = f." + attributes + " || " +
+                               "v.attrs FROM (" +
+                               "SELECT v.feature_id, " +
+                               "jsonb_object_agg(a." + qn("name") + ", " +
+                               "v." + qn("value") + ") AS attrs FROM " +
+                               qn(valueTable) + " v JOIN " +
+                               qn(Attribute._meta.db_table) + " a ON a." +
+                               qn(Attribute._meta.pk.column) +
+                               " = v.attribute_id WHERE a.shapefile_id = %s " +
+                               "AND v." + qn("value") + " IS NOT NULL " +
+                               "GROUP BY v.feature_id) v " +
+                               "WHERE f." + qn(Feature._meta.pk.column) +
+                               " = v.feature_id",
+                               [shapefile.id])
+                transaction.commit_unless_managed()
+
+            print "Dropping " + valueTable
+            cursor.execute("DROP TABLE " + qn(valueTable))
+            transaction.commit_unless_managed()
+
+        # Convert any attribute values which are still stored as strings.
+
+        for shapefile in Shapefile.objects.all().order_by("id"):
+            numConverted = _convertValues(shapefile)
+            if numConverted > 0:
+                print "Converted attribute values for %d features in %s" \
+                    % (numConverted, shapefile.filename)
+
+#############################################################################
+#
+# Private definitions:
+
+def _addColumn(cursor, model, fieldName, definition):
+    """ Add the given field's column to the model's table, if necessary.
+    """
+    qn = connection.ops.quote_name
+
+    table  = model._meta.db_table
+    column = model._meta.get_field(fieldName).column
+
+    columns = [row[0] for row in
+               connection.introspection.get_table_description(cursor, table)]
+    if column not in columns:
+        print "Adding " + column + " column to " + table
+        cursor.execute("ALTER TABLE " + qn(table) + " ADD COLUMN " +
+                       qn(column) + " " + definition)
+        transaction.commit_unless_managed()
+
+
+@transaction.commit_on_success
+def _convertValues(shapefile):
+    """ Convert the given shapefile's old-style attribute values.
+
+        We read through the shapefile's features, and update the features
+        whose attribute values are stored as strings, one batch at a time.
+        The conversion is done in a single transaction, so that our
+        server-side cursor stays open while the features are being updated.
+        We return the number of features which were updated.
+    """
+    attributes = list(shapefile.attribute_set.all())
+    parsers = attributeCodecs.compileLegacyParsers(attributes)
+    parsers = dict(zip([attr.name for attr in attributes], parsers))
+
+    numConverted = 0
+    updates = []
+    for featureId,values in featureStore.iterAttributes(shapefile):
+        converted = {}
+        for name,value in values.items():
+            if name in parsers:
+                converted[name] = parsers[name](value)
+            else:
+                converted[name] = value
+        if converted != values:
+            updates.append((featureId, converted))
+            if len(updates) >= featureStore.FETCH_BATCH_SIZE:
+                featureStore.updateAttributes(shapefile, updates)
+                numConverted = numConverted + len(updates)
+                updates = []
+
+    featureStore.updateAttributes(shapefile, updates)
+    return numConverted + len(updates)
@@ -0,0 +1,127 @@
+# migrategeometry.py
+#
+# This management command moves the feature geometries stored by earlier
+# versions of the ShapeEditor into the Feature's 'geometry' field.
+#
+# Earlier versions stored each feature's geometry in one of five separate
+# columns, depending on the type of geometry.  Every feature's geometry is
+# now stored in a single 'geometry' column, along with its geometry type and
+# bounding box.  This command adds the new columns and their indexes (if
+# they don't already exist), copies the geometries across one shapefile at a
+# time, and then drops the old columns.  To upgrade an existing database,
+# run:
+#
+#     python manage.py migrategeometry
+#
+# When upgrading a database from an earlier version of the ShapeEditor, run
+# the upgrade commands in this order, as the statistics are calculated from
+# the upgraded geometries:
+#
+#     python manage.py migrateattributes
+#     python manage.py migrategeometry
+#     python manage.py updatestatistics
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+
+from geoedit.shapeEditor.models import Shapefile, Feature
+from geoedit.shapeEditor.management import upgrade
+
+#############################################################################
+
+class Command(NoArgsCommand):
+    help = "Move feature geometries into the Feature table's single " \
+         + "geometry column."
+
+    def handle_noargs(self, **options):
+        upgrade.upgradeTables()
+
+        qn = connection.ops.quote_name
+
+        table = Feature._meta.db_table
+
+        geometry     = qn(Feature._meta.get_field("geometry").column)
+        geometryType = qn(Feature._meta.get_field("geometry_type").column)
+        bbox         = qn(Feature._meta.get_field("bbox").column)
+        shapefileId  = qn(Feature._meta.get_field("shapefile").column)
+
+        cursor = connection.cursor()
+
+        columns = [row[0] for row in
+                   connection.introspection.get_table_description(cursor,
+                                                                  table)]
+        oldColumns = []
+        for column in _OLD_COLUMNS:
+            if column in columns:
+                oldColumns.append(qn(column))
+
+        if len(oldColumns) == 0:
+            print "No geometries to migrate."
+            return
+
+        # Add the new columns, if necessary.
+
+        if Feature._meta.get_field("geometry").column not in columns:
+            print "Adding geometry columns to " + table
+            cursor.execute("ALTER TABLE " + qn(table) +
+                           " ADD COLUMN " + geometry +
+                           " geometry(Geometry, 4326)," +
+                           " ADD COLUMN " + geometryType +
+                           " varchar(50) NOT NULL DEFAULT ''," +
+                           " ADD COLUMN " + bbox +
+                           " geometry(Polygon, 4326)")
+            transaction.commit_unless_managed()
+
+        # Copy the geometries across, one shapefile at a time.
+
+        for shapefile in Shapefile.objects.all().order_by("id"):
+            print "Migrating geometries for " + shapefile.filename
+            cursor.execute("UPDATE " + qn(table) + " SET " +
+                           geometry + " = g.geom, " +
+                           geometryType + " = substr(ST_GeometryType(" +
+                           "g.geom), 4), " +
+                           bbox + " = ST_MakeEnvelope(ST_XMin(g.geom), " +
+                           "ST_YMin(g.geom), ST_XMax(g.geom), " +
+                           "ST_YMax(g.geom), 4326) FROM (SELECT " +
+                           qn(Feature._meta.pk.column) + " AS id, " +
+                           "COALESCE(" + ", ".join(oldColumns) + ") " +
+                           "AS geom FROM " + qn(table) + " WHERE " +
+                           shapefileId + " = %s) g WHERE " + qn(table) +
+                           "." + qn(Feature._meta.pk.column) + " = g.id",
+                           [shapefile.id])
+            transaction.commit_unless_managed()
+
+        # Index the new columns, and drop the old ones.
+
+        print "Indexing geometry columns"
+        cursor.execute("ALTER TABLE " + qn(table) +
+                       " ALTER COLUMN " + geometry + " SET NOT NULL," +
+                       " ALTER COLUMN " + bbox + " SET NOT NULL")
+        for fieldName in ["geometry", "bbox"]:
+            column = Feature._meta.get_field(fieldName).column
+            cursor.execute("CREATE INDEX " + qn(table + "_" + column + "_id") +
+                           " ON " + qn(table) + " USING GIST (" + qn(column) +
+                           ")")
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS btree_gist")
+        cursor.execute("CREATE INDEX " +
+                       qn(table + "_shapefile_geometry") + " ON " +
+                       qn(table) + " USING GIST (" + shapefileId + ", " +
+                       geometry + ")")
+        transaction.commit_unless_managed()
+
+        print "Dropping old geometry columns"
+        cursor.execute("ALTER TABLE " + qn(table) + ", ".join(
+                            [" DROP COLUMN " + column
+                             for column in oldColumns]))
+        transaction.commit_unless_managed()
+
+#############################################################################
+#
+# Private definitions:
+
+# The columns used to store feature geometries by earlier versions of the
+# ShapeEditor.
+
+_OLD_COLUMNS = ["geom_singlepoint", "geom_multipoint",
+                "geom_multilinestring", "geom_multipolygon",
+                "geom_geometrycollection"]
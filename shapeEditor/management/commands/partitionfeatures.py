@@ -0,0 +1,37 @@
+# partitionfeatures.py
+#
+# This management command partitions the Feature table by shapefile.
+#
+# Once the Feature table has been partitioned, each shapefile's features
+# (along with their attribute values) are stored in a table of their own.
+# Queries for one shapefile's features only touch that shapefile's table and
+# indexes, no matter how many other shapefiles there are, and deleting a
+# shapefile simply drops its table.  This requires PostgreSQL 11 or later.
+# To partition the Feature table, run:
+#
+#     python manage.py partitionfeatures
+#
+# This can be run on a new database straight after "manage.py syncdb", or
+# on an existing database, in which case the existing features are copied
+# across one shapefile at a time.  The conversion is done in a single
+# transaction, so if it fails, the Feature table is left unchanged.  The web
+# server should be stopped while this command runs, and restarted
+# afterwards.
+
+from django.core.management.base import NoArgsCommand
+
+from geoedit.shapeEditor import featureStore
+from geoedit.shapeEditor.management import upgrade
+
+#############################################################################
+
+class Command(NoArgsCommand):
+    help = "Partition the Feature table by shapefile."
+
+    def handle_noargs(self, **options):
+        upgrade.upgradeTables()
+
+        if featureStore.partitionFeatures():
+            print "Feature table partitioned."
+        else:
+            print "Feature table is already partitioned."
@@ -0,0 +1,32 @@
+# updatestatistics.py
+#
+# This management command calculates the summary statistics for each of our
+# shapefiles.
+#
+# The statistics (each shapefile's extent, feature count, vertex count and
+# modification time) are normally calculated when a shapefile is imported,
+# and kept up to date as the shapefile is edited.  This command adds the
+# columns holding the statistics to the Shapefile table (if they don't
+# already exist), and recalculates the statistics for every shapefile.  As
+# a shapefile's extent never shrinks as features are deleted, this can also
+# be used to tighten up the extents of heavily-edited shapefiles.  Run:
+#
+#     python manage.py updatestatistics
+
+from django.core.management.base import NoArgsCommand
+
+from geoedit.shapeEditor.models import Shapefile
+from geoedit.shapeEditor import featureStore
+from geoedit.shapeEditor.management import upgrade
+
+#############################################################################
+
+class Command(NoArgsCommand):
+    help = "Recalculate the summary statistics for each shapefile."
+
+    def handle_noargs(self, **options):
+        upgrade.upgradeTables()
+
+        for shapefile in Shapefile.objects.all().order_by("id"):
+            print "Updating statistics for " + shapefile.filename
+            featureStore.updateStatistics(shapefile)
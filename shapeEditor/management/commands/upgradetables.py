@@ -0,0 +1,19 @@
+# upgradetables.py
+#
+# This management command adds any missing columns to the tables created by
+# earlier versions of the ShapeEditor.  The other management commands do
+# this automatically; to upgrade the tables on their own, run:
+#
+#     python manage.py upgradetables
+
+from django.core.management.base import NoArgsCommand
+
+from geoedit.shapeEditor.management import upgrade
+
+#############################################################################
+
+class Command(NoArgsCommand):
+    help = "Add any missing columns to the ShapeEditor's tables."
+
+    def handle_noargs(self, **options):
+        upgrade.upgradeTables()
@@ -0,0 +1,97 @@
+# upgrade.py
+#
+# This module brings the tables created by earlier versions of the
+# ShapeEditor up to date.
+#
+# "manage.py syncdb" creates any tables which don't exist yet, but it never
+# adds new columns to an existing table.  Loading a Shapefile object selects
+# every one of the Shapefile table's columns, so any management command which
+# loads shapefiles fails until the table has been upgraded.  Each of our
+# management commands therefore calls upgradeTables() before doing anything
+# else.  Tables which didn't exist in earlier versions, such as the
+# FeatureChange table, are created at the same time.  To upgrade the tables
+# on their own, run:
+#
+#     python manage.py upgradetables
+
+from django.core.management.color import no_style
+from django.db import connection, transaction
+
+from geoedit.shapeEditor.models import Shapefile, FeatureChange
+
+#############################################################################
+
+def upgradeTables():
+    """ Add any missing columns and tables to our database.
+
+        Any column which has a database index is indexed as it is added.
+    """
+    cursor = connection.cursor()
+    addMissingColumns(cursor, Shapefile, _SHAPEFILE_COLUMNS)
+    createMissingTable(cursor, FeatureChange, [Shapefile])
+
+
+def addMissingColumns(cursor, model, columns):
+    """ Add any of the given columns which are missing from a model's table.
+
+        'columns' is a list of (fieldName, definition) tuples, where
+        'definition' is the SQL definition to use when adding the field's
+        column.
+    """
+    qn = connection.ops.quote_name
+
+    table = model._meta.db_table
+
+    existing = [row[0] for row in
+                connection.introspection.get_table_description(cursor, table)]
+    for fieldName,definition in columns:
+        field = model._meta.get_field(fieldName)
+        if field.column in existing:
+            continue
+        print "Adding " + field.column + " column to " + table
+        cursor.execute("ALTER TABLE " + qn(table) + " ADD COLUMN " +
+                       qn(field.column) + " " + definition)
+        for statement in connection.creation.sql_indexes_for_field(
+                                                model, field, no_style()):
+            cursor.execute(statement)
+        transaction.commit_unless_managed()
+
+
+def createMissingTable(cursor, model, knownModels):
+    """ Create the given model's table and indexes, if necessary.
+
+        'knownModels' is a list of the models whose tables already exist,
+        which the new table may refer to.
+    """
+    table = model._meta.db_table
+    if table in connection.introspection.table_names():
+        return
+
+    print "Creating " + table
+    style = no_style()
+    statements,pending = connection.creation.sql_create_model(
+                                            model, style, set(knownModels))
+    statements.extend(connection.creation.sql_indexes_for_model(model,
+                                                                style))
+    for statement in statements:
+        cursor.execute(statement)
+    transaction.commit_unless_managed()
+
+#############################################################################
+#
+# Private definitions:
+
+# The columns which have been added to the Shapefile table, and the SQL
+# definition to use when adding each column.
+
+_SHAPEFILE_COLUMNS = [("fingerprint",  "varchar(40) NOT NULL DEFAULT ''"),
+                      ("version",      "integer NOT NULL DEFAULT 0"),
+                      ("min_x",        "double precision NULL"),
+                      ("min_y",        "double precision NULL"),
+                      ("max_x",        "double precision NULL"),
+                      ("max_y",        "double precision NULL"),
+                      ("num_features", "integer NOT NULL DEFAULT 0"),
+                      ("num_vertices", "bigint NOT NULL DEFAULT 0"),
+                      ("modified",     "timestamp with time zone " +
+                                       "NOT NULL DEFAULT now()"),
+                      ("deleting",     "boolean NOT NULL DEFAULT false")]
@@ -1,22 +1,147 @@
 # Model definition for the ShapeEditor's database objects.
 
 from django.contrib.gis.db import models
+from django.contrib.gis.geos import Polygon
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import signals
+
+import datetime
+import functools
+import json
+import time
 
 #############################################################################
 
 class Shapefile(models.Model):
     """ The Shapefile object holds all the features imported from a single
         shapefile.
+
+        The 'fingerprint' field identifies the contents of the uploaded
+        shapefile, so that we can tell when the same shapefile is uploaded
+        again.  Because the fingerprint only describes the shapefile as it
+        was uploaded, it is cleared as soon as the shapefile is edited.
+
+        The 'version' field is incremented every time the shapefile's
+        features are edited.
+
+        The remaining fields hold summary statistics about the shapefile's
+        features, so that they can be displayed without scanning through
+        the features themselves.  They are calculated when the shapefile is
+        imported, and kept up to date as the features are edited.  Note that
+        the shapefile's extent only ever grows: deleting a feature doesn't
+        shrink the extent.  The extent is None if the shapefile has no
+        features.
+
+        The 'deleting' field is set while a large shapefile is being deleted
+        in the background.  Such shapefiles are no longer shown to the user.
     """
-    filename  = models.CharField(max_length=255)
-    srs_wkt   = models.CharField(max_length=255)
-    geom_type = models.CharField(max_length=50)
-    encoding  = models.CharField(max_length=20)
+    filename     = models.CharField(max_length=255)
+    srs_wkt      = models.CharField(max_length=255)
+    geom_type    = models.CharField(max_length=50)
+    encoding     = models.CharField(max_length=20)
+    fingerprint  = models.CharField(max_length=40, blank=True, db_index=True)
+    version      = models.IntegerField(default=0)
+    min_x        = models.FloatField(null=True, blank=True)
+    min_y        = models.FloatField(null=True, blank=True)
+    max_x        = models.FloatField(null=True, blank=True)
+    max_y        = models.FloatField(null=True, blank=True)
+    num_features = models.IntegerField(default=0)
+    num_vertices = models.BigIntegerField(default=0)
+    modified     = models.DateTimeField(default=datetime.datetime.now)
+    deleting     = models.BooleanField(default=False)
 
 
     def __unicode__(self):
         return self.filename
 
+
+    def getExtent(self):
+        """ Return the extent of this shapefile's features.
+
+            We return a (minX, minY, maxX, maxY) tuple, in WGS84 coordinates,
+            or None if the shapefile has no features.
+        """
+        if self.min_x == None:
+            return None
+        return (self.min_x, self.min_y, self.max_x, self.max_y)
+
+
+    def markEdited(self, numFeatures=0, numVertices=0, extent=None):
+        """ Record the fact that this shapefile's features have been edited.
+
+            'numFeatures' and 'numVertices' are the number of features and
+            vertices which were added to the shapefile (or removed, if
+            negative), and 'extent' is the (minX, minY, maxX, maxY) extent
+            of the new or changed features, or None.  We update the
+            shapefile's statistics using a single statement, so that
+            simultaneous edits don't overwrite each other's changes.
+        """
+        if extent == None:
+            extent = (None, None, None, None)
+
+        qn = connection.ops.quote_name
+
+        cursor = connection.cursor()
+        cursor.execute("UPDATE " + qn(Shapefile._meta.db_table) +
+                       " SET fingerprint = '', version = version + 1, " +
+                       "num_features = num_features + %s, " +
+                       "num_vertices = num_vertices + %s, " +
+                       "min_x = LEAST(min_x, %s), " +
+                       "min_y = LEAST(min_y, %s), " +
+                       "max_x = GREATEST(max_x, %s), " +
+                       "max_y = GREATEST(max_y, %s), " +
+                       "modified = %s WHERE id = %s " +
+                       "RETURNING version, num_features, num_vertices, " +
+                       "min_x, min_y, max_x, max_y, modified",
+                       [numFeatures, numVertices] + list(extent) +
+                       [datetime.datetime.now(), self.id])
+        row = cursor.fetchone()
+        transaction.commit_unless_managed()
+        shapefileListChanged()
+
+        self.fingerprint = ""
+        (self.version, self.num_features, self.num_vertices,
+         self.min_x, self.min_y, self.max_x, self.max_y,
+         self.modified) = row
+
+
+    def recordChange(self, featureId, change, oldGeometry=None,
+                     newGeometry=None):
+        """ Record a change to one of this shapefile's features.
+
+            'featureId' is the record ID of the feature which was changed,
+            and 'change' is the type of change, one of FeatureChange.INSERT,
+            FeatureChange.UPDATE or FeatureChange.DELETE.  'oldGeometry' and
+            'newGeometry' are the feature's geometry before and after the
+            change, as GEOSGeometry objects (or None if the feature didn't
+            exist before or after the change).
+
+            We mark the shapefile as edited, updating its statistics to
+            match, and add the change to the shapefile's change journal,
+            tagged with the shapefile's new version number.
+        """
+        if change == FeatureChange.INSERT:
+            numFeatures = 1
+        elif change == FeatureChange.DELETE:
+            numFeatures = -1
+        else:
+            numFeatures = 0
+
+        numVertices = 0
+        extent      = None
+        if oldGeometry != None:
+            numVertices = numVertices - oldGeometry.num_coords
+        if newGeometry != None:
+            numVertices = numVertices + newGeometry.num_coords
+            extent      = newGeometry.extent
+
+        self.markEdited(numFeatures, numVertices, extent)
+        FeatureChange.objects.create(shapefile=self,
+                                     feature_id=featureId,
+                                     version=self.version,
+                                     change=change)
+
 #############################################################################
 
 class Attribute(models.Model):
@@ -24,12 +149,16 @@ class Attribute(models.Model):
 
         Note that there will be one of these for each of the shapefile's
         attribute definitions.
+
+        The 'indexed' field is True if a database index has been created
+        for this attribute; see featureStore.createAttributeIndex().
     """
     shapefile = models.ForeignKey(Shapefile)
     name      = models.CharField(max_length=255)
     type      = models.IntegerField()
     width     = models.IntegerField()
     precision = models.IntegerField()
+    indexed   = models.BooleanField(default=False)
 
 
     def __unicode__(self):
@@ -37,6 +166,37 @@ class Attribute(models.Model):
 
 #############################################################################
 
+class JSONField(models.TextField):
+    """ A field which stores a dictionary as a JSON object.
+
+        The dictionary is stored in a PostgreSQL "jsonb" column, so that the
+        database can look inside it when selecting features.
+    """
+    __metaclass__ = models.SubfieldBase
+
+    def db_type(self, connection=None):
+        return "jsonb"
+
+
+    def to_python(self, value):
+        if value == None or isinstance(value, dict):
+            return value
+        if value == "":
+            return {}
+        return json.loads(value)
+
+
+    def get_prep_value(self, value):
+        if value == None:
+            return None
+        return json.dumps(value)
+
+
+    def value_to_string(self, obj):
+        return self.get_prep_value(self._get_val_from_obj(obj))
+
+#############################################################################
+
 class Feature(models.Model):
     """ The Feature object holds a single geographic feature imported from
         the Shapefile.
@@ -44,23 +204,27 @@ class Feature(models.Model):
         Note that there is a many-to-one relationship between features and
         shapefiles -- that is, each shapefile can have multiple features.
 
-        Because we don't know what type of geometry we will be storing, we
-        define separate fields for each of the geometry types the user can
-        edit.
+        Every feature's geometry is stored in the same 'geometry' field,
+        whatever its type.  The 'geometry_type' field holds the type of the
+        stored geometry, for example "MultiPolygon", and the 'bbox' field
+        holds the geometry's bounding box as a polygon.  Both are calculated
+        automatically whenever the feature is saved.  As well as the spatial
+        indexes on 'geometry' and 'bbox', the database has a combined index
+        on the feature's shapefile and geometry (see sql/feature.sql), so
+        that every query for the features in part of a shapefile can use a
+        single index.
+
+        The feature's attribute values are stored in the 'attributes' field,
+        as a dictionary mapping each attribute's name to its value.  Each
+        value is stored using the attribute's declared type, as produced by
+        the attributeCodecs module; attributes which aren't set are left
+        out.
     """
-    shapefile               = models.ForeignKey(Shapefile)
-    geom_singlepoint              = models.PointField(srid=4326, null=True,
-                                                blank=True)
-    geom_multipoint         = models.MultiPointField(srid=4326, null=True,
-                                                     blank=True)
-    geom_multilinestring    = models.MultiLineStringField(srid=4326,
-                                                          null=True,
-                                                          blank=True)
-    geom_multipolygon       = models.MultiPolygonField(srid=4326,
-                                                       null=True, blank=True)
-    geom_geometrycollection = models.GeometryCollectionField(srid=4326,
-                                                             null=True,
-                                                             blank=True)
+    shapefile     = models.ForeignKey(Shapefile)
+    geometry      = models.GeometryField(srid=4326)
+    geometry_type = models.CharField(max_length=50)
+    bbox          = models.PolygonField(srid=4326)
+    attributes    = JSONField(default=dict)
 
     # The following is required to do spatial queries on Features.
 
@@ -68,30 +232,55 @@ class Feature(models.Model):
 
 
     def __unicode__(self):
-        for geom in [self.geom_singlepoint, self.geom_multipoint,
-                     self.geom_multilinestring, self.geom_multipolygon,
-                     self.geom_geometrycollection]:
-            if geom != None:
-                return str(geom)
+        if self.geometry != None:
+            return str(self.geometry)
         return "id " + str(self.id)
 
+
+    def save(self, *args, **kwargs):
+        """ Save the feature, updating its geometry type and bounding box.
+        """
+        self.updateGeometryInfo()
+        super(Feature, self).save(*args, **kwargs)
+
+
+    def updateGeometryInfo(self):
+        """ Calculate the feature's geometry type and bounding box.
+        """
+        if self.geometry != None:
+            self.geometry_type = self.geometry.geom_type
+            self.bbox = Polygon.from_bbox(self.geometry.extent)
+            self.bbox.srid = 4326
+
 #############################################################################
 
-class AttributeValue(models.Model):
-    """ The AttributeValue object holds a single attribute value for a
-        geographic feature.
+class FeatureChange(models.Model):
+    """ A single entry in a shapefile's change journal.
 
-        Note that there is a many-to-one relationship between attributes and
-        features -- that is, each feature can have multiple attributes.
-        Similarly, the AttributeValue links to the Attribute the value is for.
+        We record a FeatureChange whenever a feature is inserted, updated or
+        deleted.  The 'version' field holds the shapefile's version number
+        once the change was made, which lets us find all the features which
+        have changed since a given version of the shapefile.
+
+        Because the journal also records deleted features, 'feature_id' is
+        simply the changed feature's record ID rather than a foreign key.
     """
-    feature   = models.ForeignKey(Feature)
-    attribute = models.ForeignKey(Attribute)
-    value     = models.CharField(max_length=255, null=True)
+    INSERT = "insert"
+    UPDATE = "update"
+    DELETE = "delete"
+
+    CHANGE_TYPES = ((INSERT, "Inserted"),
+                    (UPDATE, "Updated"),
+                    (DELETE, "Deleted"))
+
+    shapefile  = models.ForeignKey(Shapefile)
+    feature_id = models.IntegerField()
+    version    = models.IntegerField(db_index=True)
+    change     = models.CharField(max_length=6, choices=CHANGE_TYPES)
 
 
     def __unicode__(self):
-        return self.value
+        return "%s %d" % (self.change, self.feature_id)
 
 #############################################################################
 
@@ -109,3 +298,66 @@ class BaseMap(models.Model):
 
     def __unicode__(self):
         return self.name
+
+#############################################################################
+
+def getShapefileListVersion():
+    """ Return the current version number of the list of shapefiles.
+
+        The version number is kept in Django's cache, and changes whenever
+        a shapefile is added, edited or deleted.  Anything derived from the
+        list of shapefiles can be cached under this version number, and will
+        no longer be found once the list changes.
+    """
+    version = cache.get(_LIST_VERSION_KEY)
+    if version == None:
+        # Start from the current time, so that we don't reuse the version
+        # numbers of anything which is still in the cache.
+        cache.add(_LIST_VERSION_KEY, int(time.time() * 1000))
+        version = cache.get(_LIST_VERSION_KEY)
+    return version
+
+
+def shapefileListChanged(**kwargs):
+    """ Record the fact that the list of shapefiles has changed.
+
+        This is called whenever a Shapefile is saved or deleted, and should
+        also be called after changing Shapefile records without going
+        through the Django ORM.
+    """
+    try:
+        cache.incr(_LIST_VERSION_KEY)
+    except ValueError:
+        pass # No version yet; a new one will be chosen when it is needed.
+
+
+def changesShapefileList(func):
+    """ Decorator for functions which change the list of shapefiles.
+
+        Changes made within a transaction can't be seen until the
+        transaction has been committed.  If the list's version number were
+        bumped before then, a simultaneous request could cache the old list
+        under the new version number.  This decorator should therefore be
+        applied outside transaction.commit_on_success, so that the version
+        number is bumped after the decorated function's changes have been
+        committed.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            shapefileListChanged()
+    return wrapper
+
+
+signals.post_save.connect(shapefileListChanged, sender=Shapefile)
+signals.post_delete.connect(shapefileListChanged, sender=Shapefile)
+
+#############################################################################
+#
+# Private definitions:
+
+# The cache key holding the version number of the list of shapefiles.
+
+_LIST_VERSION_KEY = "shapeEditor-shapefileListVersion"
@@ -5,8 +5,12 @@
 
 from django import forms
 from django.contrib.gis import admin
+from django.contrib.gis.db import models
 
 from models import Feature
+
+import threading
+
 import utils
 
 #############################################################################
@@ -17,60 +21,68 @@ import utils
 class OurGeoModelAdmin(admin.GeoModelAdmin):
     map_template = 'ourOpenlayers.html'
 
-# The following classes tell GeoDjango how to setup an admin interface for a
-# Feature while editing various feature types.
+# The geometry fields used to set up the map widget for each type of
+# geometry.  Because every feature's geometry is stored in the same generic
+# Feature.geometry field, these fields aren't stored anywhere; they simply
+# tell GeoDjango which type of geometry the map widget should edit.
 
-class PointAdmin(OurGeoModelAdmin):
-    fields = ['geom_singlepoint']
+_MAP_FIELDS = {
+    "Point"              : models.PointField(srid=4326),
+    "LineString"         : models.LineStringField(srid=4326),
+    "Polygon"            : models.PolygonField(srid=4326),
+    "MultiPoint"         : models.MultiPointField(srid=4326),
+    "MultiLineString"    : models.MultiLineStringField(srid=4326),
+    "MultiPolygon"       : models.MultiPolygonField(srid=4326),
+    "GeometryCollection" : models.GeometryCollectionField(srid=4326),
+}
 
-class LineStringAdmin(OurGeoModelAdmin):
-    fields = ['geom_linestring']
+for field in _MAP_FIELDS.values():
+    field.set_attributes_from_name("geometry")
 
-class PolygonAdmin(OurGeoModelAdmin):
-    fields = ['geom_polygon']
+#############################################################################
 
-class MultiPointAdmin(OurGeoModelAdmin):
-    fields = ['geom_multipoint']
+def getMapForm(shapefile):
+    """ Return a form.Form subclass for editing the given shapefile's features.
 
-class MultiLineStringAdmin(OurGeoModelAdmin):
-    fields = ['geom_multilinestring']
+        The form will have a single field, 'geometry', which lets the user edit
+        the feature's geometry.
+
+        Generating the map widget and form classes is relatively expensive,
+        and the classes only depend on the shapefile's type of geometry, so
+        we generate them once for each type of geometry and then reuse them.
+    """
+    geometryType = utils.calcGeometryFieldType(shapefile.geom_type)
 
-class MultiPolygonAdmin(OurGeoModelAdmin):
-    fields = ['geom_multipolygon']
+    if geometryType in _mapForms:
+        return _mapForms[geometryType]
 
-class GeometryCollectionAdmin(OurGeoModelAdmin):
-    fields = ['geom_geometrycollection']
+    _mapFormLock.acquire()
+    try:
+        if geometryType not in _mapForms:
+            _mapForms[geometryType] = _makeMapForm(geometryType)
+        return _mapForms[geometryType]
+    finally:
+        _mapFormLock.release()
 
 #############################################################################
+#
+# Private definitions:
 
-def getMapForm(shapefile):
-    """ Return a form.Form subclass for editing the given shapefile's features.
+# Our cache of map form classes, as used by getMapForm().  This maps each
+# type of geometry to the form class to use for editing that type of
+# geometry.
 
-        The form will have a single field, 'geometry', which lets the user edit
-        the feature's geometry.
+_mapForms    = {}
+_mapFormLock = threading.Lock()
+
+
+def _makeMapForm(geometryType):
+    """ Generate the map form class for editing the given type of geometry.
     """
     # Setup a dummy admin instance to auto-generate our map widget.
 
-    geometryField = utils.calcGeometryField(shapefile.geom_type)
-    geometryType  = utils.calcGeometryFieldType(shapefile.geom_type)
-
-    if geometryType == "Point":
-        adminType = PointAdmin
-    elif geometryType == "LineString":
-        adminType = LineStringAdmin
-    elif geometryType == "Polygon":
-        adminType = PolygonAdmin
-    elif geometryType == "MultiPoint":
-        adminType = MultiPointAdmin
-    elif geometryType == "MultiLineString":
-        adminType = MultiLineStringAdmin
-    elif geometryType == "MultiPolygon":
-        adminType = MultiPolygonAdmin
-    elif geometryType == "GeometryCollection":
-        adminType = GeometryCollectionAdmin
-
-    adminInstance = adminType(Feature, admin.site)
-    field  = Feature._meta.get_field(geometryField)
+    adminInstance = OurGeoModelAdmin(Feature, admin.site)
+    field  = _MAP_FIELDS[geometryType]
 
     widgetType = adminInstance.get_map_widget(field)
 
@@ -81,4 +93,3 @@ def getMapForm(shapefile):
                                    label="")
 
     return MapForm
-
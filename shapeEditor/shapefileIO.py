@@ -4,14 +4,16 @@
 # into our database.
 
 from geoedit.shapeEditor.models import Shapefile, Attribute
-from geoedit.shapeEditor.models import Feature, AttributeValue
 
 from django.contrib.gis.geos.geometry import GEOSGeometry
-from django.core.servers.basehttp import FileWrapper
 from django.http import HttpResponse
+from django import db
 
 from osgeo import ogr,osr
 
+import array
+import hashlib
+import json
 import os
 import os.path
 import shutil
@@ -19,17 +21,53 @@ import tempfile
 import traceback
 import zipfile
 
+import attributeCodecs
+import dbfReader
+import featureStore
+import flatgeobuf
+import shpReader
 import utils
+import zipStream
 
 #############################################################################
 
-def importData(shapefile, characterEncoding):
+# The number of features to read, convert and save at once when importing a
+# shapefile.  This bounds the amount of memory used by the import, no matter
+# how many features the shapefile contains.
+
+IMPORT_BATCH_SIZE = 1000
+
+# The number of bytes to copy at once when decompressing an uploaded
+# shapefile.
+
+COPY_CHUNK_SIZE = 65536
+
+#############################################################################
+
+def importData(shapefile, characterEncoding, duplicateAction="import"):
     """ Attempt to import the contents of a shapefile into our database.
 
         'shapefile' is the Django UploadedFile object that was uploaded, and
         'characterEncoding' is the character encoding to use for interpreting
         the shapefile's string attributes.
 
+        'duplicateAction' tells us what to do if the same shapefile has
+        already been imported (using the same character encoding), and hasn't
+        been edited since.  This can be one of the following:
+
+            "import"
+
+                Import the shapefile again, as usual.
+
+            "clone"
+
+                Make a copy of the existing shapefile within the database,
+                rather than importing the uploaded shapefile.
+
+            "link"
+
+                Don't import anything, and simply use the existing shapefile.
+
         We return None if the import succeeded.  Otherwise we return a string
         containing a suitable error message explaining why the shapefile can't
         be imported.
@@ -71,21 +109,55 @@ def importData(shapefile, characterEncoding):
             return "Archive missing required " + suffix + " file."
 
     # Decompress the zip archive into a temporary directory.  At the same
-    # time, we get the name of the main ".shp" file.
+    # time, we get the name of the main ".shp" file and its ".shx" and ".dbf"
+    # files, and calculate a digest of the contents of each file as it is
+    # decompressed.
 
     zip = zipfile.ZipFile(fname)
     shapefileName = None
+    shxName = None
+    dbfName = None
+    digests = {}
     dirname = tempfile.mkdtemp()
     for info in zip.infolist():
         if info.filename.endswith(".shp"):
             shapefileName = info.filename
+        if info.filename.lower().endswith(".shx"):
+            shxName = info.filename
+        if info.filename.lower().endswith(".dbf"):
+            dbfName = info.filename
 
+        digest = hashlib.sha1()
+        src = zip.open(info)
         dstFile = os.path.join(dirname, info.filename)
         f = open(dstFile, "wb")
-        f.write(zip.read(info.filename))
+        while True:
+            chunk = src.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            f.write(chunk)
         f.close()
+        src.close()
+
+        extension = os.path.splitext(info.filename)[1].lower()
+        digests[extension] = digest.hexdigest()
     zip.close()
 
+    # See if this shapefile has been imported before.  If so, we may be able
+    # to avoid importing it again.
+
+    fingerprint = _calcFingerprint(digests)
+
+    if duplicateAction != "import":
+        original = _findDuplicate(fingerprint, characterEncoding)
+        if original != None:
+            os.remove(fname)
+            shutil.rmtree(dirname)
+            if duplicateAction == "clone":
+                featureStore.cloneShapefile(original)
+            return None
+
     # Attempt to open the shapefile.
 
     try:
@@ -106,14 +178,18 @@ def importData(shapefile, characterEncoding):
     geometryType  = layer.GetLayerDefn().GetGeomType()
     geometryName  = utils.ogrTypeToGeometryName(geometryType)
     srcSpatialRef = layer.GetSpatialRef()
-    dstSpatialRef = osr.SpatialReference()
-    dstSpatialRef.ImportFromEPSG(4326)
+
+    # The shapefile is given its fingerprint once the import has finished,
+    # so that a simultaneous upload of the same shapefile can't find and
+    # reuse a half-imported copy.
 
     shapefile = Shapefile(filename=shapefileName,
                           srs_wkt=srcSpatialRef.ExportToWkt(),
                           geom_type=geometryName,
-                          encoding=characterEncoding)
+                          encoding=characterEncoding,
+                          fingerprint="")
     shapefile.save()
+    featureStore.createPartition(shapefile)
 
     attributes = []
     layerDef = layer.GetLayerDefn()
@@ -127,132 +203,583 @@ def importData(shapefile, characterEncoding):
         attr.save()
         attributes.append(attr)
 
-    coordTransform = osr.CoordinateTransformation(srcSpatialRef,
-                                                  dstSpatialRef)
-
-    for i in range(layer.GetFeatureCount()):
-        srcFeature = layer.GetFeature(i)
-        srcGeometry = srcFeature.GetGeometryRef()
-        srcGeometry.Transform(coordTransform)
-        geometry = GEOSGeometry(srcGeometry.ExportToWkt())
-        geometry = utils.wrapGEOSGeometry(geometry)
-        geometryField = utils.calcGeometryField(geometryName)
-        args = {}
-        args['shapefile'] = shapefile
-        args[geometryField] = geometry
-        feature = Feature(**args)
-        feature.save()
+    # Note that coordTransform will be None if the shapefile is already in
+    # WGS84, in which case we don't need to transform the geometries at all.
+
+    coordTransform = utils.calcCoordTransform(shapefile.srs_wkt)
 
+    # Wherever possible, we read the geometries and attribute values directly
+    # from the ".shp" and ".dbf" files.  Anything which can't be read in this
+    # way is read from the OGR features instead.
+
+    decoders = attributeCodecs.compileDecoders(attributes, layerDef,
+                                               characterEncoding)
+
+    try:
+        shp = shpReader.ShapeReader(os.path.join(dirname, shapefileName),
+                                    os.path.join(dirname, shxName))
+    except shpReader.ShapeError:
+        traceback.print_exc()
+        shp = None
+
+    try:
+        dbf = dbfReader.DBFReader(os.path.join(dirname, dbfName))
+        columns = []
         for attr in attributes:
-            success,result = \
-                    utils.getOGRFeatureAttribute(attr, srcFeature,
-                                                 characterEncoding)
-            if not success:
-                os.remove(fname)
-                shutil.rmtree(dirname)
-                shapefile.delete()
-                return result
-
-            attrValue = AttributeValue(feature=feature,
-                                       attribute=attr,
-                                       value=result)
-            attrValue.save()
+            columns.append(dbf.compileColumn(attr, characterEncoding))
+    except dbfReader.DBFError:
+        traceback.print_exc()
+        dbf = None
+        columns = [None] * len(attributes)
+
+    # Stream the features through our import pipeline, one batch at a time.
+
+    batches = _readRecords(layer, shp, dbf)
+    batches = _readGeometries(batches, layer, shp, coordTransform)
+    batches = _convertAttributes(batches, layer, decoders, columns)
+
+    errMsg = None
+    try:
+        for batch in batches:
+            featureStore.insertFeatures(shapefile, attributes,
+                                        [(record.geometry, record.values)
+                                         for record in batch])
+            db.reset_queries() # Don't let DEBUG mode log every batch.
+        featureStore.updateStatistics(shapefile)
+        featureStore.recordImport(shapefile)
+        Shapefile.objects.filter(id=shapefile.id).update(
+                                                fingerprint=fingerprint)
+        shapefile.fingerprint = fingerprint
+    except _ImportError, e:
+        errMsg = str(e)
+        featureStore.deleteShapefile(shapefile)
 
     # Finally, clean everything up.
 
+    if dbf != None:
+        dbf.close()
+    if shp != None:
+        shp.close()
     os.remove(fname)
     shutil.rmtree(dirname)
 
-    return None # success.
+    return errMsg # None on success.
 
 #############################################################################
 
-def exportData(shapefile):
+def exportData(shapefile, compress=True, featureFilter=None):
     """ Export the contents of the given shapefile.
 
-        'shapefile' is the Shapefile object to export.
+        'shapefile' is the Shapefile object to export.  If 'compress' is
+        False, the exported files are stored in the ZIP archive without
+        being compressed, which is quicker to generate but slower to
+        download.  If 'featureFilter' is not None, it should be a
+        FeatureFilter object selecting the features to export.
+
+        We return a Django HttpResponse object which sends the shapefile's
+        contents to the user's web browser as a ZIP archive.  Note that the
+        archive is generated on the fly while the response is being sent, so
+        the user doesn't have to wait for the entire shapefile to be exported
+        before the download starts.
+    """
+    shapefileName = os.path.splitext(shapefile.filename)[0]
+
+    response = HttpResponse(generateExport(shapefile, compress,
+                                           featureFilter),
+                            content_type="application/zip")
+    response['Content-Disposition'] = "attachment; filename=" \
+                                    + shapefileName + ".zip"
+    return response
+
+#############################################################################
+
+def generateExport(shapefile, compress=True, featureFilter=None):
+    """ Generate a zipped copy of the given shapefile.
+
+        'shapefile' is the Shapefile object to export, and 'compress' is True
+        if the exported files should be compressed.  If 'featureFilter' is
+        not None, only the features selected by that filter are exported.
 
         We create a shapefile which holds the contents of the given shapefile,
-        then copy the shapefile into a temporary zip archive.  Upon completion,
-        we return a Django HttpResponse object which can be used to send the
-        zipped shapefile to the user's web browser.
+        and yield the chunks of a ZIP archive containing that shapefile.  Each
+        of the shapefile's component files is added to the archive as soon as
+        OGR has finished writing it.
     """
+    archive = zipStream.ZipStream(compress)
+
     # Create an OGR shapefile to hold the data we're exporting.
 
     dstDir = tempfile.mkdtemp()
-    dstFile = str(os.path.join(dstDir, shapefile.filename))
+    try:
+        dstFile = str(os.path.join(dstDir, shapefile.filename))
 
-    srcSpatialRef = osr.SpatialReference()
-    srcSpatialRef.ImportFromEPSG(4326)
+        dstSpatialRef = osr.SpatialReference()
+        dstSpatialRef.ImportFromWkt(shapefile.srs_wkt)
 
-    dstSpatialRef = osr.SpatialReference()
-    dstSpatialRef.ImportFromWkt(shapefile.srs_wkt)
+        coordTransform = utils.calcCoordTransform(shapefile.srs_wkt,
+                                                  toWGS84=False)
 
-    coordTransform = osr.CoordinateTransformation(srcSpatialRef,
-                                                  dstSpatialRef)
+        driver = ogr.GetDriverByName("ESRI Shapefile")
+        datasource = driver.CreateDataSource(dstFile)
+        layer = datasource.CreateLayer(str(shapefile.filename),
+                                       dstSpatialRef)
 
-    driver = ogr.GetDriverByName("ESRI Shapefile")
-    datasource = driver.CreateDataSource(dstFile)
-    layer = datasource.CreateLayer(str(shapefile.filename),
-                                   dstSpatialRef)
+        # OGR writes the ".prj" file as soon as the layer is created, so we
+        # can start sending the archive straight away.
 
-    # Define the various fields which will hold our attributes.
+        sent = set()
+        for fName in sorted(os.listdir(dstDir)):
+            if fName.lower().endswith(".prj"):
+                for chunk in archive.addFile(os.path.join(dstDir, fName),
+                                             fName):
+                    yield chunk
+                sent.add(fName)
 
-    for attr in shapefile.attribute_set.all():
-        field = ogr.FieldDefn(str(attr.name), attr.type)
-        field.SetWidth(attr.width)
-        field.SetPrecision(attr.precision)
-        layer.CreateField(field)
+        # Define the various fields which will hold our attributes.
+
+        attributes = list(shapefile.attribute_set.all())
+        for attr in attributes:
+            field = ogr.FieldDefn(str(attr.name), attr.type)
+            field.SetWidth(attr.width)
+            field.SetPrecision(attr.precision)
+            layer.CreateField(field)
 
-    # Save the feature geometries and attributes into the shapefile.
+        featureDefn = layer.GetLayerDefn()
+        encoders = attributeCodecs.compileEncoders(attributes, featureDefn,
+                                                   shapefile.encoding)
+        encoders = dict(zip([attr.name for attr in attributes], encoders))
 
-    geomField = utils.calcGeometryField(shapefile.geom_type)
+        # Save the feature geometries and attributes into the shapefile.
+        # Note that we stream the features out of the database rather than
+        # loading them all at once.
 
-    for feature in shapefile.feature_set.all():
-        geometry = getattr(feature, geomField)
-        geometry = utils.unwrapGEOSGeometry(geometry)
-        dstGeometry = ogr.CreateGeometryFromWkt(geometry.wkt)
-        dstGeometry.Transform(coordTransform)
+        for featureId,wkb,values in featureStore.iterFeatures(shapefile,
+                                                              featureFilter):
+            dstGeometry = ogr.CreateGeometryFromWkb(str(wkb))
+            dstGeometry = utils.unwrapOGRGeometry(dstGeometry)
+            if coordTransform != None:
+                dstGeometry.Transform(coordTransform)
 
-        dstFeature = ogr.Feature(layer.GetLayerDefn())
-        dstFeature.SetGeometry(dstGeometry)
+            dstFeature = ogr.Feature(featureDefn)
+            dstFeature.SetGeometry(dstGeometry)
 
-        for attrValue in feature.attributevalue_set.all():
-            utils.setOGRFeatureAttribute(attrValue.attribute,
-                                         attrValue.value,
-                                         dstFeature,
-                                         shapefile.encoding)
+            for name,value in values.items():
+                encode = encoders[name]
+                encode(dstFeature, value)
 
-        layer.CreateFeature(dstFeature)
-        dstFeature.Destroy()
+            layer.CreateFeature(dstFeature)
+            dstFeature.Destroy()
 
-    datasource.Destroy() # Close the file, write everything to disk.
+        datasource.Destroy() # Close the file, write everything to disk.
 
-    # Compress the shapefile into a ZIP archive.
+        # Add the rest of the shapefile to the ZIP archive.
 
-    temp = tempfile.TemporaryFile()
-    zip = zipfile.ZipFile(temp, 'w', zipfile.ZIP_DEFLATED)
+        for fName in sorted(os.listdir(dstDir)):
+            if fName not in sent:
+                for chunk in archive.addFile(os.path.join(dstDir, fName),
+                                             fName):
+                    yield chunk
+
+        for chunk in archive.close():
+            yield chunk
+    finally:
+        shutil.rmtree(dstDir) # Clean up our temporary files.
+
+#############################################################################
 
-    shapefileBase = os.path.splitext(dstFile)[0]
+def exportGeoJSON(shapefile, featureFilter=None, sinceVersion=None):
+    """ Export the contents of the given shapefile as GeoJSON.
+
+        We return a Django HttpResponse object which sends the shapefile's
+        features to the user's web browser as newline-delimited GeoJSON,
+        with one GeoJSON Feature object on each line.  The features are sent
+        as they are read from the database, so the recipient can start
+        processing them straight away.
+
+        If 'featureFilter' is not None, it should be a FeatureFilter object
+        selecting the features to export.  If 'sinceVersion' is not None,
+        we only export the features which have changed since that version
+        of the shapefile; see generateGeoJSON() for details.
+
+        The response's "X-ShapeEditor-Version" header holds the shapefile's
+        current version number, which can be passed back as 'sinceVersion'
+        to retrieve any subsequent changes.
+    """
     shapefileName = os.path.splitext(shapefile.filename)[0]
 
-    for fName in os.listdir(dstDir):
-        zip.write(os.path.join(dstDir, fName), fName)
+    response = HttpResponse(generateGeoJSON(shapefile, featureFilter,
+                                            sinceVersion),
+                            content_type="application/x-ndjson")
+    response['Content-Disposition'] = "attachment; filename=" \
+                                    + shapefileName + ".geojsonl"
+    response['X-ShapeEditor-Version'] = str(shapefile.version)
+    return response
 
-    zip.close()
 
-    # Clean up our temporary files.
+def generateGeoJSON(shapefile, featureFilter=None, sinceVersion=None):
+    """ Generate a newline-delimited GeoJSON copy of the given shapefile.
+
+        We yield the generated GeoJSON, a chunk at a time.  The features'
+        geometries are in WGS84 (EPSG:4326) coordinates, as required by the
+        GeoJSON specification.  If 'featureFilter' is not None, only the
+        features selected by that filter are included.
+
+        If 'sinceVersion' is not None, we use the shapefile's change journal
+        to only include the features which have been inserted, updated or
+        deleted since the given version of the shapefile.  Each feature then
+        has an extra "change" member, set to "insert", "update" or "delete".
+        Deleted features have a null geometry and properties.
+    """
+    names = [attr.name for attr in shapefile.attribute_set.all()]
+
+    if sinceVersion == None:
+        features = ((featureId, None, wkb, values)
+                    for featureId,wkb,values
+                    in featureStore.iterFeatures(shapefile, featureFilter))
+    else:
+        features = featureStore.iterChanges(shapefile, sinceVersion)
+
+    chunk = []
+    size  = 0
+    for featureId,change,wkb,values in features:
+        feature = makeGeoJSONFeature(featureId, wkb, values, names)
+        if change != None:
+            feature['change'] = change
+
+        line = json.dumps(feature) + "\n"
+        chunk.append(line)
+        size = size + len(line)
+        if size >= COPY_CHUNK_SIZE:
+            yield "".join(chunk)
+            chunk = []
+            size  = 0
+
+    if size > 0:
+        yield "".join(chunk)
+
+
+def makeGeoJSONFeature(featureId, wkb, values, names):
+    """ Return a GeoJSON Feature object for the given feature.
+
+        'featureId' is the feature's record ID, 'wkb' is the feature's
+        geometry in WKB format (or None), 'values' is a dictionary mapping
+        attribute names to the feature's attribute values, and 'names' is a
+        list of the shapefile's attribute names.  Every attribute is included
+        in the feature's properties, with a null value for the attributes
+        which aren't set.  If 'wkb' is None, the feature's geometry and
+        properties are both null.
+
+        We return the GeoJSON Feature as a dictionary, ready to be converted
+        to JSON.
+    """
+    feature = {'type'       : "Feature",
+               'id'         : featureId,
+               'geometry'   : None,
+               'properties' : None}
+    if wkb != None:
+        properties = dict.fromkeys(names)
+        properties.update(values)
+        feature['geometry']   = _geoJSONGeometry(utils.parseWKB(wkb))
+        feature['properties'] = properties
+    return feature
+
+#############################################################################
+
+def exportFlatGeobuf(shapefile, index=True, featureFilter=None):
+    """ Export the contents of the given shapefile in FlatGeobuf format.
 
-    shutil.rmtree(dstDir)
+        'index' is True if the FlatGeobuf file should include a spatial
+        index, and 'featureFilter' is either None or a FeatureFilter object
+        selecting the features to export.
 
-    # Create an HttpResponse object to send the ZIP file back to the user's web
-    # browser.
+        We return a Django HttpResponse object which sends the FlatGeobuf
+        file to the user's web browser as it is being generated.
+    """
+    shapefileName = os.path.splitext(shapefile.filename)[0]
 
-    f = FileWrapper(temp)
-    response = HttpResponse(f, content_type="application/zip")
+    response = HttpResponse(generateFlatGeobuf(shapefile, index,
+                                               featureFilter),
+                            content_type="application/octet-stream")
     response['Content-Disposition'] = "attachment; filename=" \
-                                    + shapefileName + ".zip"
-    response['Content-Length'] = temp.tell()
-    temp.seek(0)
+                                    + shapefileName + ".fgb"
     return response
 
+
+def generateFlatGeobuf(shapefile, index=True, featureFilter=None):
+    """ Generate a FlatGeobuf copy of the given shapefile.
+
+        If 'index' is True, the generated file will include a packed Hilbert
+        R-tree index, allowing clients to read just the features within a
+        given area.  Note that the index has to be built before any data can
+        be sent.  If 'index' is False, we start sending the file straight
+        away.
+
+        We yield the chunks of data making up the FlatGeobuf file.  As with
+        GeoJSON, the features' geometries are in WGS84 coordinates.  If
+        'featureFilter' is not None, only the features selected by that
+        filter are included.
+    """
+    attributes = list(shapefile.attribute_set.all())
+
+    def features():
+        for featureId,wkb,values in featureStore.iterFeatures(shapefile,
+                                                              featureFilter):
+            yield (wkb, [values.get(attr.name) for attr in attributes])
+
+    writer = flatgeobuf.FlatGeobufWriter(
+                    os.path.splitext(shapefile.filename)[0],
+                    utils.calcGeometryFieldType(shapefile.geom_type),
+                    attributes)
+    return writer.generate(features(), index)
+
+#############################################################################
+#
+# Private definitions:
+
+class _ImportError(Exception):
+    """ Exception raised by our import pipeline if the import fails.
+
+        The exception's message is the error message to show to the user.
+    """
+    pass
+
+#############################################################################
+
+def _calcFingerprint(digests):
+    """ Calculate the fingerprint for an uploaded shapefile.
+
+        'digests' is a dictionary mapping each file extension (".shp", ".dbf",
+        etc.) to the SHA-1 digest of the uploaded file with that extension.
+        We return a fingerprint which identifies the shapefile's ".shp",
+        ".dbf" and ".prj" files, as a string.
+    """
+    fingerprint = hashlib.sha1()
+    for extension in [".shp", ".dbf", ".prj"]:
+        fingerprint.update(extension + "=" + digests[extension] + ";")
+    return fingerprint.hexdigest()
+
+
+def _findDuplicate(fingerprint, characterEncoding):
+    """ Return the previously-imported copy of an uploaded shapefile.
+
+        We look for an unedited shapefile with the given fingerprint, which
+        was imported using the given character encoding.  If there is one,
+        we return the Shapefile object; otherwise, we return None.
+    """
+    duplicates = Shapefile.objects.filter(fingerprint=fingerprint,
+                                          encoding=characterEncoding,
+                                          deleting=False)
+    duplicates = duplicates.order_by("id")[:1]
+    if len(duplicates) == 0:
+        return None
+    return duplicates[0]
+
+#############################################################################
+
+class _ImportRecord(object):
+    """ A single feature passing through our import pipeline.
+
+        'recordNum' is the feature's record number within the shapefile.
+        'geometry' and 'values' are filled in by the pipeline as the feature
+        is processed.
+    """
+    def __init__(self, recordNum, srcFeature=None):
+        self.recordNum  = recordNum
+        self.srcFeature = srcFeature
+        self.geometry   = None
+        self.values     = None
+
+
+    def getSrcFeature(self, layer):
+        """ Return the OGR feature for this record, reading it if necessary.
+        """
+        if self.srcFeature == None:
+            self.srcFeature = layer.GetFeature(self.recordNum)
+        return self.srcFeature
+
+#############################################################################
+
+def _readRecords(layer, shp, dbf):
+    """ Read the records in a shapefile, in batches.
+
+        This generator is the first stage of our import pipeline.  We yield
+        a list of _ImportRecord objects for each batch of up to
+        IMPORT_BATCH_SIZE features.
+
+        The records are returned in order of the Hilbert value of the centre
+        of each feature's bounding box, so that features which are close
+        together in space are stored close together on disk.  This means
+        that a tile or bounding box query only has to read a few of the
+        Feature table's pages, rather than pages scattered right across the
+        table.
+
+        This ordering is only used when we can read the shapefile directly.
+        We then step through the record numbers in the ".dbf" file, and get
+        the centre of each feature from its record header in the ".shp"
+        file, so only the record numbers and their Hilbert values are kept
+        in memory; the features themselves are read later on, as they are
+        needed.
+
+        Otherwise, we read through the OGR layer once, returning the records
+        in their original order along with the OGR features we have read.
+        Sorting these records would mean reading every feature a second
+        time, one random-access lookup at a time, so the features are left
+        unclustered; the "clusterfeatures" management command can be used to
+        sort them afterwards.
+    """
+    if (shp == None or dbf == None or
+        shp.numRecords != dbf.numRecords):
+        batch = []
+        layer.ResetReading()
+        while True:
+            srcFeature = layer.GetNextFeature()
+            if srcFeature == None:
+                break
+            batch.append(_ImportRecord(srcFeature.GetFID(), srcFeature))
+            if len(batch) == IMPORT_BATCH_SIZE:
+                yield batch
+                batch = []
+
+        if len(batch) > 0:
+            yield batch
+        return
+
+    recordNums = array.array("l")
+    hilbertValues = array.array("L")
+
+    extent = shp.extent
+    for recordNum in dbf.iterRecordNums():
+        recordNums.append(recordNum)
+        hilbertValues.append(_calcHilbertValue(shp.readCentre(recordNum),
+                                               extent))
+
+    order = sorted(xrange(len(recordNums)), key=hilbertValues.__getitem__)
+
+    batch = []
+    for i in order:
+        batch.append(_ImportRecord(recordNums[i]))
+        if len(batch) == IMPORT_BATCH_SIZE:
+            yield batch
+            batch = []
+
+    if len(batch) > 0:
+        yield batch
+
+
+def _calcHilbertValue(centre, extent):
+    """ Return the Hilbert value to use for sorting an imported feature.
+
+        'centre' is the (x, y) centre of the feature's bounding box, or None
+        if the feature has no geometry, and 'extent' is the shapefile's
+        extent, both in the shapefile's own coordinates.
+    """
+    if centre == None:
+        return 0
+    x,y = centre
+    return utils.calcHilbertValue(x, y, extent)
+
+
+def _readGeometries(batches, layer, shp, coordTransform):
+    """ Read the geometry for each record in the given batches.
+
+        This generator is the second stage of our import pipeline.  For each
+        batch, we read each record's geometry, transform it into WGS84 if
+        necessary, and store it into the record as a GEOSGeometry object.
+    """
+    for batch in batches:
+        wkbs = None
+        if shp != None:
+            try:
+                wkbs = shp.readGeometries([record.recordNum
+                                           for record in batch])
+            except shpReader.ShapeError:
+                wkbs = None # Fall back to using OGR.
+
+        for i,record in enumerate(batch):
+            if wkbs == None or wkbs[i] is shpReader.FALLBACK:
+                srcGeometry = record.getSrcFeature(layer).GetGeometryRef()
+                if srcGeometry == None:
+                    raise _ImportError("Shapefile contains a feature " +
+                                       "without a geometry.")
+            elif coordTransform != None:
+                srcGeometry = ogr.CreateGeometryFromWkb(wkbs[i])
+            else:
+                geometry = GEOSGeometry(buffer(wkbs[i]))
+                record.geometry = utils.wrapGEOSGeometry(geometry)
+                continue
+
+            if coordTransform != None:
+                srcGeometry.Transform(coordTransform)
+            geometry = GEOSGeometry(srcGeometry.ExportToWkt())
+            record.geometry = utils.wrapGEOSGeometry(geometry)
+
+        yield batch
+
+
+def _convertAttributes(batches, layer, decoders, columns):
+    """ Extract the attribute values for each record in the given batches.
+
+        This generator is the third stage of our import pipeline.  'decoders'
+        is the list of attribute decoders to use for reading attributes from
+        the OGR features, and 'columns' is a parallel list of functions for
+        reading each attribute directly from the ".dbf" file (or None if the
+        attribute has to be read via OGR).
+
+        Once a record's attribute values have been extracted, we no longer
+        need its OGR feature, so we release it to save memory.
+    """
+    for batch in batches:
+        recordNums = [record.recordNum for record in batch]
+
+        columnValues = []
+        for column in columns:
+            values = None
+            if column != None:
+                try:
+                    values = column(recordNums)
+                except dbfReader.DBFError:
+                    values = None # Fall back to using OGR.
+            columnValues.append(values)
+
+        for i,record in enumerate(batch):
+            record.values = []
+            for decode,values in zip(decoders, columnValues):
+                if values != None:
+                    record.values.append(values[i])
+                else:
+                    success,result = decode(record.getSrcFeature(layer))
+                    if not success:
+                        raise _ImportError(result)
+                    record.values.append(result)
+            record.srcFeature = None
+
+        yield batch
+
+#############################################################################
+
+def _geoJSONGeometry(geometry):
+    """ Convert a parsed geometry into a GeoJSON geometry object.
+
+        'geometry' is a (type, data) tuple, as returned by utils.parseWKB().
+    """
+    geometryType,data = geometry
+
+    if geometryType == "GeometryCollection":
+        return {'type'       : geometryType,
+                'geometries' : [_geoJSONGeometry(member) for member in data]}
+
+    def points(coords):
+        return zip(coords[0::2], coords[1::2])
+
+    if geometryType == "Point":
+        coordinates = data
+    elif geometryType == "LineString":
+        coordinates = points(data)
+    elif geometryType == "Polygon":
+        coordinates = [points(ring) for ring in data]
+    else:
+        coordinates = [_geoJSONGeometry(member)['coordinates']
+                       for member in data]
+
+    return {'type'        : geometryType,
+            'coordinates' : coordinates}
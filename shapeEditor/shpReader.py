@@ -0,0 +1,307 @@
+# shpReader.py
+#
+# This module implements a fast reader for the geometries held in a
+# shapefile's ".shp" file.
+#
+# Rather than reading each feature's geometry via OGR, we memory-map the
+# ".shp" and ".shx" files and convert the shapes directly into WKB format,
+# a batch of records at a time.  Because the shapefile stores each shape's
+# coordinates as an array of little-endian (x,y) doubles, which is exactly
+# how WKB stores its coordinates, the coordinate arrays can be copied
+# straight into the WKB buffer without decoding the individual points.
+#
+# Only the two-dimensional shape types (and their "measured" variants, whose
+# measures we ignore) are handled here.  For anything else -- null shapes,
+# shapes with Z coordinates, multipatches, or polygons whose rings we can't
+# unambiguously assign to outer rings -- we return FALLBACK, and the caller
+# should read that record's geometry via OGR instead.
+
+import mmap
+import struct
+
+#############################################################################
+
+# The value returned by ShapeReader.readGeometries() for records which need
+# to be read via OGR.
+
+FALLBACK = object()
+
+#############################################################################
+
+class ShapeError(Exception):
+    """ Exception raised when a shapefile can't be read.
+    """
+    pass
+
+#############################################################################
+
+class ShapeReader(object):
+    """ A memory-mapped reader for a shapefile's ".shp" and ".shx" files.
+
+        The 'numRecords' attribute holds the number of records in the
+        shapefile, and 'extent' holds the shapefile's bounding box, as a
+        (minX, minY, maxX, maxY) tuple in the shapefile's own coordinates.
+    """
+    def __init__(self, shpFilename, shxFilename):
+        """ Open the given ".shp" and ".shx" files.
+
+            We raise a ShapeError if the files can't be opened or are
+            invalid.
+        """
+        self._files   = []
+        self._buffers = []
+        try:
+            self._shp = self._open(shpFilename)
+            self._shx = self._open(shxFilename)
+        except (IOError, EnvironmentError, ValueError), e:
+            self.close()
+            raise ShapeError("Unable to open shapefile: " + str(e))
+
+        for buf in [self._shp, self._shx]:
+            if (len(buf) < 100 or
+                struct.unpack(">i", buf[0:4])[0] != 9994):
+                self.close()
+                raise ShapeError("Invalid shapefile header.")
+
+        self.numRecords = (len(self._shx) - 100) / 8
+        self.extent     = struct.unpack("<4d", self._shp[36:68])
+
+
+    def close(self):
+        """ Close the shapefile.
+        """
+        for buf in self._buffers:
+            buf.close()
+        for f in self._files:
+            f.close()
+        self._buffers = []
+        self._files   = []
+
+
+    def readGeometries(self, recordNums):
+        """ Read the geometries for the given records.
+
+            'recordNums' is a list of record numbers, in any order.  We
+            return a list with one entry for each record, holding either the
+            record's geometry as a (little-endian) WKB string, or FALLBACK if
+            the record's geometry should be read via OGR.
+        """
+        results = []
+        for recordNum in recordNums:
+            offset,length = self._readIndex(recordNum)
+            if length < 4 or offset + length > len(self._shp):
+                results.append(FALLBACK)
+                continue
+
+            content = self._shp[offset:offset+length]
+            try:
+                results.append(_decodeShape(content))
+            except struct.error:
+                results.append(FALLBACK)
+        return results
+
+
+    def readCentre(self, recordNum):
+        """ Return the centre of the given record's bounding box.
+
+            We return an (x, y) tuple, in the shapefile's own coordinates, or
+            None if the record doesn't have a geometry.  Only the record's
+            header is read, so this is much quicker than reading the record's
+            geometry.
+        """
+        offset,length = self._readIndex(recordNum)
+        if length < 4 or offset + length > len(self._shp):
+            return None
+
+        shapeType = struct.unpack_from("<i", self._shp, offset)[0]
+        if shapeType == _SHP_NULL:
+            return None
+        elif shapeType in [_SHP_POINT, _SHP_POINTM, _SHP_POINTZ]:
+            if length < 20:
+                return None
+            return struct.unpack_from("<2d", self._shp, offset+4)
+        else:
+            if length < 36:
+                return None
+            minX,minY,maxX,maxY = struct.unpack_from("<4d", self._shp,
+                                                     offset+4)
+            return ((minX + maxX) / 2, (minY + maxY) / 2)
+
+    # =====================
+    # == PRIVATE METHODS ==
+    # =====================
+
+    def _open(self, filename):
+        """ Open and memory-map the given file.
+        """
+        f = open(filename, "rb")
+        self._files.append(f)
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buffers.append(buf)
+        return buf
+
+
+    def _readIndex(self, recordNum):
+        """ Return the (offset, length) of the given record's contents.
+
+            The offset and length are in bytes, and skip the record header.
+        """
+        if recordNum < 0 or recordNum >= self.numRecords:
+            raise ShapeError("Record number out of range.")
+        offset,length = struct.unpack_from(">2i", self._shx,
+                                           100 + recordNum * 8)
+        return (offset * 2 + 8, length * 2)
+
+#############################################################################
+#
+# Private definitions:
+
+# Shapefile shape types:
+
+_SHP_NULL        = 0
+_SHP_POINT       = 1
+_SHP_POLYLINE    = 3
+_SHP_POLYGON     = 5
+_SHP_MULTIPOINT  = 8
+_SHP_POINTZ      = 11
+_SHP_POINTM      = 21
+_SHP_POLYLINEM   = 23
+_SHP_POLYGONM    = 25
+_SHP_MULTIPOINTM = 28
+
+# WKB geometry types:
+
+_WKB_POINT           = 1
+_WKB_LINESTRING      = 2
+_WKB_POLYGON         = 3
+_WKB_MULTIPOINT      = 4
+_WKB_MULTILINESTRING = 5
+_WKB_MULTIPOLYGON    = 6
+
+
+def _decodeShape(content):
+    """ Convert the contents of a single shapefile record into WKB format.
+
+        We return the WKB string, or FALLBACK if the shape can't be converted.
+    """
+    shapeType = struct.unpack("<i", content[0:4])[0]
+
+    if shapeType in [_SHP_POINT, _SHP_POINTM]:
+        if len(content) < 20:
+            return FALLBACK
+        return struct.pack("<BI", 1, _WKB_POINT) + content[4:20]
+
+    if shapeType in [_SHP_MULTIPOINT, _SHP_MULTIPOINTM]:
+        numPoints = struct.unpack("<i", content[36:40])[0]
+        if numPoints < 1 or len(content) < 40 + numPoints * 16:
+            return FALLBACK
+        pointHeader = struct.pack("<BI", 1, _WKB_POINT)
+        wkb = [struct.pack("<BII", 1, _WKB_MULTIPOINT, numPoints)]
+        for i in range(numPoints):
+            wkb.append(pointHeader)
+            wkb.append(content[40+i*16:56+i*16])
+        return "".join(wkb)
+
+    if shapeType in [_SHP_POLYLINE, _SHP_POLYLINEM,
+                     _SHP_POLYGON, _SHP_POLYGONM]:
+        parts = _splitParts(content)
+        if parts == None:
+            return FALLBACK
+
+        if shapeType in [_SHP_POLYLINE, _SHP_POLYLINEM]:
+            if len(parts) == 1:
+                return _lineStringWKB(parts[0])
+            wkb = [struct.pack("<BII", 1, _WKB_MULTILINESTRING, len(parts))]
+            for part in parts:
+                wkb.append(_lineStringWKB(part))
+            return "".join(wkb)
+
+        # If we get here, we have a polygon.  Make sure the rings are
+        # closed, and then see which of the rings are outer rings (which
+        # shapefiles store in clockwise order) and which are holes.
+
+        for numPoints,coords in parts:
+            if numPoints < 4 or coords[:16] != coords[-16:]:
+                return FALLBACK
+
+        if len(parts) == 1:
+            return _polygonWKB(parts)
+
+        areas = [_signedArea(numPoints, coords)
+                 for numPoints,coords in parts]
+        if 0 in areas:
+            return FALLBACK
+        if areas[0] < 0 and min(areas[1:]) > 0:
+            # One outer ring, followed by its holes.
+            return _polygonWKB(parts)
+        if max(areas) < 0:
+            # Several outer rings, none of which have holes.
+            wkb = [struct.pack("<BII", 1, _WKB_MULTIPOLYGON, len(parts))]
+            for part in parts:
+                wkb.append(_polygonWKB([part]))
+            return "".join(wkb)
+
+        # Several outer rings with holes -> OGR has to work out which hole
+        # belongs to which ring.
+        return FALLBACK
+
+    return FALLBACK # Null shape, Z coordinates, multipatch, etc.
+
+
+def _splitParts(content):
+    """ Split the contents of a PolyLine or Polygon record into its parts.
+
+        We return a list of (numPoints, coords) tuples, one for each part,
+        where 'coords' is the raw coordinate data for that part.  If the
+        record is invalid, we return None.
+    """
+    numParts,numPoints = struct.unpack("<ii", content[36:44])
+    pointsStart = 44 + numParts * 4
+    if (numParts < 1 or numPoints < 1 or
+        len(content) < pointsStart + numPoints * 16):
+        return None
+
+    starts = list(struct.unpack("<%di" % numParts, content[44:pointsStart]))
+    starts.append(numPoints)
+
+    parts = []
+    for i in range(numParts):
+        partPoints = starts[i+1] - starts[i]
+        if partPoints < 2:
+            return None
+        start = pointsStart + starts[i] * 16
+        parts.append((partPoints, content[start:start+partPoints*16]))
+    return parts
+
+
+def _lineStringWKB(part):
+    """ Return the WKB for a LineString holding the given part.
+    """
+    numPoints,coords = part
+    return struct.pack("<BII", 1, _WKB_LINESTRING, numPoints) + coords
+
+
+def _polygonWKB(rings):
+    """ Return the WKB for a Polygon holding the given rings.
+    """
+    wkb = [struct.pack("<BII", 1, _WKB_POLYGON, len(rings))]
+    for numPoints,coords in rings:
+        wkb.append(struct.pack("<I", numPoints))
+        wkb.append(coords)
+    return "".join(wkb)
+
+
+def _signedArea(numPoints, coords):
+    """ Return twice the signed area of the given ring.
+
+        The result is negative for clockwise rings and positive for
+        counter-clockwise rings.
+    """
+    values = struct.unpack("<%dd" % (numPoints * 2), coords)
+    xs = values[0::2]
+    ys = values[1::2]
+    area = 0.0
+    for i in range(numPoints - 1):
+        area = area + xs[i] * ys[i+1] - xs[i+1] * ys[i]
+    return area
+
@@ -0,0 +1,398 @@
+# spatialCache.py
+#
+# This module implements an in-memory spatial index of a shapefile's
+# features.
+#
+# Looking up the feature the user clicked on means a trip to the database
+# for every click, even though the shapefiles being edited are usually small
+# enough to keep in memory.  If the SHAPEEDITOR_SPATIAL_CACHE_SIZE setting is
+# set, we keep a SpatialIndex for each of the recently used shapefiles,
+# holding the shapefile's geometries (prepared, so that repeated predicate
+# tests are fast) along with an STR-packed R-tree of their bounding boxes.
+# Point and bounding box queries can then be answered without going to the
+# database at all.
+#
+# Each index is built the first time it is needed, and records the version
+# of the shapefile it was built from.  When a feature is edited, the index
+# is patched to match; if the shapefile has been changed in some other way
+# (for example, by another process), the version numbers no longer match and
+# the index is simply rebuilt.  The indexes are kept within the configured
+# memory budget by discarding the least recently used ones.
+
+from django.conf import settings
+from django.contrib.gis.geos import GEOSGeometry, Point, Polygon
+
+import itertools
+import math
+import threading
+
+import featureStore
+
+#############################################################################
+
+# The number of entries in each node of our R-trees.
+
+NODE_SIZE = 16
+
+# The number of edits we patch into an index before rebuilding it.  Edited
+# features are searched one at a time, so a heavily edited index slowly
+# loses its speed.
+
+MAX_PATCHES = 100
+
+#############################################################################
+
+class SpatialIndex(object):
+    """ An in-memory spatial index of a shapefile's features.
+
+        The 'version' attribute holds the version of the shapefile the index
+        matches, and 'size' holds an estimate of the memory used by the
+        index, in bytes.
+    """
+    def __init__(self, version, features):
+        """ Build a new SpatialIndex.
+
+            'version' is the version number of the shapefile being indexed,
+            and 'features' is a sequence of (featureId, geometry) tuples,
+            where 'geometry' is the feature's GEOSGeometry object.
+        """
+        self.version = version
+
+        self._lock     = threading.Lock()
+        self._features = {} # Maps feature ID to (geometry, prepared) tuple.
+        self._patched  = {} # Maps feature ID to envelope of edited features.
+
+        items = []
+        numVertices = 0
+        for featureId,geometry in features:
+            self._features[featureId] = (geometry, geometry.prepared)
+            minX,minY,maxX,maxY = geometry.extent
+            items.append((minX, minY, maxX, maxY, featureId))
+            numVertices = numVertices + geometry.num_coords
+
+        self._root,self._height = _buildTree(items)
+        self.size = _calcSize(len(items), numVertices)
+
+
+    def findNearestFeature(self, longitude, latitude, radius):
+        """ Find the feature closest to the given point.
+
+            The parameters and return value are the same as for
+            featureStore.findNearestFeature().
+        """
+        point = Point(longitude, latitude, srid=4326)
+        bounds = (longitude - radius, latitude - radius,
+                  longitude + radius, latitude + radius)
+
+        self._lock.acquire()
+        try:
+            closest = None
+            for featureId in self._search(bounds):
+                geometry,prepared = self._features[featureId]
+                if prepared.intersects(point):
+                    distance = 0
+                else:
+                    distance = geometry.distance(point)
+                if distance <= radius and (closest == None or
+                                           (distance, featureId) < closest):
+                    closest = (distance, featureId)
+        finally:
+            self._lock.release()
+
+        if closest == None:
+            return None
+        return closest[1]
+
+
+    def findFeatures(self, minX, minY, maxX, maxY):
+        """ Find the features which intersect the given bounding box.
+
+            We return a sorted list of the record IDs of the features.
+        """
+        area = Polygon.from_bbox((minX, minY, maxX, maxY))
+        area.srid = 4326
+
+        self._lock.acquire()
+        try:
+            featureIds = []
+            for featureId in self._search((minX, minY, maxX, maxY)):
+                geometry,prepared = self._features[featureId]
+                if prepared.intersects(area):
+                    featureIds.append(featureId)
+        finally:
+            self._lock.release()
+
+        featureIds.sort()
+        return featureIds
+
+
+    def patch(self, featureId, geometry):
+        """ Update the index to reflect a change to one of its features.
+
+            'featureId' is the record ID of the added, updated or deleted
+            feature, and 'geometry' is the feature's new GEOSGeometry object,
+            or None if the feature was deleted.  We return False if the index
+            has been patched too many times and should be rebuilt.
+        """
+        self._lock.acquire()
+        try:
+            if geometry == None:
+                self._features.pop(featureId, None)
+                self._patched.pop(featureId, None)
+            else:
+                self._features[featureId] = (geometry, geometry.prepared)
+                self._patched[featureId] = geometry.extent
+            return len(self._patched) <= MAX_PATCHES
+        finally:
+            self._lock.release()
+
+    # =====================
+    # == PRIVATE METHODS ==
+    # =====================
+
+    def _search(self, bounds):
+        """ Return the IDs of the features whose envelopes touch 'bounds'.
+
+            'bounds' is a (minX, minY, maxX, maxY) tuple.  Deleted features
+            are skipped, and edited features are checked against their new
+            envelopes rather than the ones stored in the tree.
+        """
+        minX,minY,maxX,maxY = bounds
+
+        featureIds = []
+        for featureId in _searchTree(self._root, self._height, bounds):
+            if featureId in self._features and featureId not in self._patched:
+                featureIds.append(featureId)
+
+        for featureId,envelope in self._patched.items():
+            if (envelope[0] <= maxX and envelope[2] >= minX and
+                envelope[1] <= maxY and envelope[3] >= minY):
+                featureIds.append(featureId)
+
+        return featureIds
+
+#############################################################################
+
+def getIndex(shapefile):
+    """ Return the SpatialIndex for the given shapefile.
+
+        If we don't already have an up-to-date index for the shapefile, we
+        build one.  We return None if the spatial cache has been disabled,
+        if the shapefile is too big to fit in the cache, or if another
+        thread is already building the shapefile's index; in this case, the
+        caller should query the database instead.
+    """
+    budget = getattr(settings, "SHAPEEDITOR_SPATIAL_CACHE_SIZE", None)
+    if budget == None:
+        return None
+    if _calcSize(shapefile.num_features, shapefile.num_vertices) > budget:
+        return None
+
+    _lock.acquire()
+    try:
+        entry = _indexes.get(shapefile.id)
+        if entry != None and entry[1].version == shapefile.version:
+            _indexes[shapefile.id] = (_ticks.next(), entry[1])
+            return entry[1]
+        if shapefile.id in _building:
+            return None
+        _building.add(shapefile.id)
+    finally:
+        _lock.release()
+
+    # If we get here, we have to build a new index.  This is done without
+    # holding the lock, so that lookups for other shapefiles can proceed in
+    # the meantime.  Lookups for this shapefile go to the database until the
+    # index has been built.
+
+    def features():
+        for featureId,wkb,values in featureStore.iterFeatures(shapefile):
+            yield (featureId, GEOSGeometry(buffer(wkb), srid=4326))
+
+    index = None
+    try:
+        index = SpatialIndex(shapefile.version, features())
+    finally:
+        _lock.acquire()
+        try:
+            _building.discard(shapefile.id)
+            if index != None:
+                _indexes[shapefile.id] = (_ticks.next(), index)
+                _evict(budget)
+        finally:
+            _lock.release()
+
+    return index
+
+
+def featureChanged(shapefile, featureId, geometry):
+    """ Update the cache to reflect a change to one of a shapefile's features.
+
+        This should be called after the change has been recorded using
+        Shapefile.recordChange(), so that the shapefile's version number has
+        been bumped.  'featureId' is the record ID of the added, updated or
+        deleted feature, and 'geometry' is the feature's new GEOSGeometry
+        object, or None if the feature was deleted.
+    """
+    featuresChanged(shapefile, [(featureId, geometry)])
+
+
+def featuresChanged(shapefile, changes):
+    """ Update the cache to reflect a single edit to a shapefile's features.
+
+        This is the same as featureChanged(), except that the edit can
+        change any number of features at once.  'changes' is a list of
+        (featureId, geometry) tuples, one for each feature whose geometry
+        was changed by the edit.
+
+        If the cached index was built from the previous version of the
+        shapefile, we patch it to match.  Otherwise, the shapefile has been
+        changed in some other way as well, so we discard the index.
+    """
+    _lock.acquire()
+    try:
+        entry = _indexes.get(shapefile.id)
+        if entry == None:
+            return
+        index = entry[1]
+        patched = (index.version == shapefile.version - 1)
+        for featureId,geometry in changes:
+            if not patched:
+                break
+            patched = index.patch(featureId, geometry)
+        if patched:
+            index.version = shapefile.version
+        else:
+            del _indexes[shapefile.id]
+    finally:
+        _lock.release()
+
+
+def discard(shapefileId):
+    """ Remove the given shapefile's index from the cache, if it has one.
+    """
+    _lock.acquire()
+    try:
+        _indexes.pop(shapefileId, None)
+    finally:
+        _lock.release()
+
+#############################################################################
+#
+# Private definitions:
+
+# Our cache of spatial indexes.  This maps each shapefile's ID to a
+# (lastUsed, index) tuple, where 'lastUsed' is a tick count recording when
+# the index was last used, and 'index' is the shapefile's SpatialIndex.
+
+_indexes = {}
+_ticks   = itertools.count()
+_lock    = threading.Lock()
+
+# The IDs of the shapefiles whose indexes are being built.
+
+_building = set()
+
+# Our estimates of the memory used by each feature and each vertex in a
+# SpatialIndex, in bytes.  These cover the GEOS geometries and their prepared
+# versions, as well as the Python objects which refer to them.
+
+_BYTES_PER_FEATURE = 1024
+_BYTES_PER_VERTEX  = 40
+
+
+def _calcSize(numFeatures, numVertices):
+    """ Return the estimated size of a SpatialIndex, in bytes.
+    """
+    return numFeatures * _BYTES_PER_FEATURE + numVertices * _BYTES_PER_VERTEX
+
+
+def _evict(budget):
+    """ Discard the least recently used indexes until we are within budget.
+
+        This must be called with the lock held.
+    """
+    total = sum([index.size for lastUsed,index in _indexes.values()])
+    while total > budget and len(_indexes) > 1:
+        lastUsed,shapefileId = min([(entry[0], shapefileId) for shapefileId,
+                                    entry in _indexes.items()])
+        total = total - _indexes.pop(shapefileId)[1].size
+
+
+def _buildTree(items):
+    """ Build an STR-packed R-tree holding the given items.
+
+        'items' is a list of (minX, minY, maxX, maxY, featureId) tuples.  Each
+        node of the tree is stored as a (minX, minY, maxX, maxY, children)
+        tuple, where 'children' is the list of the node's child nodes or, for
+        nodes at the lowest level of the tree, the node's items.
+
+        We return a (root, height) tuple, where 'root' is the tree's root
+        node (or None if there are no items) and 'height' is the number of
+        levels of nodes in the tree.
+    """
+    if len(items) == 0:
+        return (None, 0)
+
+    entries = items
+    height  = 0
+    while True:
+        entries = _packLevel(entries)
+        height  = height + 1
+        if len(entries) == 1:
+            return (entries[0], height)
+
+
+def _packLevel(entries):
+    """ Pack one level of an R-tree using the Sort-Tile-Recursive algorithm.
+
+        'entries' is a list of (minX, minY, maxX, maxY, ...) tuples.  We sort
+        the entries into vertical slices by the X coordinate of their centre,
+        sort each slice by the Y coordinate of their centre, and then group
+        each run of NODE_SIZE entries into a node.  We return the list of
+        nodes.
+    """
+    numNodes  = int(math.ceil(float(len(entries)) / NODE_SIZE))
+    numSlices = int(math.ceil(math.sqrt(numNodes)))
+    sliceSize = numSlices * NODE_SIZE
+
+    entries = sorted(entries, key=lambda entry: entry[0] + entry[2])
+
+    nodes = []
+    for i in range(0, len(entries), sliceSize):
+        slice = sorted(entries[i:i+sliceSize],
+                       key=lambda entry: entry[1] + entry[3])
+        for j in range(0, len(slice), NODE_SIZE):
+            children = slice[j:j+NODE_SIZE]
+            nodes.append((min([child[0] for child in children]),
+                          min([child[1] for child in children]),
+                          max([child[2] for child in children]),
+                          max([child[3] for child in children]),
+                          children))
+    return nodes
+
+
+def _searchTree(root, height, bounds):
+    """ Return the IDs of the items in an R-tree which touch 'bounds'.
+
+        'root' and 'height' are as returned by _buildTree(), and 'bounds' is
+        a (minX, minY, maxX, maxY) tuple.
+    """
+    if root == None:
+        return []
+
+    minX,minY,maxX,maxY = bounds
+
+    featureIds = []
+    stack = [(root, height)]
+    while len(stack) > 0:
+        node,level = stack.pop()
+        for child in node[4]:
+            if (child[0] > maxX or child[2] < minX or
+                child[1] > maxY or child[3] < minY):
+                continue
+            if level == 1:
+                featureIds.append(child[4])
+            else:
+                stack.append((child, level - 1))
+    return featureIds
@@ -0,0 +1,12 @@
+-- feature.sql
+--
+-- Custom SQL run by "manage.py syncdb" once the Feature table has been
+-- created.  This adds a combined index on each feature's shapefile and
+-- geometry, so that the database can find the features in part of a single
+-- shapefile using just one index.  Indexing an integer column using GiST
+-- requires the btree_gist extension.
+
+CREATE EXTENSION IF NOT EXISTS btree_gist;
+
+CREATE INDEX "shapeEditor_feature_shapefile_geometry"
+    ON "shapeEditor_feature" USING GIST ("shapefile_id", "geometry");
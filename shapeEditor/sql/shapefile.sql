@@ -0,0 +1,10 @@
+-- shapefile.sql
+--
+-- Custom SQL run by "manage.py syncdb" once the Shapefile table has been
+-- created.  This adds an index covering the shapefiles shown to the user,
+-- in the order they are listed, so that each page of the list of shapefiles
+-- can be read straight from the index.  To add the index to an existing
+-- database, run this file using "manage.py dbshell".
+
+CREATE INDEX "shapeEditor_shapefile_listing"
+    ON "shapeEditor_shapefile" ("filename", "id") WHERE NOT "deleting";
@@ -5,7 +5,34 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.http import QueryDict
+from django.contrib.gis.geos import GEOSGeometry, Point, Polygon
+
+from osgeo import ogr
+
+import os
+import StringIO
+import struct
+import tempfile
+import zipfile
+
+from geoedit.shapeEditor import attributeCodecs
+from geoedit.shapeEditor import dbfReader
+from geoedit.shapeEditor import edits
+from geoedit.shapeEditor import featureStore
+from geoedit.shapeEditor import filters
+from geoedit.shapeEditor import flatgeobuf
+from geoedit.shapeEditor import shapefileEditor
+from geoedit.shapeEditor import shpReader
+from geoedit.shapeEditor import spatialCache
+from geoedit.shapeEditor import utils
+from geoedit.shapeEditor import views
+from geoedit.shapeEditor import zipStream
+from geoedit.shapeEditor.models import Shapefile, Attribute, Feature
+from geoedit.shapeEditor.models import FeatureChange
+from geoedit.shapeEditor.models import getShapefileListVersion
+from geoedit.shapeEditor.models import shapefileListChanged
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -21,3 +48,665 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+#############################################################################
+
+class AttributeCodecTest(TestCase):
+    def test_list_round_trip(self):
+        """
+        Tests that list values survive a trip through the list encoding.
+        """
+        for values in [[1, 2, 3], [1.5, -2.25], [u"abc", u"d\xe9f"], []]:
+            encoded = attributeCodecs.encodeList(values)
+            self.assertEqual(attributeCodecs.decodeList(encoded), values)
+
+    def test_legacy_list_format(self):
+        """
+        Tests that lists stored using the old repr() format can be read.
+        """
+        self.assertEqual(attributeCodecs.decodeList("['  1.50', ' 2.00']"),
+                         ['  1.50', ' 2.00'])
+        self.assertEqual(attributeCodecs.decodeList("[1, 2]"), [1, 2])
+
+    def test_date_time_round_trip(self):
+        """
+        Tests that dates and times are stored as sortable ISO 8601 strings.
+        """
+        for type,parts,expected in [
+                (ogr.OFTDate, (2010, 7, 4, 0, 0, 0, 0), "2010-07-04"),
+                (ogr.OFTTime, (0, 0, 0, 9, 5, 0, 0), "09:05:00"),
+                (ogr.OFTDateTime, (2010, 7, 4, 9, 5, 0, 100),
+                 "2010-07-04T09:05:00Z")]:
+            value = attributeCodecs.formatDateTime(type, *parts)
+            self.assertEqual(value, expected)
+            self.assertEqual(attributeCodecs.parseDateTime(type, value),
+                             parts)
+
+    def test_legacy_values(self):
+        """
+        Tests that attribute values stored as strings are converted.
+        """
+        attributes = [Attribute(name="COUNT", type=ogr.OFTInteger,
+                                width=5, precision=0),
+                      Attribute(name="AREA", type=ogr.OFTReal,
+                                width=8, precision=2),
+                      Attribute(name="WHEN", type=ogr.OFTDate,
+                                width=8, precision=0),
+                      Attribute(name="NAME", type=ogr.OFTString,
+                                width=10, precision=0)]
+        parsers = attributeCodecs.compileLegacyParsers(attributes)
+
+        legacy = ["12", "    3.50", "2010,7,4,0", u"12"]
+        typed  = [12, 3.5, "2010-07-04", u"12"]
+        for parser,old,new in zip(parsers, legacy, typed):
+            self.assertEqual(parser(old), new)
+            self.assertEqual(parser(new), new)
+
+#############################################################################
+
+class FeatureAttributesTest(TestCase):
+    def test_encode_attributes(self):
+        """
+        Tests that a feature's attribute values survive being stored.
+        """
+        attributes = [Attribute(name="NAME", type=ogr.OFTString,
+                                width=10, precision=0),
+                      Attribute(name="COUNT", type=ogr.OFTInteger,
+                                width=5, precision=0)]
+        encoded = featureStore.encodeAttributes(attributes,
+                                                [u"caf\xe9", None])
+
+        field = Feature._meta.get_field("attributes")
+        self.assertEqual(field.to_python(encoded), {u"NAME" : u"caf\xe9"})
+        self.assertEqual(field.to_python(field.get_prep_value({})), {})
+
+#############################################################################
+
+class DBFReaderTest(TestCase):
+    def setUp(self):
+        fields  = [("NAME", "C", 10, 0), ("COUNT", "N", 5, 0),
+                   ("AREA", "N", 8, 2), ("WHEN", "D", 8, 0)]
+        records = [["caf\xe9", "12", "3.5", "20100704"],
+                   ["", "*****", "", "00000000"]]
+
+        recordLength = 1 + sum([field[2] for field in fields])
+        headerLength = 32 + 32 * len(fields) + 1
+
+        data = [struct.pack("<BBBBIHH20x", 3, 110, 1, 1, len(records),
+                            headerLength, recordLength)]
+        for name,type,width,decimals in fields:
+            data.append(struct.pack("<11sc4xBB14x", name, type,
+                                    width, decimals))
+        data.append("\r")
+        for record in records:
+            data.append(" ")
+            for (name,type,width,decimals),value in zip(fields, record):
+                data.append(value.rjust(width) if type == "N"
+                            else value.ljust(width))
+
+        fd,self.filename = tempfile.mkstemp(suffix=".dbf")
+        os.write(fd, "".join(data))
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_read_columns(self):
+        """
+        Tests that each supported column type is read and converted.
+        """
+        reader = dbfReader.DBFReader(self.filename)
+        self.assertEqual(reader.numRecords, 2)
+
+        expected = [(Attribute(name="NAME", type=ogr.OFTString,
+                               width=10, precision=0), [u"caf\xe9", None]),
+                    (Attribute(name="COUNT", type=ogr.OFTInteger,
+                               width=5, precision=0), [12, None]),
+                    (Attribute(name="AREA", type=ogr.OFTReal,
+                               width=8, precision=2), [3.5, None]),
+                    (Attribute(name="WHEN", type=ogr.OFTDate,
+                               width=8, precision=0), ["2010-07-04", None])]
+        for attr,values in expected:
+            column = reader.compileColumn(attr, "latin1")
+            self.assertEqual(column([0, 1]), values)
+        reader.close()
+
+    def test_fallback(self):
+        """
+        Tests that unknown attributes and undecodable values are rejected.
+        """
+        reader = dbfReader.DBFReader(self.filename)
+        attr = Attribute(name="MISSING", type=ogr.OFTString,
+                         width=10, precision=0)
+        self.assertEqual(reader.compileColumn(attr, "ascii"), None)
+
+        attr = Attribute(name="NAME", type=ogr.OFTString,
+                         width=10, precision=0)
+        column = reader.compileColumn(attr, "ascii")
+        self.assertRaises(dbfReader.DBFError, column, [0])
+        reader.close()
+
+#############################################################################
+
+class FilterTest(TestCase):
+    def test_area_filters(self):
+        """
+        Tests that bounding boxes and polygons are parsed into an area.
+        """
+        self.assertEqual(filters.parseFilter(None, QueryDict("")), None)
+
+        featureFilter = filters.parseFilter(None,
+                                            QueryDict("bbox=0,0,10,10"))
+        self.assertEqual(featureFilter.area.extent, (0, 0, 10, 10))
+        self.assertEqual(featureFilter.predicates, [])
+
+        featureFilter = filters.parseFilter(None, QueryDict(
+                "bbox=0,0,10,10&" +
+                "polygon=POLYGON((5 5, 20 5, 20 20, 5 20, 5 5))"))
+        self.assertEqual(featureFilter.area.extent, (5, 5, 10, 10))
+
+    def test_predicates(self):
+        """
+        Tests that attribute predicates are converted to typed values.
+        """
+        attributes = {}
+        for name,type in [("POP", ogr.OFTInteger), ("NAME", ogr.OFTString),
+                          ("FOUNDED", ogr.OFTDate),
+                          ("CODES", ogr.OFTIntegerList)]:
+            attributes[name] = Attribute(name=name, type=type,
+                                         width=10, precision=0)
+
+        attr,operator,value = filters._parsePredicate("POP >= 1000",
+                                                      attributes)
+        self.assertEqual((attr.name, operator, value), ("POP", ">=", 1000))
+
+        attr,operator,value = filters._parsePredicate("FOUNDED<1900-1-1",
+                                                      attributes)
+        self.assertEqual((operator, value), ("<", "1900-01-01"))
+
+        for predicate in ["POP=many", "FOUNDED=1900", "CODES=1",
+                          "MISSING=1"]:
+            self.assertRaises(filters.FilterError, filters._parsePredicate,
+                              predicate, attributes)
+
+    def test_invalid_filters(self):
+        """
+        Tests that invalid filters are rejected.
+        """
+        for query in ["bbox=1,2,3", "bbox=10,0,0,10",
+                      "polygon=POINT(1 1)", "polygon=nonsense"]:
+            self.assertRaises(filters.FilterError, filters.parseFilter,
+                              None, QueryDict(query))
+
+#############################################################################
+
+class EditsTest(TestCase):
+    def test_values(self):
+        """
+        Tests that edited attribute values are checked and converted.
+        """
+        area  = Attribute(name="AREA", type=ogr.OFTReal,
+                          width=8, precision=2)
+        when  = Attribute(name="WHEN", type=ogr.OFTDate,
+                          width=8, precision=0)
+        codes = Attribute(name="CODES", type=ogr.OFTIntegerList,
+                          width=10, precision=0)
+
+        self.assertEqual(edits._parseValue(area, 3), 3.0)
+        self.assertEqual(edits._parseValue(area, 1.234), 1.23)
+        self.assertEqual(edits._parseValue(when, "1900-1-1"), "1900-01-01")
+        self.assertEqual(edits._parseValue(codes, [1, 2]), [1, 2])
+        self.assertEqual(edits._parseValue(codes, None), None)
+
+        for attr,value in [(area, "3"), (area, True), (when, "1900"),
+                           (codes, 1), (codes, [1, "2"])]:
+            self.assertRaises(edits.EditError, edits._parseValue,
+                              attr, value)
+
+#############################################################################
+
+class ApplyEditsTest(TransactionTestCase):
+    # We need real transactions here, so that we can check that a failed
+    # batch of edits is rolled back.
+
+    def setUp(self):
+        self.shapefile = Shapefile(filename="test.shp", srs_wkt="",
+                                   geom_type="Point", encoding="ascii")
+        self.shapefile.save()
+        featureStore.createPartition(self.shapefile)
+
+        self.name  = Attribute(shapefile=self.shapefile, name="NAME",
+                               type=ogr.OFTString, width=10, precision=0)
+        self.count = Attribute(shapefile=self.shapefile, name="COUNT",
+                               type=ogr.OFTInteger, width=5, precision=0)
+        self.name.save()
+        self.count.save()
+
+        self.featureIds = featureStore.insertFeatures(
+                            self.shapefile, [self.name, self.count],
+                            [(Point(i, i, srid=4326), [name, i])
+                             for i,name in enumerate(["a", "b", "c"])])
+        featureStore.updateStatistics(self.shapefile)
+
+    def test_apply_edits(self):
+        """
+        Tests that a batch of inserts, updates and deletes is applied as a
+        single new version of the shapefile.
+        """
+        id1,id2,id3 = self.featureIds
+        oldVersion = self.shapefile.version
+
+        batch = edits.parseEdits(self.shapefile, [
+                    {'action'     : "insert",
+                     'geometry'   : "POINT(5 5)",
+                     'attributes' : {'NAME' : "d"}},
+                    {'action'     : "insert",
+                     'geometry'   : "POINT(6 6)"},
+                    {'action'     : "update",
+                     'id'         : id1,
+                     'attributes' : {'NAME' : None, 'COUNT' : 7}},
+                    {'action'     : "update",
+                     'id'         : id2,
+                     'geometry'   : "POINT(9 9)"},
+                    {'action'     : "delete",
+                     'id'         : id3}])
+        insertedIds,extent = featureStore.applyEdits(self.shapefile, batch)
+        self.assertEqual(len(insertedIds), 2)
+
+        shapefile = Shapefile.objects.get(id=self.shapefile.id)
+        self.assertEqual(shapefile.version, oldVersion + 1)
+        self.assertEqual(shapefile.num_features, 4)
+        self.assertEqual(shapefile.num_vertices, 4)
+
+        changes = FeatureChange.objects.filter(shapefile=shapefile)
+        self.assertEqual(sorted([(change.version, change.feature_id,
+                                  change.change) for change in changes]),
+                         sorted([(oldVersion + 1, insertedIds[0], "insert"),
+                                 (oldVersion + 1, insertedIds[1], "insert"),
+                                 (oldVersion + 1, id1, "update"),
+                                 (oldVersion + 1, id2, "update"),
+                                 (oldVersion + 1, id3, "delete")]))
+
+        self.assertEqual(Feature.objects.get(id=id1).attributes,
+                         {'COUNT' : 7})
+        self.assertEqual(Feature.objects.get(id=id2).geometry.coords,
+                         (9.0, 9.0))
+        self.assertEqual(Feature.objects.get(id=insertedIds[0]).attributes,
+                         {'NAME' : "d"})
+        self.assertFalse(Feature.objects.filter(id=id3).exists())
+
+    def test_missing_feature(self):
+        """
+        Tests that a batch of edits which refers to a missing feature is
+        rejected without changing anything.
+        """
+        id1,id2,id3 = self.featureIds
+        oldVersion = self.shapefile.version
+
+        batch = edits.parseEdits(self.shapefile, [
+                    {'action'     : "insert",
+                     'geometry'   : "POINT(5 5)"},
+                    {'action'     : "update",
+                     'id'         : id1,
+                     'attributes' : {'COUNT' : 7}},
+                    {'action'     : "delete",
+                     'id'         : id2},
+                    {'action'     : "delete",
+                     'id'         : max(self.featureIds) + 1000}])
+        self.assertRaises(Feature.DoesNotExist, featureStore.applyEdits,
+                          self.shapefile, batch)
+
+        shapefile = Shapefile.objects.get(id=self.shapefile.id)
+        self.assertEqual(shapefile.version, oldVersion)
+        self.assertEqual(shapefile.num_features, 3)
+        self.assertEqual(shapefile.num_vertices, 3)
+        self.assertEqual(sorted(Feature.objects.filter(shapefile=shapefile)
+                                               .values_list("id", flat=True)),
+                         sorted(self.featureIds))
+        self.assertEqual(Feature.objects.get(id=id1).attributes,
+                         {'NAME' : "a", 'COUNT' : 0})
+        self.assertFalse(FeatureChange.objects.filter(
+                                            shapefile=shapefile).exists())
+
+#############################################################################
+
+class QueryKeyTest(TestCase):
+    def test_query_keys(self):
+        """
+        Tests that query keys survive a round trip, and are checked.
+        """
+        count = Attribute(name="COUNT", type=ogr.OFTInteger,
+                          width=5, precision=0)
+        name  = Attribute(name="NAME", type=ogr.OFTString,
+                          width=10, precision=0)
+
+        for key,sortAttr in [((12, 34), count), ((None, 34), count),
+                             ((u"caf\xe9", 34), name), ((None, 34), None)]:
+            encoded = views._encodeQueryKey(key)
+            self.assertEqual(views._decodeQueryKey(encoded, sortAttr), key)
+
+        self.assertEqual(views._decodeQueryKey(
+                            views._encodeQueryKey((u"abc", 34)), count),
+                         None)
+        self.assertEqual(views._decodeQueryKey("nonsense", None), None)
+
+#############################################################################
+
+class FeatureQueryTest(TestCase):
+    def setUp(self):
+        self.shapefile = Shapefile(filename="test.shp", srs_wkt="",
+                                   geom_type="Point", encoding="ascii")
+        self.shapefile.save()
+        featureStore.createPartition(self.shapefile)
+
+        self.count = Attribute(shapefile=self.shapefile, name="COUNT",
+                               type=ogr.OFTInteger, width=5, precision=0)
+        self.count.save()
+
+        counts = [3, None, 1, 2, None, 1, 3, None]
+        featureIds = featureStore.insertFeatures(
+                            self.shapefile, [self.count],
+                            [(Point(i, i, srid=4326), [count])
+                             for i,count in enumerate(counts)])
+        self.features = zip(featureIds, counts)
+
+    def test_paging(self):
+        """
+        Tests that paging through a shapefile's features returns every
+        feature exactly once, in the right order, whichever way the
+        features are sorted.
+        """
+        byId = sorted([featureId for featureId,count in self.features])
+        byCount = [featureId for isNull,count,featureId in
+                   sorted([(count == None, count, featureId)
+                           for featureId,count in self.features])]
+
+        for sortAttr,expected in [(None, byId), (self.count, byCount)]:
+            self.assertEqual(self._readPages(sortAttr, False), expected)
+            self.assertEqual(self._readPages(sortAttr, True),
+                             list(reversed(expected)))
+
+    def _readPages(self, sortAttr, descending):
+        """ Read all the features, a few at a time.
+
+            Each page's key is passed through the views' encoding, as it
+            would be by a client.  We return the list of feature IDs.
+        """
+        featureIds = []
+        after = None
+        while True:
+            features,nextKey = featureStore.queryFeatures(
+                                    self.shapefile, None, sortAttr,
+                                    descending, 3, after)
+            featureIds.extend([feature[0] for feature in features])
+            if nextKey == None:
+                return featureIds
+            after = views._decodeQueryKey(views._encodeQueryKey(nextKey),
+                                          sortAttr)
+
+#############################################################################
+
+class HitRadiusTest(TestCase):
+    def test_hit_radius(self):
+        """
+        Tests that the hit-testing radius follows the map's resolution.
+        """
+        radius = views._calcHitRadius(QueryDict("resolution=0.01"), 0, 0)
+        self.assertAlmostEqual(radius, 0.01 * views.HIT_TOLERANCE)
+
+        fallback = utils.calcSearchRadius(0, 0, views.DEFAULT_HIT_RADIUS)
+        for query in ["", "resolution=0", "resolution=nonsense"]:
+            self.assertAlmostEqual(views._calcHitRadius(QueryDict(query),
+                                                        0, 0), fallback)
+
+    def test_batch_radii(self):
+        """
+        Tests that search radii calculated in bulk match those calculated
+        one point at a time.
+        """
+        latitudes  = [0, 45.5, -60]
+        longitudes = [0, 170, -10.25]
+        radii = utils.calcSearchRadii(latitudes, longitudes, 250)
+        self.assertEqual(len(radii), 3)
+        for latitude,longitude,radius in zip(latitudes, longitudes, radii):
+            self.assertAlmostEqual(radius, utils.calcSearchRadius(
+                                                latitude, longitude, 250))
+        self.assertEqual(utils.calcSearchRadii([], [], 250), [])
+
+#############################################################################
+
+class MapFormTest(TestCase):
+    def test_forms_reused(self):
+        """
+        Tests that map forms are generated once for each type of geometry.
+        """
+        polygons = shapefileEditor.getMapForm(Shapefile(geom_type="Polygon"))
+        self.failUnless(polygons is shapefileEditor.getMapForm(
+                                        Shapefile(geom_type="MultiPolygon")))
+        self.failIf(polygons is shapefileEditor.getMapForm(
+                                        Shapefile(geom_type="Point")))
+
+#############################################################################
+
+class ShapefileListTest(TestCase):
+    def test_list_version(self):
+        """
+        Tests that the version of the shapefile list changes when the list
+        is changed.
+        """
+        version = getShapefileListVersion()
+        self.assertEqual(getShapefileListVersion(), version)
+        shapefileListChanged()
+        self.assertNotEqual(getShapefileListVersion(), version)
+
+#############################################################################
+
+class ShapeReaderTest(TestCase):
+    def setUp(self):
+        square = [(0, 0), (0, 10), (10, 10), (10, 0), (0, 0)]
+        hole   = [(2, 2), (4, 2), (4, 4), (2, 4), (2, 2)]
+        shapes = [self._point(1.5, 2.5),
+                  self._parts(3, [[(0, 0), (1, 1)], [(2, 2), (3, 3)]]),
+                  self._parts(5, [square, hole]),
+                  self._parts(5, [square, [(20, 20), (20, 30), (30, 30),
+                                           (20, 20)], hole]),
+                  struct.pack("<i", 0)]
+
+        shp = [self._header(50 + sum([4 + len(s) / 2 for s in shapes]))]
+        shx = [self._header(50 + 4 * len(shapes))]
+        offset = 50
+        for i,shape in enumerate(shapes):
+            shx.append(struct.pack(">ii", offset, len(shape) / 2))
+            shp.append(struct.pack(">ii", i + 1, len(shape) / 2) + shape)
+            offset = offset + 4 + len(shape) / 2
+
+        self.filenames = []
+        for data,suffix in [(shp, ".shp"), (shx, ".shx")]:
+            fd,filename = tempfile.mkstemp(suffix=suffix)
+            os.write(fd, "".join(data))
+            os.close(fd)
+            self.filenames.append(filename)
+
+    def tearDown(self):
+        for filename in self.filenames:
+            os.remove(filename)
+
+    def test_read_geometries(self):
+        """
+        Tests that shapes are converted to WKB or left for OGR to read.
+        """
+        reader = shpReader.ShapeReader(*self.filenames)
+        self.assertEqual(reader.numRecords, 5)
+
+        results = reader.readGeometries(range(5))
+        wkts = [GEOSGeometry(buffer(wkb)).wkt for wkb in results[:3]]
+        self.assertEqual(wkts[0], GEOSGeometry("POINT (1.5 2.5)").wkt)
+        self.assertEqual(wkts[1], GEOSGeometry(
+            "MULTILINESTRING ((0 0, 1 1), (2 2, 3 3))").wkt)
+        self.assertEqual(wkts[2], GEOSGeometry(
+            "POLYGON ((0 0, 0 10, 10 10, 10 0, 0 0), " +
+            "(2 2, 4 2, 4 4, 2 4, 2 2))").wkt)
+        self.failUnless(results[3] is shpReader.FALLBACK)
+        self.failUnless(results[4] is shpReader.FALLBACK)
+        reader.close()
+
+    def test_read_out_of_order(self):
+        """
+        Tests that records can be read in any order, as done when importing
+        features in Hilbert order.
+        """
+        reader = shpReader.ShapeReader(*self.filenames)
+        results = reader.readGeometries([2, 0])
+        self.assertEqual(GEOSGeometry(buffer(results[1])).wkt,
+                         GEOSGeometry("POINT (1.5 2.5)").wkt)
+        self.assertEqual(reader.readCentre(0), (1.5, 2.5))
+        self.assertEqual(reader.readCentre(4), None)
+        self.assertRaises(shpReader.ShapeError, reader.readCentre, 5)
+        reader.close()
+
+    def _header(self, fileLength):
+        return (struct.pack(">i20xi", 9994, fileLength) +
+                struct.pack("<ii64x", 1000, 5))
+
+    def _point(self, x, y):
+        return struct.pack("<idd", 1, x, y)
+
+    def _parts(self, shapeType, parts):
+        starts = []
+        points = []
+        for part in parts:
+            starts.append(len(points))
+            points.extend(part)
+        data = [struct.pack("<i32xii", shapeType, len(parts), len(points))]
+        data.append(struct.pack("<%di" % len(starts), *starts))
+        for x,y in points:
+            data.append(struct.pack("<dd", x, y))
+        return "".join(data)
+
+#############################################################################
+
+class SpatialIndexTest(TestCase):
+    def test_lookups(self):
+        """
+        Tests point and bounding box lookups, before and after patching.
+        """
+        features = []
+        for i in range(100):
+            x = (i % 10) * 10
+            y = (i // 10) * 10
+            square = Polygon.from_bbox((x, y, x + 5, y + 5))
+            square.srid = 4326
+            features.append((i, square))
+        index = spatialCache.SpatialIndex(3, features)
+
+        self.assertEqual(index.findNearestFeature(12, 22, 1), 21)
+        self.assertEqual(index.findNearestFeature(16, 22, 1.5), 21)
+        self.assertEqual(index.findNearestFeature(17, 22, 1), None)
+        self.assertEqual(index.findFeatures(4, 4, 11, 11), [0, 1, 10, 11])
+
+        self.failUnless(index.patch(21, None))
+        self.failUnless(index.patch(0, GEOSGeometry("POINT(17 22)",
+                                                    srid=4326)))
+        self.assertEqual(index.findNearestFeature(12, 22, 1), None)
+        self.assertEqual(index.findNearestFeature(17, 22, 1), 0)
+        self.assertEqual(index.findFeatures(4, 4, 11, 11), [1, 10, 11])
+
+#############################################################################
+
+class ZipStreamTest(TestCase):
+    def test_archive(self):
+        """
+        Tests that a streamed archive can be read back in, with and without
+        compression.
+        """
+        for compress in [True, False]:
+            archive = zipStream.ZipStream(compress, chunkSize=10)
+            chunks = []
+            chunks.extend(archive.addData(["abc" * 100, "def"], "one.txt"))
+            chunks.extend(archive.addData([], "empty.txt"))
+            chunks.extend(archive.close())
+
+            zip = zipfile.ZipFile(StringIO.StringIO("".join(chunks)))
+            self.assertEqual(zip.testzip(), None)
+            self.assertEqual(zip.read("one.txt"), "abc" * 100 + "def")
+            self.assertEqual(zip.read("empty.txt"), "")
+
+    def test_stored_file(self):
+        """
+        Tests that uncompressed files have their size and CRC in their local
+        header, rather than in a data descriptor.
+        """
+        fd,path = tempfile.mkstemp()
+        os.write(fd, "abc" * 100)
+        os.close(fd)
+        try:
+            archive = zipStream.ZipStream(False, chunkSize=10)
+            chunks = list(archive.addFile(path, "one.txt"))
+            chunks.extend(archive.close())
+        finally:
+            os.remove(path)
+
+        data = "".join(chunks)
+        flags = struct.unpack("<H", data[6:8])[0]
+        crc,compressed,size = struct.unpack("<III", data[14:26])
+        self.assertEqual(flags, 0)
+        self.assertEqual((compressed, size), (300, 300))
+
+        zip = zipfile.ZipFile(StringIO.StringIO(data))
+        self.assertEqual(zip.getinfo("one.txt").CRC, crc)
+        self.assertEqual(zip.read("one.txt"), "abc" * 100)
+
+#############################################################################
+
+class FlatGeobufTest(TestCase):
+    def test_parse_wkb(self):
+        """
+        Tests that WKB geometries are parsed correctly.
+        """
+        geometry = GEOSGeometry("MULTIPOLYGON(((0 0, 2 0, 2 2, 0 0))," +
+                                "((5 5, 6 5, 6 6, 5 5)))")
+        self.assertEqual(utils.parseWKB(geometry.wkb),
+                         ("MultiPolygon",
+                          [("Polygon", [(0, 0, 2, 0, 2, 2, 0, 0)]),
+                           ("Polygon", [(5, 5, 6, 5, 6, 6, 5, 5)])]))
+
+    def test_indexed_file(self):
+        """
+        Tests that the spatial index points at each of the features.
+        """
+        attributes = [Attribute(name="ID", type=ogr.OFTInteger,
+                                width=5, precision=0)]
+        features = []
+        for i in range(20):
+            point = GEOSGeometry("POINT(%d %d)" % (i, 20 - i))
+            features.append((point.wkb, [i]))
+
+        writer = flatgeobuf.FlatGeobufWriter("test", "Point", attributes)
+        data = "".join(writer.generate(features, index=True))
+
+        self.assertEqual(data[:8], "fgb\x03fgb\x00")
+        headerSize = struct.unpack("<I", data[8:12])[0]
+
+        # 20 leaf nodes, 2 nodes in the next level up, and a root node.
+
+        indexStart    = 12 + headerSize
+        featuresStart = indexStart + 23 * 40
+
+        offsets = []
+        for i in range(3, 23):
+            node = data[indexStart+i*40:indexStart+(i+1)*40]
+            minX,minY,maxX,maxY,offset = struct.unpack("<ddddQ", node)
+            self.assertEqual((minX, minY), (maxX, maxY))
+            self.assertEqual(minX + minY, 20)
+            offsets.append(offset)
+
+        self.assertEqual(offsets[0], 0)
+        for offset,nextOffset in zip(offsets, offsets[1:] + [None]):
+            size = struct.unpack("<I", data[featuresStart+offset:
+                                            featuresStart+offset+4])[0]
+            if nextOffset == None:
+                self.assertEqual(featuresStart + offset + 4 + size,
+                                 len(data))
+            else:
+                self.assertEqual(offset + 4 + size, nextOffset)
+
@@ -62,7 +62,7 @@ def service(request, version):
         xml.append('  <Title>ShapeEditor Tile Map Service</Title>')
         xml.append('  <Abstract></Abstract>')
         xml.append('  <TileMaps>')
-        for shapefile in Shapefile.objects.all():
+        for shapefile in Shapefile.objects.filter(deleting=False):
             id = str(shapefile.id)
             xml.append('    <TileMap title="' + shapefile.filename + '"')
             xml.append('             srs="EPSG:4326"')
@@ -99,8 +99,11 @@ def tileMap(request, version, shapefile_id):
         xml.append('  <Title>' + shapefile.filename + '</Title>')
         xml.append('  <Abstract></Abstract>')
         xml.append('  <SRS>EPSG:4326</SRS>')
-        xml.append('  <BoundingBox minx="-180" miny="-90" ' +
-                                  'maxx="180" maxy="90"/>')
+        extent = shapefile.getExtent()
+        if extent == None:
+            extent = (-180, -90, 180, 90)
+        xml.append('  <BoundingBox minx="%s" miny="%s" maxx="%s" maxy="%s"/>'
+                   % extent)
         xml.append('  <Origin x="-180" y="-90"/>')
         xml.append('  <TileFormat width="' + str(TILE_WIDTH) +
                    '" height="' + str(TILE_HEIGHT) + '" ' +
@@ -137,8 +140,7 @@ def tile(request, version, shapefile_id, zoom, x, y):
         if shapefile == None:
             raise Http404
 
-        geometryField = utils.calcGeometryField(shapefile.geom_type)
-        geometryType  = utils.calcGeometryFieldType(shapefile.geom_type)
+        geometryType = utils.calcGeometryFieldType(shapefile.geom_type)
 
         zoom = int(zoom)
         x    = int(x)
@@ -198,19 +200,21 @@ def tile(request, version, shapefile_id, zoom, x, y):
         # Setup our feature layer, which displays the features from the
         # shapefile.
 
-        query = '(select ' + geometryField + ' from "shapeEditor_feature" where shapefile_id=' + str(shapefile.id) + ') as geom'
+        # Mapnik adds a bounding box test for the tile to this query, so
+        # the database can use the combined shapefile and geometry index to
+        # find the features to draw.
 
-	print "QUERY: " + query +":" + geometryField+":" + geometryType
+        query = '(select geometry from "shapeEditor_feature" ' \
+              + 'where shapefile_id=' + str(shapefile.id) + ') as geom'
 
         datasource = mapnik.PostGIS(user=dbSettings['USER'],
                                     password=dbSettings['PASSWORD'],
                                     dbname=dbSettings['NAME'],
                                     table=query,
                                     srid=4326,
-                                    geometry_field=geometryField,
+                                    geometry_field="geometry",
                                     geometry_table='"shapeEditor_feature"')
 
-	print "DATA SOURCE IS " + str(datasource)
         featureLayer = mapnik.Layer("featureLayer")
         featureLayer.datasource = datasource
         featureLayer.styles.append("featureLayerStyle")
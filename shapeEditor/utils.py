@@ -4,9 +4,12 @@
 # application.
 
 from django.contrib.gis.geos.collections import MultiPolygon, MultiLineString
-from osgeo import ogr
+from osgeo import ogr,osr
 import pyproj
 
+import struct
+import threading
+
 #############################################################################
 
 def ogrTypeToGeometryName(ogrType):
@@ -44,206 +47,68 @@ def geometryNameToOGRType(geometryName):
             'LinearRing'         : ogr.wkbLinearRing}.get(geometryName)
 
 
-def getOGRFeatureAttribute(attr, feature, encoding):
-    """ Extract an attribute value from the given OGR feature.
-
-        The parameters are as follows:
-
-            'attr'
-
-                The Attribute object describing the attribute to extract.
+def calcCoordTransform(srs_wkt, toWGS84=True):
+    """ Return the coordinate transformation to use for the given SRS.
 
-            'feature'
+        'srs_wkt' is the spatial reference system of a shapefile, in WKT
+        format.  If 'toWGS84' is True, we return a transformation from that
+        SRS into WGS84 (EPSG:4326), which is what we use to store features
+        in the database.  Otherwise, we return the inverse transformation,
+        from WGS84 back into the shapefile's own SRS.
 
-                The OGR Feature object which we want to extract the attribute
-                value from.
+        If the shapefile's SRS is already equivalent to WGS84, we return None
+        to indicate that no transformation is needed at all.
 
-            'encoding'
-
-                The character encoding to use for string values.
-
-        We attempt to extract the given attribute from the given feature, and
-        convert it to a string for storage in the database.
-
-        Upon completion, we return a (success, result) tuple, where 'success'
-        will be True iff the attribute was successfully extracted, and 'result'
-        is either the attribute's value converted to a string or a suitable
-        error message explaining why the attribute could not be extracted.
+        The transformations are cached, so repeated imports and exports of
+        shapefiles using the same SRS don't have to build a new
+        CoordinateTransformation object each time.  GDAL's transformation
+        objects can't safely be used by more than one thread at once, so
+        each thread has a cache of its own.
     """
-    attrName = str(attr.name)
-
-    if not feature.IsFieldSet(attrName):
-        return (True, None)
-
-    needsEncoding = False
-    if attr.type == ogr.OFTInteger:
-        value = str(feature.GetFieldAsInteger(attrName))
-    elif attr.type == ogr.OFTIntegerList:
-        value = repr(feature.GetFieldAsIntegerList(attrName))
-    elif attr.type == ogr.OFTReal:
-        value = feature.GetFieldAsDouble(attrName)
-        value = "%*.*f" % (attr.width, attr.precision, value)
-    elif attr.type == ogr.OFTRealList:
-        values = feature.GetFieldAsDoubleList(attrName)
-        sValues = []
-        for value in values:
-            sValues.append("%*.*f" % (attr.width, attr.precision, value))
-        value = repr(sValues)
-    elif attr.type == ogr.OFTString:
-        value = feature.GetFieldAsString(attrName)
-        needsEncoding = True
-    elif attr.type == ogr.OFTStringList:
-        value = repr(feature.GetFieldAsStringList(attrName))
-        needsEncoding = True
-    elif attr.type == ogr.OFTDate:
-        parts = feature.GetFieldAsDateTime(attrName)
-        year,month,day,hour,minute,second,tzone = parts
-        value = "%d,%d,%d,%d" % (year,month,day,tzone)
-    elif attr.type == ogr.OFTTime:
-        parts = feature.GetFieldAsDateTime(attrName)
-        year,month,day,hour,minute,second,tzone = parts
-        value = "%d,%d,%d,%d" % (hour,minute,second,tzone)
-    elif attr.type == ogr.OFTDateTime:
-        parts = feature.GetFieldAsDateTime(attrName)
-        year,month,day,hour,minute,second,tzone = parts
-        value = "%d,%d,%d,%d,%d,%d,%d,%d" % (year,month,day,
-                                             hour,minute,second,tzone)
-    else:
-        return (False, "Unsupported attribute type: "+str(attr.type))
-
-    if needsEncoding:
-        try:
-            value = value.decode(encoding)
-        except UnicodeDecodeError:
-            return (False, "Unable to decode value in " +
-                    repr(attrName) + " attribute.&nbsp; " +
-                    "Are you sure you're using the right " +
-                    "character encoding?")
-
-    return (True, value)
-
-
-def setOGRFeatureAttribute(attr, value, feature, encoding):
-    """ Store an attribute value into the given OGR feature.
-
-        The parameters are as follows:
-
-            'attr'
-
-                The Attribute object describing the attribute to store.
+    transforms = getattr(_coordTransforms, "cache", None)
+    if transforms == None:
+        transforms = _coordTransforms.cache = {}
+
+    key = (srs_wkt, toWGS84)
+    if key not in transforms:
+        srcSpatialRef = osr.SpatialReference()
+        srcSpatialRef.ImportFromWkt(srs_wkt)
+
+        dstSpatialRef = osr.SpatialReference()
+        dstSpatialRef.ImportFromEPSG(4326)
+
+        if srcSpatialRef.IsSame(dstSpatialRef):
+            coordTransform = None
+        elif toWGS84:
+            coordTransform = osr.CoordinateTransformation(srcSpatialRef,
+                                                          dstSpatialRef)
+        else:
+            coordTransform = osr.CoordinateTransformation(dstSpatialRef,
+                                                          srcSpatialRef)
+        transforms[key] = coordTransform
+    return transforms[key]
 
-            'value'
 
-                The value to store, as a string.
-
-            'feature'
-
-                The OGR Feature object which we want to store the attribute
-                value into.
-
-            'encoding'
-
-                The character encoding to use for string values.
-
-        We convert the attribute value into the appropriate data type, and
-        store it into the given feature.
-    """
-    attrName = str(attr.name)
-
-    if value == None:
-        feature.UnsetField(attrName)
-        return
-
-    if attr.type == ogr.OFTInteger:
-        feature.SetField(attrName, int(value))
-    elif attr.type == ogr.OFTIntegerList:
-        integers = eval(value)
-        feature.SetFieldIntegerList(attrName, integers)
-    elif attr.type == ogr.OFTReal:
-        feature.SetField(attrName, float(value))
-    elif attr.type == ogr.OFTRealList:
-        floats = []
-        for s in eval(value):
-            floats.append(eval(s))
-        feature.SetFieldDoubleList(attrName, floats)
-    elif attr.type == ogr.OFTString:
-        feature.SetField(attrName, value.encode(encoding))
-    elif attr.type == ogr.OFTStringList:
-        strings = []
-        for s in eval(value):
-            strings.append(s.encode(encoding))
-        feature.SetFieldStringList(attrName, strings)
-    elif attr.type == ogr.OFTDate:
-        parts = value.split(",")
-        year  = int(parts[0])
-        month = int(parts[1])
-        day   = int(parts[2])
-        tzone = int(parts[3])
-        feature.SetField(attrName, year, month, day, 0, 0, 0, tzone)
-    elif attr.type == ogr.OFTTime:
-        parts  = value.split(",")
-        hour   = int(parts[0])
-        minute = int(parts[1])
-        second = int(parts[2])
-        tzone  = int(parts[3])
-        feature.SetField(attrName, 0, 0, 0, hour, minute, second, tzone)
-    elif attr.type == ogr.OFTDateTime:
-        parts = value.split(",")
-        year   = int(parts[0])
-        month  = int(parts[1])
-        day    = int(parts[2])
-        hour   = int(parts[3])
-        minute = int(parts[4])
-        second = int(parts[5])
-        tzone  = int(parts[6])
-        feature.SetField(attrName, year, month, day,
-                         hour, minute, second, tzone)
-
-
-def calcGeometryField(geometryType):
-    """ Return the field to use to store the given type of geometry.
+def calcGeometryFieldType(geometryType):
+    """ Return the type of geometry used to store the given type of geometry.
 
         'geometryType' is a string containing a geometry type, for example
         "Polygon", "Point", "GeometryCollection", etc.
 
-        We return the name of the field within the Feature object to use to
-        store the given type of geometry.
+        We return the type of geometry which will actually be stored in the
+        Feature's 'geometry' field.
 
         Because shapefiles are unable to differentiate between Polygons and
-        MultiPolygons, or between LineStrings and MultiLineStrings, we actually
-        need to store a Polygon object into the MultiPolygon field, and
-        LineString objects within the MultiLineString field.
+        MultiPolygons, or between LineStrings and MultiLineStrings, we
+        actually store Polygon objects as MultiPolygons, and LineString
+        objects as MultiLineStrings, so that all the features in a shapefile
+        have the same type of geometry.
 
         See [http://code.djangoproject.com/ticket/7218] for more details.
 
-        To work around for this, the _calcGeometryField() function maps
-        Polygons to MultiPolygons and LineStrings to MultiLineStrings.  Other
-        geometry types are unchanged.
-
-        Upon completion, we return the name of the field within the Feature
-        database object to use to store geometries of the given type.
-    """
-    if geometryType == "Polygon":
-        return "geom_multipolygon"
-    elif geometryType == "LineString":
-        return "geom_multilinestring"
-    elif geometryType == "Point":
-        return "geom_singlepoint"
-    else:
-        return "geom_" + geometryType.lower()
-
-
-def calcGeometryFieldType(geometryType):
-    """ Return the type of field used to store the given type of geometry.
-
-        'geometry' is a string containing a geometry type, for example
-        "Polygon", "Point", "GeometryCollection", etc.
-
-        We return the name of the type of field which will be used to store
-        this geometry in the database.
-
-        This works in the same way as calcGeometryField(), above, except it
-        returns the type of geometry rather than the field name.
+        To work around for this, this function maps Polygons to MultiPolygons
+        and LineStrings to MultiLineStrings.  Other geometry types are
+        unchanged.
     """
     if geometryType == "Polygon":
         return "MultiPolygon"
@@ -260,10 +125,10 @@ def wrapGEOSGeometry(geometry):
         MultiPolygon object.  Similarly, if the geometry is a LineString, we
         wrap it in a MultiLineString.
 
-        This is used to ensure that imported Polygon and LineString objects can
-        be stored into the appropriate field of the Feature database object.
-        See the definition of the calcGeometryField() function, above, to see
-        why this is necessary.
+        This is used to ensure that imported Polygon and LineString objects are
+        stored using the same type of geometry as the rest of the shapefile.
+        See the definition of the calcGeometryFieldType() function, above, to
+        see why this is necessary.
 
         Upon completion, we return the wrapped object, or the object unchanged
         if it does not need to be wrapped.
@@ -284,8 +149,9 @@ def unwrapGEOSGeometry(geometry):
         is a MultiLineString containing exactly one LineString, we return the
         LineString object.  Otherwise, we return the geometry object unchanged.
 
-        See the definition of the calcGeometryField() function, above, to see
-        why wrapping and unwrapping Polygon and LineString fields is necessary.
+        See the definition of the calcGeometryFieldType() function, above, to
+        see why wrapping and unwrapping Polygon and LineString fields is
+        necessary.
     """
     if geometry.geom_type in ["MultiPolygon", "MultiLineString"]:
         if len(geometry) == 1:
@@ -293,6 +159,19 @@ def unwrapGEOSGeometry(geometry):
     return geometry
 
 
+def unwrapOGRGeometry(geometry):
+    """ Unwrap the given OGR Geometry object.
+
+        This does the same as unwrapGEOSGeometry(), above, for an OGR Geometry
+        object rather than a GEOSGeometry.
+    """
+    if geometry.GetGeometryType() in [ogr.wkbMultiPolygon,
+                                      ogr.wkbMultiLineString]:
+        if geometry.GetGeometryCount() == 1:
+            return geometry.GetGeometryRef(0).Clone()
+    return geometry
+
+
 def calcSearchRadius(latitude, longitude, distance):
     """ Given a distance in meters, return the matching distance in "degrees".
 
@@ -302,20 +181,180 @@ def calcSearchRadius(latitude, longitude, distance):
         by heading 'distance' meters east, west, north or south of the
         specified starting point.
     """
-    geod = pyproj.Geod(ellps="WGS84")
+    return calcSearchRadii([latitude], [longitude], distance)[0]
+
+
+def calcSearchRadii(latitudes, longitudes, distance):
+    """ Calculate the search radius, in "degrees", for a number of points.
+
+        'latitudes' and 'longitudes' are parallel lists of coordinates, and
+        'distance' is a distance in meters.  We return a list holding the
+        search radius for each point, as calculated by calcSearchRadius().
+        Rather than calculating the radius one point at a time, we make a
+        single call to the geodesic library for all four directions from
+        every point.
+    """
+    numPoints = len(latitudes)
+    if numPoints == 0:
+        return []
+
+    lats   = list(latitudes) * 4
+    longs  = list(longitudes) * 4
+    angles = [0] * numPoints + [90] * numPoints + [180] * numPoints \
+           + [270] * numPoints
+    x,y,angle = _geod.fwd(longs, lats, angles, [distance] * (numPoints * 4))
+
+    radii = []
+    for i in range(numPoints):
+        latitude  = lats[i]
+        longitude = longs[i]
+        radii.append(max(0,
+                         y[i] - latitude,                   # North.
+                         x[numPoints + i] - longitude,      # East.
+                         latitude - y[numPoints * 2 + i],   # South.
+                         longitude - x[numPoints * 3 + i])) # West.
+    return radii
+
+
+def calcHilbertValue(x, y, extent):
+    """ Return the position of the given point along a Hilbert curve.
+
+        'x' and 'y' are the coordinates of the point, and 'extent' is a
+        (minX, minY, maxX, maxY) tuple giving the area covered by the curve.
+        We divide this area into a 65536 x 65536 grid, and return the
+        distance along a Hilbert curve through this grid of the cell which
+        contains the given point.
+
+        Sorting features by the Hilbert value of their centre point places
+        features which are close together in space close together in the
+        sorted list.
+    """
+    minX,minY,maxX,maxY = extent
+
+    hilbertX = 0
+    if maxX > minX:
+        hilbertX = int(_HILBERT_MAX * (x - minX) / (maxX - minX))
+    hilbertY = 0
+    if maxY > minY:
+        hilbertY = int(_HILBERT_MAX * (y - minY) / (maxY - minY))
+    hilbertX = min(max(hilbertX, 0), _HILBERT_MAX)
+    hilbertY = min(max(hilbertY, 0), _HILBERT_MAX)
+
+    value = 0
+    s = (_HILBERT_MAX + 1) >> 1
+    while s > 0:
+        rx = (hilbertX & s) > 0
+        ry = (hilbertY & s) > 0
+        value = value + s * s * ((3 * rx) ^ ry)
+        if not ry:
+            if rx:
+                hilbertX = s - 1 - hilbertX
+                hilbertY = s - 1 - hilbertY
+            hilbertX,hilbertY = hilbertY,hilbertX
+        s = s >> 1
+    return value
+
+
+def parseWKB(wkb):
+    """ Parse the given two-dimensional geometry in WKB format.
+
+        We return a (type, data) tuple, where 'type' is the name of the
+        geometry type (for example, "Point" or "MultiPolygon"), and 'data'
+        depends on the type of geometry:
+
+            "Point"       A tuple of (x, y) coordinates.
+
+            "LineString"  A flat tuple of (x1, y1, x2, y2, ...) coordinates.
+
+            "Polygon"     A list of rings, each one a flat tuple of
+                          coordinates as for a LineString.
+
+        For the "MultiPoint", "MultiLineString", "MultiPolygon" and
+        "GeometryCollection" types, 'data' is a list of the member
+        geometries, each one parsed into a (type, data) tuple in the same
+        way.
+
+        We raise a ValueError if the geometry can't be parsed.
+    """
+    try:
+        geometry,offset = _parseWKB(str(wkb), 0)
+    except struct.error, e:
+        raise ValueError("Invalid WKB geometry: " + str(e))
+    return geometry
+
+#############################################################################
+#
+# Private definitions:
+
+# The maximum X and Y coordinates of the grid used by calcHilbertValue().
 
-    radius = 0
-    x,y,angle = geod.fwd(longitude, latitude, 0, distance)
-    radius = max(radius, y-latitude)
+_HILBERT_MAX = (1 << 16) - 1
 
-    x,y,angle = geod.fwd(longitude, latitude, 90, distance)
-    radius = max(radius, x-longitude)
+# The WGS84 ellipsoid, as used by calcSearchRadii().  Setting up a Geod
+# object is relatively expensive, so we only do it once.
 
-    x,y,angle = geod.fwd(longitude, latitude, 180, distance)
-    radius = max(radius, latitude-y)
+_geod = pyproj.Geod(ellps="WGS84")
 
-    x,y,angle = geod.fwd(longitude, latitude, 270, distance)
-    radius = max(radius, longitude-x)
+# Our per-thread caches of coordinate transformations, as used by
+# calcCoordTransform().  Each thread's 'cache' attribute maps a (srs_wkt,
+# toWGS84) tuple to the CoordinateTransformation object to use, or None if
+# no transformation is required.
 
-    return radius
+_coordTransforms = threading.local()
 
+# The WKB geometry types understood by parseWKB().
+
+_WKB_TYPES = {1 : "Point",
+              2 : "LineString",
+              3 : "Polygon",
+              4 : "MultiPoint",
+              5 : "MultiLineString",
+              6 : "MultiPolygon",
+              7 : "GeometryCollection"}
+
+
+def _parseWKB(data, offset):
+    """ Parse the WKB geometry starting at the given offset into 'data'.
+
+        We return a (geometry, offset) tuple, where 'geometry' is the parsed
+        geometry as returned by parseWKB(), and 'offset' is the offset of the
+        first byte following the geometry.
+    """
+    if data[offset] == "\x01":
+        byteOrder = "<"
+    else:
+        byteOrder = ">"
+
+    wkbType = struct.unpack_from(byteOrder + "I", data, offset + 1)[0]
+    offset = offset + 5
+
+    geometryType = _WKB_TYPES.get(wkbType)
+    if geometryType == None:
+        raise ValueError("Unsupported WKB geometry type: %d" % wkbType)
+
+    if geometryType == "Point":
+        coords = struct.unpack_from(byteOrder + "dd", data, offset)
+        return ((geometryType, coords), offset + 16)
+
+    count = struct.unpack_from(byteOrder + "I", data, offset)[0]
+    offset = offset + 4
+
+    if geometryType == "LineString":
+        coords = struct.unpack_from(byteOrder + "%dd" % (count * 2),
+                                    data, offset)
+        return ((geometryType, coords), offset + count * 16)
+    elif geometryType == "Polygon":
+        rings = []
+        for i in range(count):
+            numPoints = struct.unpack_from(byteOrder + "I", data, offset)[0]
+            offset = offset + 4
+            rings.append(struct.unpack_from(byteOrder + "%dd" %
+                                            (numPoints * 2), data, offset))
+            offset = offset + numPoints * 16
+        return ((geometryType, rings), offset)
+    else:
+        members = []
+        for i in range(count):
+            member,offset = _parseWKB(data, offset)
+            members.append(member)
+        return ((geometryType, members), offset)
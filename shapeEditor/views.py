@@ -2,28 +2,94 @@
 #
 # This module contains the various views for the ShapeEditor application.
 
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
 from django.http import HttpResponse,HttpResponseRedirect
+from django.http import HttpResponseBadRequest, HttpResponseNotAllowed
 from django.template import RequestContext
 from django.shortcuts import render_to_response
-from django.contrib.gis.geos import Point
+from osgeo import ogr
 
-from geoedit.shapeEditor.models import Shapefile, Feature
+from geoedit.shapeEditor.models import Shapefile, Attribute, Feature
+from geoedit.shapeEditor.models import getShapefileListVersion
+from geoedit.shapeEditor.models import shapefileListChanged
 from geoedit.shapeEditor.forms  import ImportShapefileForm
 
+import base64
+import hashlib
+import json
+import threading
 import traceback
 
+import edits
+import exportCache
+import featureStore
+import filters
 import shapefileEditor
 import shapefileIO
+import spatialCache
 import utils
 
+# The default and maximum number of features returned by queryFeatures().
+
+DEFAULT_QUERY_LIMIT = 100
+MAX_QUERY_LIMIT     = 1000
+
+# How close, in pixels, the user has to click to a feature to select it.
+
+HIT_TOLERANCE = 5
+
+# The search radius, in meters, to use when the client doesn't tell us the
+# map's resolution.
+
+DEFAULT_HIT_RADIUS = 100
+
+# The maximum number of points which can be looked up by findFeatures().
+
+MAX_BATCH_POINTS = 10000
+
+# The maximum number of changes which can be made by editFeatures().
+
+MAX_BATCH_EDITS = 10000
+
+# The number of shapefiles shown on each page of the list of shapefiles.
+
+LIST_PAGE_SIZE = 100
+
+# How long, in seconds, to cache each page of the list of shapefiles.  The
+# cached pages are discarded as soon as the list changes, so this only
+# limits how long other processes can see a stale list when the cache isn't
+# shared between them.
+
+LIST_CACHE_TIMEOUT = 60
+
 #############################################################################
 
 def listShapefiles(request):
     """ Display a list of the available shapefiles.
+
+        The shapefiles are listed one page at a time, sorted by filename.
+        The optional "after" query parameter holds the key returned with
+        the previous page, so that we can carry on from where that page
+        left off.
     """
-    shapefiles = Shapefile.objects.all().order_by('filename')
+    after = None
+    if request.GET.get("after"):
+        after = _decodeQueryKey(request.GET['after'], None)
+        if after == None or not isinstance(after[0], basestring):
+            return HttpResponseBadRequest("Invalid key: " +
+                                          request.GET['after'])
+
+    shapefiles,nextKey = _getShapefileList(after)
+
+    if nextKey != None:
+        nextKey = _encodeQueryKey(nextKey)
+
     return render_to_response("listShapefiles.html",
-                              {'shapefiles' : shapefiles})
+                              {'shapefiles' : shapefiles,
+                               'isFirst'    : after == None,
+                               'next'       : nextKey})
 
 #############################################################################
 
@@ -42,7 +108,9 @@ def importShapefile(request):
         if form.is_valid():
             shapefile = request.FILES['import_file']
             encoding = request.POST['character_encoding']
-            errMsg = shapefileIO.importData(shapefile, encoding)
+            duplicateAction = form.cleaned_data['duplicate_action']
+            errMsg = shapefileIO.importData(shapefile, encoding,
+                                            duplicateAction)
             if errMsg == None:
                 return HttpResponseRedirect("/shape-editor")
 
@@ -54,15 +122,190 @@ def importShapefile(request):
 
 def exportShapefile(request, shapefile_id):
     """ Let the user export the given shapefile.
+
+        By default, the exported shapefile is compressed.  If the request
+        includes a "compression=store" query parameter, the shapefile is sent
+        without compression, which is faster when downloading across a fast
+        local network.
+
+        The request can also include "bbox", "polygon" and "where" query
+        parameters to export just some of the shapefile's features; see
+        filters.parseFilter() for details.  Filtered exports aren't cached.
+    """
+    shapefile = Shapefile.objects.get(id=shapefile_id)
+    if shapefile != None:
+        try:
+            featureFilter = filters.parseFilter(shapefile, request.GET)
+        except filters.FilterError, e:
+            return HttpResponseBadRequest(unicode(e))
+
+        compress = (request.GET.get("compression") != "store")
+        if featureFilter == None:
+            return exportCache.getExportResponse(request, shapefile,
+                                                 compress)
+        else:
+            return shapefileIO.exportData(shapefile, compress,
+                                          featureFilter)
+    else:
+        return HttpResponseRedirect("/shape-editor")
+
+#############################################################################
+
+def exportGeoJSON(request, shapefile_id):
+    """ Export the given shapefile as newline-delimited GeoJSON.
+
+        As with exportShapefile(), the request can include query parameters
+        to export just some of the shapefile's features.
+
+        Alternatively, the request can include a "since" query parameter,
+        holding the version number returned by an earlier export in its
+        "X-ShapeEditor-Version" header.  In this case, we only export the
+        features which have been inserted, updated or deleted since then.
+    """
+    shapefile = Shapefile.objects.get(id=shapefile_id)
+    if shapefile != None:
+        try:
+            featureFilter = filters.parseFilter(shapefile, request.GET)
+        except filters.FilterError, e:
+            return HttpResponseBadRequest(unicode(e))
+
+        sinceVersion = None
+        if request.GET.get("since"):
+            try:
+                sinceVersion = int(request.GET['since'])
+            except ValueError:
+                return HttpResponseBadRequest("Invalid version: " +
+                                              request.GET['since'])
+            if featureFilter != None:
+                return HttpResponseBadRequest("Changes can't be filtered.")
+
+        return shapefileIO.exportGeoJSON(shapefile, featureFilter,
+                                         sinceVersion)
+    else:
+        return HttpResponseRedirect("/shape-editor")
+
+#############################################################################
+
+def exportFlatGeobuf(request, shapefile_id):
+    """ Export the given shapefile in FlatGeobuf format.
+
+        By default, the exported file includes a spatial index.  If the
+        request includes an "index=0" query parameter, the index is left out
+        so that the file can be sent without waiting for the index to be
+        built.  As with exportShapefile(), the request can include query
+        parameters to export just some of the shapefile's features.
     """
     shapefile = Shapefile.objects.get(id=shapefile_id)
     if shapefile != None:
-        return shapefileIO.exportData(shapefile)
+        try:
+            featureFilter = filters.parseFilter(shapefile, request.GET)
+        except filters.FilterError, e:
+            return HttpResponseBadRequest(unicode(e))
+
+        index = (request.GET.get("index") != "0")
+        if featureFilter == None:
+            return exportCache.getFlatGeobufResponse(request, shapefile,
+                                                     index)
+        else:
+            return shapefileIO.exportFlatGeobuf(shapefile, index,
+                                                featureFilter)
     else:
         return HttpResponseRedirect("/shape-editor")
 
 #############################################################################
 
+def queryFeatures(request, shapefile_id):
+    """ Return one page of the given shapefile's features, as GeoJSON.
+
+        As with exportShapefile(), the request can include "bbox", "polygon"
+        and "where" query parameters to select just some of the shapefile's
+        features.  The following query parameters are also supported:
+
+            'sort'
+
+                The name of the attribute to sort the features by.  Prefix
+                the name with "-" to sort in descending order.  By default,
+                the features are sorted by record ID.
+
+            'limit'
+
+                The maximum number of features to return, from 1 to
+                MAX_QUERY_LIMIT.  Defaults to DEFAULT_QUERY_LIMIT.
+
+            'after'
+
+                The "next" value returned by a previous query, to retrieve
+                the following page of features.
+
+        We return a GeoJSON FeatureCollection object holding the selected
+        features.  The object's "next" member is the value to pass as the
+        'after' parameter to retrieve the next page of features, or null if
+        there are no more features.
+    """
+    try:
+        shapefile = Shapefile.objects.get(id=shapefile_id)
+    except Shapefile.DoesNotExist:
+        return HttpResponseRedirect("/shape-editor")
+
+    try:
+        featureFilter = filters.parseFilter(shapefile, request.GET)
+    except filters.FilterError, e:
+        return HttpResponseBadRequest(unicode(e))
+
+    sortAttr   = None
+    descending = False
+    if request.GET.get("sort"):
+        name = request.GET['sort']
+        if name.startswith("-"):
+            name = name[1:]
+            descending = True
+        try:
+            sortAttr = shapefile.attribute_set.get(name=name)
+        except Attribute.DoesNotExist:
+            return HttpResponseBadRequest("Unknown attribute: " + name)
+        if sortAttr.type not in featureStore.SCALAR_TYPES:
+            return HttpResponseBadRequest("Unable to sort on attribute: " +
+                                          name)
+
+    limit = DEFAULT_QUERY_LIMIT
+    if request.GET.get("limit"):
+        try:
+            limit = int(request.GET['limit'])
+        except ValueError:
+            limit = 0
+        if limit < 1 or limit > MAX_QUERY_LIMIT:
+            return HttpResponseBadRequest("Invalid limit: " +
+                                          request.GET['limit'])
+
+    after = None
+    if request.GET.get("after"):
+        after = _decodeQueryKey(request.GET['after'], sortAttr)
+        if after == None:
+            return HttpResponseBadRequest("Invalid key: " +
+                                          request.GET['after'])
+
+    features,nextKey = featureStore.queryFeatures(shapefile, featureFilter,
+                                                  sortAttr, descending,
+                                                  limit, after)
+
+    names = [attr.name for attr in shapefile.attribute_set.all()]
+
+    result = {'type'     : "FeatureCollection",
+              'features' : [],
+              'next'     : None}
+    for featureId,wkb,values in features:
+        result['features'].append(
+            shapefileIO.makeGeoJSONFeature(featureId, wkb, values, names))
+    if nextKey != None:
+        result['next'] = _encodeQueryKey(nextKey)
+
+    response = HttpResponse(json.dumps(result),
+                            content_type="application/json")
+    response['X-ShapeEditor-Version'] = str(shapefile.version)
+    return response
+
+#############################################################################
+
 def editShapefile(request, shapefile_id):
     """ Let the user edit the given shapefile.
 
@@ -86,12 +329,29 @@ def editShapefile(request, shapefile_id):
 
 def deleteShapefile(request, shapefile_id):
     """ Let the user delete the given shapefile.
+
+        If the shapefile has more features than the
+        SHAPEEDITOR_BACKGROUND_DELETE_THRESHOLD setting, the shapefile is
+        hidden straight away and then deleted in the background, so that the
+        user doesn't have to wait.  Either way, any cached exports of the
+        shapefile are removed once it has been deleted.
     """
     shapefile = Shapefile.objects.get(id=shapefile_id)
 
     if request.method == "POST":
-        if request.POST['confirm'] == "1":
-            shapefile.delete()
+        if request.POST['confirm'] == "1" and not shapefile.deleting:
+            threshold = getattr(settings,
+                                "SHAPEEDITOR_BACKGROUND_DELETE_THRESHOLD",
+                                100000)
+            if threshold != None and shapefile.num_features > threshold:
+                Shapefile.objects.filter(id=shapefile.id).update(
+                                                        deleting=True)
+                shapefileListChanged()
+                thread = threading.Thread(target=_deleteShapefile,
+                                          args=(shapefile.id, True))
+                thread.start()
+            else:
+                _deleteShapefile(shapefile.id)
         return HttpResponseRedirect("/shape-editor")
 
     return render_to_response("deleteShapefile.html",
@@ -101,48 +361,106 @@ def deleteShapefile(request, shapefile_id):
 
 def findFeature(request):
     """ See if the user clicked on a feature in our shapefile.
+
+        The request's parameters give the shapefile's ID, the latitude and
+        longitude of the clicked-on point, and the map's current resolution
+        in degrees per pixel.  We find the feature closest to the clicked-on
+        point, up to HIT_TOLERANCE pixels away, and return the URL for
+        editing that feature, or an empty response if the user didn't click
+        on a feature.
     """
     try:
         shapefile_id = int(request.GET['shapefile_id'])
         latitude     = float(request.GET['latitude'])
         longitude    = float(request.GET['longitude'])
+        shapefile    = Shapefile.objects.get(id=shapefile_id, deleting=False)
+    except (KeyError, ValueError, Shapefile.DoesNotExist):
+        return HttpResponse("")
 
-        shapefile = Shapefile.objects.get(id=shapefile_id)
-        pt = Point(longitude, latitude)
-        radius = utils.calcSearchRadius(latitude, longitude, 100) # 100 meters.
-
-        if shapefile.geom_type == "Point":
-            query = Feature.objects.filter(
-                geom_singlepoint__dwithin=(pt, radius))
-        elif shapefile.geom_type in ["LineString", "MultiLineString"]:
-            query = Feature.objects.filter(
-                geom_multilinestring__dwithin=(pt, radius))
-        elif shapefile.geom_type in ["Polygon", "MultiPolygon"]:
-            query = Feature.objects.filter(
-                geom_multipolygon__dwithin=(pt, radius))
-        elif shapefile.geom_type == "MultiPoint":
-            query = Feature.objects.filter(
-                geom_multipoint__dwithin=(pt, radius))
-        elif shapefile.geom_type == "GeometryCollection":
-            query = feature.objects.filter(
-                geom_geometrycollection__dwithin=(pt, radius))
-        else:
-            print "Unsupported geometry: " + feature.geom_type
-            return ""
+    radius = _calcHitRadius(request.GET, latitude, longitude)
+    index  = spatialCache.getIndex(shapefile)
+    if index != None:
+        featureId = index.findNearestFeature(longitude, latitude, radius)
+    else:
+        featureId = featureStore.findNearestFeature(shapefile, longitude,
+                                                    latitude, radius)
+    if featureId == None:
+        return HttpResponse("")
 
-        if query.count() != 1:
-            # We don't have exactly one hit -> ignore the click.
-            return HttpResponse("")
+    # Success!  Return the URL for the "edit" view for the selected feature.
 
-        # Success!  Redirect the user to the "edit" view for the selected
-        # feature.
+    return HttpResponse("/shape-editor/editFeature/" +
+                        str(shapefile_id) + "/" + str(featureId))
 
-        feature = query.all()[0]
-        return HttpResponse("/shape-editor/editFeature/" +\
-                            str(shapefile_id) + "/" + str(feature.id))
-    except:
-        traceback.print_exc()
-        return HttpResponse("")
+#############################################################################
+
+def findFeatures(request, shapefile_id):
+    """ Find the features hit by a number of points.
+
+        This is a batch version of findFeature(), for resolving many points
+        at once.  The following request parameters are supported, either in
+        the query string or as POSTed form data:
+
+            'points'
+
+                A JSON array of [longitude, latitude] pairs, holding up to
+                MAX_BATCH_POINTS points.
+
+            'tolerance'
+
+                The maximum distance, in meters, a feature can be from a
+                point and still be hit.  Defaults to DEFAULT_HIT_RADIUS.
+
+        We return a JSON object whose "features" member is an array holding
+        the record ID of the feature closest to each point, or null if no
+        feature is within the tolerance of that point.
+    """
+    try:
+        shapefile = Shapefile.objects.get(id=shapefile_id, deleting=False)
+    except Shapefile.DoesNotExist:
+        return HttpResponseRedirect("/shape-editor")
+
+    if request.method == "POST":
+        params = request.POST
+    else:
+        params = request.GET
+
+    try:
+        points = [(float(longitude), float(latitude))
+                  for longitude,latitude in json.loads(params['points'])]
+    except (KeyError, TypeError, ValueError):
+        return HttpResponseBadRequest("Invalid points.")
+    if len(points) > MAX_BATCH_POINTS:
+        return HttpResponseBadRequest("Too many points.")
+
+    tolerance = DEFAULT_HIT_RADIUS
+    if params.get("tolerance"):
+        try:
+            tolerance = float(params['tolerance'])
+        except ValueError:
+            tolerance = -1
+        if not tolerance >= 0:
+            return HttpResponseBadRequest("Invalid tolerance: " +
+                                          params['tolerance'])
+
+    longitudes = [longitude for longitude,latitude in points]
+    latitudes  = [latitude for longitude,latitude in points]
+    radii = utils.calcSearchRadii(latitudes, longitudes, tolerance)
+
+    index = spatialCache.getIndex(shapefile)
+    if index != None:
+        featureIds = []
+        for longitude,latitude,radius in zip(longitudes, latitudes, radii):
+            featureIds.append(index.findNearestFeature(longitude, latitude,
+                                                       radius))
+    else:
+        featureIds = featureStore.findNearestFeatures(
+                            shapefile, zip(longitudes, latitudes, radii))
+
+    response = HttpResponse(json.dumps({'features' : featureIds}),
+                            content_type="application/json")
+    response['X-ShapeEditor-Version'] = str(shapefile.version)
+    return response
 
 #############################################################################
 
@@ -151,37 +469,38 @@ def editFeature(request, shapefile_id, feature_id=None):
 
         'feature_id' will be None if we are adding a new feature.
     """
-    shapefile = Shapefile.objects.get(id=shapefile_id)
-
     if request.method == "POST" and "delete" in request.POST:
         # User clicked on the "Delete" button -> show "Delete Feature" page.
         return HttpResponseRedirect("/shape-editor/deleteFeature/" +
                                     shapefile_id + "/" + feature_id)
 
-    geometryField = utils.calcGeometryField(shapefile.geom_type)
-
-    formType = shapefileEditor.getMapForm(shapefile)
-
     if feature_id == None:
         # Adding a new feature.
+        shapefile = Shapefile.objects.get(id=shapefile_id)
         feature = Feature(shapefile=shapefile)
-        attributes = []
     else:
-        # Editing an existing feature.
-        feature = Feature.objects.get(id=feature_id)
+        # Editing an existing feature.  We load the feature and its
+        # shapefile using a single query.
+        feature = Feature.objects.select_related("shapefile").get(
+                                    id=feature_id, shapefile__id=shapefile_id)
+        shapefile = feature.shapefile
+
+    formType = shapefileEditor.getMapForm(shapefile)
 
-    # Get the attributes for this feature.
+    # Get the attributes for this feature.  Because the feature's attribute
+    # values are stored along with the feature itself, this only needs a
+    # single query, no matter how many attributes the shapefile has.
 
     attributes = [] # List of (name, value) tuples.
-    for attrValue in feature.attributevalue_set.all():
-        attributes.append([attrValue.attribute.name,
-                           attrValue.value])
+    for attr in shapefile.attribute_set.all():
+        attributes.append([attr.name,
+                           feature.attributes.get(attr.name)])
     attributes.sort()
 
     # Display the form.
 
     if request.method == "GET":
-        wkt = getattr(feature, geometryField)
+        wkt = feature.geometry
         form = formType({'geometry' : wkt})
         return render_to_response("editFeature.html",
                                   {'shapefile'  : shapefile,
@@ -192,8 +511,11 @@ def editFeature(request, shapefile_id, feature_id=None):
         try:
             if form.is_valid():
                 wkt = form.cleaned_data['geometry']
-                setattr(feature, geometryField, wkt)
-                feature.save()
+                oldGeometry = feature.geometry
+                feature.geometry = wkt
+                featureStore.saveFeature(shapefile, feature, oldGeometry)
+                spatialCache.featureChanged(shapefile, feature.id,
+                                            feature.geometry)
                 # Return the user to the "select feature" page.
                 return HttpResponseRedirect("/shape-editor/edit/" +
                                             shapefile_id)
@@ -207,18 +529,223 @@ def editFeature(request, shapefile_id, feature_id=None):
 
 #############################################################################
 
+def editFeatures(request, shapefile_id):
+    """ Apply a batch of edits to the given shapefile's features.
+
+        The edits are POSTed as a 'changes' parameter, holding a JSON array
+        of up to MAX_BATCH_EDITS changes in the format described by
+        edits.parseEdits().  The whole batch is applied in a single
+        transaction: if any of the changes can't be made, none of them are.
+
+        We return a JSON object with the following members:
+
+            'inserted'
+
+                An array holding the record IDs of the inserted features, in
+                the order they were given.
+
+            'version'
+
+                The shapefile's new version number.
+
+            'extent'
+
+                The [minX, minY, maxX, maxY] extent covering the old and new
+                geometries of every changed feature, so that the client knows
+                which part of the map to redraw, or null if no geometries
+                were changed.
+    """
+    try:
+        shapefile = Shapefile.objects.get(id=shapefile_id, deleting=False)
+    except Shapefile.DoesNotExist:
+        return HttpResponseRedirect("/shape-editor")
+
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    try:
+        changes = json.loads(request.POST['changes'])
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest("Invalid changes.")
+    if isinstance(changes, list) and len(changes) > MAX_BATCH_EDITS:
+        return HttpResponseBadRequest("Too many changes.")
+
+    try:
+        featureEdits = edits.parseEdits(shapefile, changes)
+        insertedIds,extent = featureStore.applyEdits(shapefile,
+                                                     featureEdits)
+    except edits.EditError, e:
+        return HttpResponseBadRequest(unicode(e))
+    except Feature.DoesNotExist, e:
+        return HttpResponseBadRequest(unicode(e))
+
+    # Bring the shapefile's spatial index up to date, in a single pass.
+
+    changed = [(featureId, None) for featureId in featureEdits.deletes]
+    for featureId,geometry,values in featureEdits.updates:
+        if geometry != None:
+            changed.append((featureId, geometry))
+    for featureId,(geometry,values) in zip(insertedIds,
+                                           featureEdits.inserts):
+        changed.append((featureId, geometry))
+    spatialCache.featuresChanged(shapefile, changed)
+
+    result = {'inserted' : insertedIds,
+              'version'  : shapefile.version,
+              'extent'   : extent}
+
+    response = HttpResponse(json.dumps(result),
+                            content_type="application/json")
+    response['X-ShapeEditor-Version'] = str(shapefile.version)
+    return response
+
+#############################################################################
+
 def deleteFeature(request, shapefile_id, feature_id):
     """ Let the user delete the given feature.
     """
-    feature = Feature.objects.get(id=feature_id)
+    feature = Feature.objects.get(id=feature_id, shapefile__id=shapefile_id)
 
     if request.method == "GET":
         return render_to_response("deleteFeature.html",
                                   {'feature' : feature})
     elif request.method == "POST":
         if request.POST['confirm'] == "1":
-            feature.delete()
+            featureId = feature.id
+            featureStore.deleteFeature(feature.shapefile, feature)
+            spatialCache.featureChanged(feature.shapefile, featureId, None)
         # Return the user to the "select feature" page.
         return HttpResponseRedirect("/shape-editor/edit/" +
                                     shapefile_id)
 
+#############################################################################
+#
+# Private definitions:
+
+def _deleteShapefile(shapefileId, inBackground=False):
+    """ Delete the given shapefile, and remove its cached exports and index.
+
+        If 'inBackground' is True, we are running in a thread of our own,
+        and so have to close our database connection when we're done.
+    """
+    try:
+        shapefile = Shapefile.objects.get(id=shapefileId)
+        featureStore.deleteShapefile(shapefile)
+        exportCache.purge(shapefileId)
+        spatialCache.discard(shapefileId)
+    except:
+        traceback.print_exc()
+        if not inBackground:
+            raise
+
+    if inBackground:
+        connection.close()
+
+
+def _getShapefileList(after):
+    """ Return one page of the list of shapefiles.
+
+        'after' is the (filename, id) key of the last shapefile on the
+        previous page, or None to return the first page.  We return a
+        (shapefiles, nextKey) tuple, where 'shapefiles' is a list of
+        dictionaries describing the shapefiles on this page and 'nextKey' is
+        the key to use for the next page, or None if this is the last page.
+
+        The shapefile statistics are stored with the shapefile, so the page
+        is loaded using a single query, using just the columns we display.
+        The page is then cached until the list of shapefiles changes.
+    """
+    if after == None:
+        pageKey = ""
+    else:
+        pageKey = _encodeQueryKey(after)
+    cacheKey = "shapeEditor-shapefileList-%d-%s" \
+             % (getShapefileListVersion(), hashlib.md5(pageKey).hexdigest())
+
+    page = cache.get(cacheKey)
+    if page != None:
+        return page
+
+    query = Shapefile.objects.filter(deleting=False)
+    if after != None:
+        # A row comparison lets the database start reading the index on
+        # (filename, id) straight after the previous page.
+        qn = connection.ops.quote_name
+        query = query.extra(where=["(" + qn("filename") + ", " + qn("id") +
+                                   ") > (%s, %s)"],
+                            params=[after[0], after[1]])
+    query = query.order_by("filename", "id")
+    query = query.values("id", "filename", "num_features", "num_vertices",
+                         "min_x", "min_y", "max_x", "max_y", "modified")
+
+    shapefiles = list(query[:LIST_PAGE_SIZE+1])
+    nextKey = None
+    if len(shapefiles) > LIST_PAGE_SIZE:
+        shapefiles = shapefiles[:LIST_PAGE_SIZE]
+        nextKey = (shapefiles[-1]['filename'], shapefiles[-1]['id'])
+
+    for shapefile in shapefiles:
+        if shapefile['min_x'] == None:
+            shapefile['extent'] = None
+        else:
+            shapefile['extent'] = (shapefile['min_x'], shapefile['min_y'],
+                                   shapefile['max_x'], shapefile['max_y'])
+
+    page = (shapefiles, nextKey)
+    cache.set(cacheKey, page, LIST_CACHE_TIMEOUT)
+    return page
+
+
+def _calcHitRadius(params, latitude, longitude):
+    """ Return the search radius, in degrees, to use for hit-testing.
+
+        'params' is a QueryDict holding the request's parameters.  If the
+        client gave us the map's resolution, in degrees per pixel, the radius
+        covers HIT_TOLERANCE pixels at that resolution.  Otherwise, we fall
+        back to a radius of DEFAULT_HIT_RADIUS meters around the given point.
+    """
+    try:
+        resolution = float(params['resolution'])
+    except (KeyError, ValueError):
+        resolution = None
+
+    if resolution == None or not resolution > 0:
+        return utils.calcSearchRadius(latitude, longitude,
+                                      DEFAULT_HIT_RADIUS)
+    return resolution * HIT_TOLERANCE
+
+
+def _encodeQueryKey(key):
+    """ Convert a key returned by featureStore.queryFeatures() to a string.
+    """
+    return base64.urlsafe_b64encode(json.dumps(key))
+
+
+def _decodeQueryKey(value, sortAttr):
+    """ Convert a string created by _encodeQueryKey() back into a key.
+
+        'sortAttr' is the Attribute object the features are sorted by, or
+        None.  We return None if the string isn't a valid key for a query
+        sorted by that attribute.
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(str(value)))
+    except (TypeError, ValueError, UnicodeEncodeError):
+        return None
+    if (not isinstance(key, list) or len(key) != 2
+        or not isinstance(key[1], (int, long))):
+        return None
+
+    sortValue = key[0]
+    if sortAttr == None or sortValue == None:
+        valid = True
+    elif sortAttr.type == ogr.OFTInteger:
+        valid = isinstance(sortValue, (int, long))
+    elif sortAttr.type == ogr.OFTReal:
+        valid = isinstance(sortValue, (int, long, float))
+    else:
+        valid = isinstance(sortValue, basestring)
+
+    if not valid:
+        return None
+    return tuple(key)
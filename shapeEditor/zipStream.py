@@ -0,0 +1,199 @@
+# zipStream.py
+#
+# This module implements a ZIP archive writer which generates the archive as
+# a sequence of chunks, rather than writing it to a file.
+#
+# Python's zipfile module needs to seek backwards to fill in each member's
+# size and CRC once the member has been written, so it can't be used to send
+# a ZIP archive to the user's web browser as it is being built.  Instead, we
+# write each member's size and CRC into a "data descriptor" following the
+# member's data, which lets us send every chunk of the archive as soon as it
+# has been generated.
+#
+# Some streaming ZIP readers can't find the end of a member which is stored
+# without compression unless its size is given in the member's local header.
+# When adding a file without compressing it, we therefore read through the
+# file to calculate its size and CRC first, and write them into the local
+# header rather than using a data descriptor.
+#
+# Note that we don't support the ZIP64 extensions, so neither the archive
+# nor any of its members can be larger than 4GB.
+
+import struct
+import time
+import zlib
+
+#############################################################################
+
+class ZipStream(object):
+    """ A ZIP archive which is generated as a sequence of chunks.
+
+        To use this, call addFile() for each file to add to the archive, and
+        then call close() to finish the archive off.  Both of these are
+        generators, yielding the chunks of data making up the archive.
+    """
+    def __init__(self, compress=True, chunkSize=65536):
+        """ Initialise our ZipStream.
+
+            If 'compress' is True, the archive's members will be compressed.
+            Otherwise, they will simply be stored in the archive without
+            compression, which is faster but results in a larger archive.
+            'chunkSize' is the number of bytes to read from each file at once.
+        """
+        self._compress  = compress
+        self._chunkSize = chunkSize
+        self._offset    = 0  # Number of bytes generated so far.
+        self._entries   = [] # List of central directory entries.
+
+
+    def addFile(self, path, arcname):
+        """ Add the given file to the archive.
+
+            'path' is the path to the file to add, and 'arcname' is the name
+            to use for the file within the archive.
+        """
+        f = open(path, "rb")
+        try:
+            checksum = None
+            if not self._compress:
+                crc  = 0
+                size = 0
+                for chunk in self._readChunks(f):
+                    crc  = zlib.crc32(chunk, crc)
+                    size = size + len(chunk)
+                checksum = (crc & 0xFFFFFFFF, size)
+                f.seek(0)
+
+            for chunk in self._addMember(self._readChunks(f), arcname,
+                                         checksum):
+                yield chunk
+        finally:
+            f.close()
+
+
+    def addData(self, chunks, arcname):
+        """ Add a member to the archive, using the given data.
+
+            'chunks' is an iterable yielding the member's contents, and
+            'arcname' is the name to use for the member within the archive.
+        """
+        return self._addMember(chunks, arcname)
+
+
+    def close(self):
+        """ Finish off the archive by writing the central directory.
+        """
+        directoryOffset = self._offset
+        directory = "".join(self._entries)
+        yield self._emit(directory +
+                         struct.pack("<IHHHHIIH", _END_OF_DIRECTORY_SIG,
+                                     0, 0, len(self._entries),
+                                     len(self._entries), len(directory),
+                                     directoryOffset, 0))
+
+    # =====================
+    # == PRIVATE METHODS ==
+    # =====================
+
+    def _addMember(self, chunks, arcname, checksum=None):
+        """ Add a member to the archive, yielding the archive's chunks.
+
+            'chunks' and 'arcname' are as for addData().  If the member is
+            stored without compression, 'checksum' can be set to the
+            member's (crc, size) tuple, which is then written into the
+            member's local header instead of a data descriptor.
+        """
+        if self._compress:
+            method = _ZIP_DEFLATED
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                          zlib.DEFLATED, -15)
+        else:
+            method = _ZIP_STORED
+            compressor = None
+
+        dosTime,dosDate = _dosDateTime(time.localtime())
+        headerOffset = self._offset
+
+        if checksum != None and compressor == None:
+            flags = 0
+            headerCRC,headerSize = checksum
+        else:
+            flags = _FLAG_DATA_DESCRIPTOR
+            headerCRC,headerSize = (0, 0)
+
+        yield self._emit(struct.pack("<IHHHHHIIIHH", _LOCAL_HEADER_SIG,
+                                     20, flags, method, dosTime, dosDate,
+                                     headerCRC, headerSize, headerSize,
+                                     len(arcname), 0) + arcname)
+
+        crc        = 0
+        size       = 0
+        compressed = 0
+        for chunk in chunks:
+            crc  = zlib.crc32(chunk, crc)
+            size = size + len(chunk)
+            if compressor != None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                compressed = compressed + len(chunk)
+                yield self._emit(chunk)
+
+        if compressor != None:
+            chunk = compressor.flush()
+            compressed = compressed + len(chunk)
+            yield self._emit(chunk)
+
+        crc = crc & 0xFFFFFFFF
+        if flags & _FLAG_DATA_DESCRIPTOR:
+            yield self._emit(struct.pack("<IIII", _DATA_DESCRIPTOR_SIG,
+                                         crc, compressed, size))
+
+        self._entries.append(struct.pack("<IHHHHHHIIIHHHHHII",
+                                         _CENTRAL_HEADER_SIG, 20, 20,
+                                         flags, method,
+                                         dosTime, dosDate, crc, compressed,
+                                         size, len(arcname), 0, 0, 0, 0, 0,
+                                         headerOffset) + arcname)
+
+
+    def _emit(self, data):
+        """ Keep track of the number of bytes generated so far.
+
+            We return 'data' unchanged.
+        """
+        self._offset = self._offset + len(data)
+        return data
+
+
+    def _readChunks(self, f):
+        """ Read the contents of the given file, one chunk at a time.
+        """
+        while True:
+            chunk = f.read(self._chunkSize)
+            if not chunk:
+                break
+            yield chunk
+
+#############################################################################
+#
+# Private definitions:
+
+_LOCAL_HEADER_SIG      = 0x04034b50
+_DATA_DESCRIPTOR_SIG   = 0x08074b50
+_CENTRAL_HEADER_SIG    = 0x02014b50
+_END_OF_DIRECTORY_SIG  = 0x06054b50
+
+_FLAG_DATA_DESCRIPTOR  = 0x0008
+
+_ZIP_STORED            = 0
+_ZIP_DEFLATED          = 8
+
+
+def _dosDateTime(timestamp):
+    """ Convert the given time.struct_time value to a DOS (time, date) tuple.
+    """
+    year,month,day,hour,minute,second = timestamp[:6]
+    dosTime = (hour << 11) | (minute << 5) | (second // 2)
+    dosDate = ((max(year, 1980) - 1980) << 9) | (month << 5) | day
+    return (dosTime, dosDate)
+
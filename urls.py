@@ -9,12 +9,20 @@ urlpatterns = patterns('geoedit.shapeEditor.views',
             'importShapefile'),
        (r'^shape-editor/export/(?P<shapefile_id>\d+)$',
             'exportShapefile'),
+       (r'^shape-editor/export/(?P<shapefile_id>\d+)/geojson$',
+            'exportGeoJSON'),
+       (r'^shape-editor/export/(?P<shapefile_id>\d+)/flatgeobuf$',
+            'exportFlatGeobuf'),
+       (r'^shape-editor/query/(?P<shapefile_id>\d+)$',
+            'queryFeatures'),
        (r'^shape-editor/edit/(?P<shapefile_id>\d+)$',
             'editShapefile'),
        (r'^shape-editor/delete/(?P<shapefile_id>\d+)$',
             'deleteShapefile'),
        (r'^shape-editor/findFeature$',
             'findFeature'),
+       (r'^shape-editor/findFeatures/(?P<shapefile_id>\d+)$',
+            'findFeatures'),
        (r'^shape-editor/addFeature/(?P<shapefile_id>\d+)$',
             'editFeature'), # feature_id = None -> add.
        (r'^shape-editor/editFeature/(?P<shapefile_id>\d+)/' +
@@ -23,6 +31,8 @@ urlpatterns = patterns('geoedit.shapeEditor.views',
        (r'^shape-editor/deleteFeature/(?P<shapefile_id>\d+)/' +
         r'(?P<feature_id>\d+)$',
             'deleteFeature'),
+       (r'^shape-editor/editFeatures/(?P<shapefile_id>\d+)$',
+            'editFeatures'),
 )
 
 # Our TMS Server URLs: